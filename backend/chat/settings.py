@@ -124,18 +124,86 @@ DATABASES = {
 CHANNEL_LAYERS = {
     'default': {
         # "BACKEND": "channels.layers.InMemoryChannelLayer",
-        # using redis
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        # "BACKEND": "channels_redis.core.RedisChannelLayer",
+        # using redis only to reach sockets on other processes
+        'BACKEND': 'chats.layers.HybridChannelLayer',
         'CONFIG': {
             'hosts': [('127.0.0.1', 6379)],
         },
     },
 }
 
+# chat consumers
+CHAT_CONFIG = {
+    # batch message inserts instead of one transaction per message. Off by default:
+    # messages are only broadcast once their batch commits, up to WRITE_BEHIND_MAX_DELAY
+    # later, a trade of latency for insert throughput worth making only under heavy load
+    'WRITE_BEHIND': os.environ.get('CHAT_WRITE_BEHIND', 'FALSE') == 'TRUE',
+    'WRITE_BEHIND_MAX_BATCH': 100,
+    'WRITE_BEHIND_MAX_DELAY': 0.05,
+    # 'local' (the default) counts sockets per process, set 'redis' to share counts across workers
+    'PRESENCE_BACKEND': os.environ.get('CHAT_PRESENCE_BACKEND', 'local'),
+    # redis of the shared counts, its own setting rather than the channel layer's hosts
+    'PRESENCE_REDIS_URL': os.environ.get('CHAT_PRESENCE_REDIS_URL', 'redis://127.0.0.1:6379/0'),
+    # seconds shared counts outlive a worker that stopped refreshing them
+    'PRESENCE_TTL': 60.0,
+    'PRESENCE_FLUSH_INTERVAL': 2.0,
+    # at most one typing broadcast per room per interval, typers expire after ttl
+    'TYPING_INTERVAL': 0.5,
+    'TYPING_TTL': 5.0,
+    # rooms a single multiplexed ws/chat/ socket may subscribe to
+    'MAX_ROOMS_PER_CONNECTION': 200,
+    # frames buffered per socket before typing is shed and the client is dropped
+    'OUTBOUND_QUEUE_SIZE': 500,
+    # frames sent but not yet reported received by the client before its writer waits,
+    # daphne's send doesn't wait for the socket so this is what makes the buffer fill,
+    # clients that never report are held once they have this many
+    'OUTBOUND_WINDOW': 100,
+    # bytes queued plus sent but unreported per socket before the client is dropped
+    'OUTBOUND_MAX_BYTES': 4 * 1024 * 1024,
+    # offer the chat.msgpack subprotocol (msgpack comes with channels_redis)
+    'BINARY_FRAMES': True,
+    # messages replayed per resume frame, clients resume again while has_more
+    'REPLAY_LIMIT': 500,
+    # reaction totals are broadcast per room at most once per interval
+    'REACTION_INTERVAL': 1.0,
+    # archive_messages moves messages older than this into compressed segments
+    'ARCHIVE_AFTER_DAYS': 365,
+    'ARCHIVE_SEGMENT_SIZE': 500,
+    # participants embedded per room in the room list, the rest is paginated
+    'PARTICIPANT_SAMPLE_SIZE': 5,
+    # largest attachment accepted, and the chunk size clients are told to send
+    'UPLOAD_MAX_SIZE': 50 * 1024 * 1024,
+    'UPLOAD_CHUNK_SIZE': 1024 * 1024,
+    # seconds the last chunk's request waits for a preview before it finishes in the background
+    'UPLOAD_PROCESSING_WAIT': 2.0,
+    # seconds after which a chunk write that never finished may be taken over by a retry
+    'UPLOAD_CLAIM_TIMEOUT': 300.0,
+    # processes making image previews, and the longest side of a preview
+    'MEDIA_WORKERS': 2,
+    'THUMBNAIL_SIZE': 320,
+    # room_updated previews for members' sockets outside the room, one event per message
+    # on the room's topic, members of larger rooms get none and refresh the room list
+    'ROOM_UPDATE_MAX_PARTICIPANTS': 1000,
+    'ROOM_UPDATE_PREVIEW_LENGTH': 100,
+    # public channels join one layer channel per process and fan out to local sockets,
+    # other rooms add every socket to the group, see chats/fanout.py, the channel is
+    # re-added to the group well within channels_redis' default one day group expiry
+    'FANOUT_CHANNELS': True,
+    'FANOUT_REFRESH_INTERVAL': 3600.0,
+
+    # socket database work runs on pools of its own rather than asgiref's single sync thread,
+    # history and replay reads get a separate one so they can't hold up sends
+    'DB_WORKERS': 8,
+    'DB_HISTORY_WORKERS': 4,
+    # seconds a call can wait for a worker before the pool logs that it's saturated
+    'DB_SATURATION_WARNING': 0.25,
+}
+
 # RestFramework
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'users.authentication.CachedJWTAuthentication',
     ),
 
     'DEFAULT_PERMISSION_CLASSES': (
@@ -159,6 +227,19 @@ SIMPLE_JWT = {
     'BLACKLIST_AFTER_ROTATION': True,
 }
 
+# verified token -> user snapshot cache shared by the api and websockets
+AUTH_TOKEN_CACHE = {
+    'MAX_SIZE': 10000,
+    'TTL': 300,
+}
+
+# square avatar copies made on upload, SMALL_SIZE is the one chat payloads embed
+AVATAR_RENDITIONS = {
+    'SIZES': (32, 64, 128, 256),
+    'SMALL_SIZE': 64,
+    'QUALITY': 80,
+}
+
 # CORS
 CORS_ALLOWED_ORIGINS = [
     'http://localhost:3000',
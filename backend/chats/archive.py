@@ -0,0 +1,257 @@
+'''Cold tier for old messages
+
+archive_room moves a room's oldest messages out of Message into compressed
+MessageArchiveSegment rows, in seq order and keeping each message's seq,
+and drops their likes, reactions and search rows with them. Only totals
+survive archival, so archived messages report their like and reaction
+counts but not who reacted. Archived messages count as read, archival moves
+participants' read watermarks past them so the unread counters, which only
+count hot messages, stay right. ArchivedMessage rows record which segment
+each message went to.
+
+RoomArchive and search_archive read segments back as unsaved Message
+instances shaped like hot ones, so history, replay and search merge both
+tiers without callers telling them apart.
+'''
+import json
+import uuid
+import zlib
+
+from datetime import datetime
+
+from django.db import transaction
+from django.db.models import OuterRef, Q
+
+from .models import ArchivedMessage, ChatRoom, Message, MessageArchiveSegment, RoomParticipant
+from .reactions import reaction_counts
+from .receipts import unread_messages
+from .search import archive_segment_matches, index_archive_segment, term_patterns, text_snippet
+
+from users.models import User
+
+
+def position(message):
+    # the (created_at, id) keyset order of history pages
+    return message.created_at, message.id
+
+def pack(messages, reactions):
+    records = [
+        {
+            'id': str(message.id),
+            'seq': message.seq,
+            'sender_id': str(message.sender_id),
+            'content': message.content,
+            'message_type': message.message_type,
+            'file': message.file.name or None,
+            'attachment_meta': message.attachment_meta,
+            'is_edited': message.is_edited,
+            'edited_at': message.edited_at.isoformat(),
+            'reply_to_id': str(message.reply_to_id) if message.reply_to_id else None,
+            'created_at': message.created_at.isoformat(),
+            'updated_at': message.updated_at.isoformat(),
+            'likes_count': message.likes_count,
+            'reactions': reactions[message.id],
+        }
+        for message in messages
+    ]
+    return zlib.compress(json.dumps(records, separators=(',', ':')).encode(), 9)
+
+def unpack(data):
+    return json.loads(zlib.decompress(bytes(data)))
+
+def archive_room(room_id, cutoff, segment_size):
+    '''Moving the room's next run of messages older than cutoff into a segment
+
+    The room's last message and messages that hot replies still point at
+    stay hot. Watermarks behind the newest archived message move up to it.
+    Returns the number of messages archived, 0 when done.
+    '''
+    with transaction.atomic():
+        last_message_id = ChatRoom.objects.filter(id=room_id).values_list('last_message_id', flat=True).first()
+        messages = list(
+            Message.objects
+            .filter(room_id=room_id, created_at__lt=cutoff, replies__isnull=True)
+            .exclude(id=last_message_id)
+            .order_by('seq')[:segment_size]
+        )
+        if not messages:
+            return 0
+
+        ids = [message.id for message in messages]
+        newest = max(message.created_at for message in messages)
+        segment = MessageArchiveSegment.objects.create(
+            room_id=room_id,
+            first_seq=messages[0].seq,
+            last_seq=messages[-1].seq,
+            first_created_at=min(message.created_at for message in messages),
+            last_created_at=newest,
+            message_count=len(messages),
+            data=pack(messages, reaction_counts(ids)),
+        )
+        ArchivedMessage.objects.bulk_create(
+            ArchivedMessage(id=message.id, segment=segment, created_at=message.created_at)
+            for message in messages
+        )
+        index_archive_segment(segment.id, '\n'.join(message.content for message in messages))
+        # cascades to likes and reactions, the search trigger drops their index rows
+        Message.objects.filter(id__in=ids).delete()
+        # counted after the delete, so only hot messages newer than the archived ones remain
+        RoomParticipant.objects.filter(
+            Q(last_read_at__isnull=True) | Q(last_read_at__lt=newest), room_id=room_id,
+        ).update(
+            last_read_message=None,
+            last_read_at=newest,
+            unread_count=unread_messages(room_id, OuterRef('user_id'), newest),
+        )
+    return len(messages)
+
+
+class RoomArchive:
+    '''Read side of one room's archived messages
+
+    Segments are picked by their time range and decompressed one at a time
+    until the request is covered, senders are loaded once per archive.
+    '''
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.users = {}
+
+    def segments(self):
+        return MessageArchiveSegment.objects.filter(room_id=self.room_id)
+
+    def messages(self, segment):
+        return materialize(unpack(segment.data), segment.room_id, self.users)
+
+    def older(self, before=None, limit=50, floor=None):
+        '''Up to limit messages positioned before before and after floor, newest first'''
+        segments = self.segments().order_by('-last_created_at')
+        if before is not None:
+            segments = segments.filter(first_created_at__lte=before[0])
+        if floor is not None:
+            segments = segments.filter(last_created_at__gte=floor[0])
+
+        found = []
+        for segment in segments.iterator(chunk_size=4):
+            if len(found) >= limit and segment.last_created_at < found[limit - 1].created_at:
+                break
+            found += [
+                message for message in self.messages(segment)
+                if (before is None or position(message) < before)
+                and (floor is None or position(message) > floor)
+            ]
+            found.sort(key=position, reverse=True)
+        return found[:limit]
+
+    def newer(self, after, limit=50, ceiling=None, inclusive=False):
+        '''Up to limit messages positioned after after and before ceiling, oldest first'''
+        segments = self.segments().order_by('first_created_at').filter(last_created_at__gte=after[0])
+        if ceiling is not None:
+            segments = segments.filter(first_created_at__lte=ceiling[0])
+
+        found = []
+        for segment in segments.iterator(chunk_size=4):
+            if len(found) >= limit and segment.first_created_at > found[limit - 1].created_at:
+                break
+            found += [
+                message for message in self.messages(segment)
+                if (position(message) >= after if inclusive else position(message) > after)
+                and (ceiling is None or position(message) < ceiling)
+            ]
+            found.sort(key=position)
+        return found[:limit]
+
+    def after_seq(self, seq, limit):
+        '''Up to limit messages numbered after seq, in seq order'''
+        found = []
+        for segment in self.segments().filter(last_seq__gt=seq).order_by('first_seq').iterator(chunk_size=4):
+            if len(found) >= limit and segment.first_seq > found[limit - 1].seq:
+                break
+            found += [message for message in self.messages(segment) if message.seq > seq]
+            found.sort(key=lambda message: message.seq)
+        return found[:limit]
+
+    def locate(self, message_id):
+        '''Position of an archived message, None if it isn't archived here'''
+        try:
+            message_id = uuid.UUID(str(message_id))
+        except ValueError:
+            return None
+        created_at = (
+            ArchivedMessage.objects
+            .filter(id=message_id, segment__room_id=self.room_id)
+            .values_list('created_at', flat=True)
+            .first()
+        )
+        return (created_at, message_id) if created_at is not None else None
+
+
+def materialize(records, room_id, users):
+    '''Unsaved Message instances for archived records, with what serializers read attached'''
+    missing = {record['sender_id'] for record in records} - users.keys()
+    if missing:
+        users.update(dict.fromkeys(missing))
+        for user in User.objects.filter(id__in=missing).select_related('profile'):
+            users[str(user.id)] = user
+
+    messages = []
+    for record in records:
+        sender = users.get(record['sender_id'])
+        if sender is None:
+            # the sender was deleted, hot messages would have gone with them
+            continue
+        message = Message(
+            id=uuid.UUID(record['id']),
+            room_id=room_id,
+            seq=record['seq'],
+            sender=sender,
+            content=record['content'],
+            message_type=record['message_type'],
+            file=record['file'],
+            attachment_meta=record.get('attachment_meta') or {},
+            is_edited=record['is_edited'],
+            edited_at=datetime.fromisoformat(record['edited_at']),
+            reply_to_id=uuid.UUID(record['reply_to_id']) if record['reply_to_id'] else None,
+            created_at=datetime.fromisoformat(record['created_at']),
+            updated_at=datetime.fromisoformat(record['updated_at']),
+            likes_count=record['likes_count'],
+        )
+        message._state.adding = False
+        message.is_archived = True
+        message.reaction_totals = record['reactions']
+        # per user likes and reactions are gone, answer without querying
+        message.liked_by_user = False
+        message.own_reactions = []
+        message._prefetched_objects_cache = {'likes': User.objects.none()}
+        messages.append(message)
+    return messages
+
+def merge(hot, cold, limit, reverse=False):
+    return sorted(hot + cold, key=position, reverse=reverse)[:limit]
+
+def search_archive(room_ids, text, before=None, limit=20):
+    '''Archived messages of the rooms matching text, newest first, each with a snippet'''
+    patterns = term_patterns(text)
+    if not patterns:
+        return []
+    segments = (
+        MessageArchiveSegment.objects
+        .filter(archive_segment_matches(text), room_id__in=room_ids)
+        .order_by('-last_created_at')
+    )
+    if before is not None:
+        segments = segments.filter(first_created_at__lte=before[0])
+
+    users, found = {}, []
+    for segment in segments.iterator(chunk_size=4):
+        if len(found) >= limit and segment.last_created_at < found[limit - 1].created_at:
+            break
+        for message in materialize(unpack(segment.data), segment.room_id, users):
+            if before is not None and position(message) >= before:
+                continue
+            snippet = text_snippet(message.content, patterns)
+            if snippet is not None:
+                message.snippet = snippet
+                found.append(message)
+        found.sort(key=position, reverse=True)
+    return found[:limit]
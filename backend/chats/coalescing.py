@@ -0,0 +1,206 @@
+import asyncio
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from .executors import chat_db_to_async
+from .frames import frame_event
+from . import reactions
+from .utils import chat_config
+
+logger = logging.getLogger(__name__)
+
+
+class TypingCoalescer:
+    '''Per-room typing state broadcast as at most one event per room per interval
+
+    Keystroke frames only refresh a user's expiry. A room is broadcast when
+    someone starts or stops typing, when a typer goes quiet for TYPING_TTL
+    seconds, or when a long running typer needs re-announcing before client
+    side expiry. Events carry the changes as deltas plus the ttl so clients
+    connected to other workers can merge them.
+
+    A user typing from several sockets stays typing until the last of them
+    stops, leaves the room or goes quiet.
+    '''
+
+    def __init__(self, interval=None, ttl=None):
+        self.interval = interval or chat_config('TYPING_INTERVAL')
+        self.ttl = ttl or chat_config('TYPING_TTL')
+        # room_id -> user_id -> [username, expires_at, announced_at, typing channels]
+        self.rooms = {}
+        # room_id -> user_id -> (username, is_typing)
+        self.changes = {}
+        self.timer = None
+        self.sending = set()
+
+    def update(self, room_id, user_id, username, is_typing, channel=None):
+        now = asyncio.get_running_loop().time()
+        typers = self.rooms.setdefault(room_id, {})
+        if is_typing:
+            if user_id in typers:
+                typers[user_id][1] = now + self.ttl
+                typers[user_id][3].add(channel)
+                return
+            typers[user_id] = [username, now + self.ttl, now, {channel}]
+            self.changes.setdefault(room_id, {})[user_id] = (username, True)
+        else:
+            state = typers.get(user_id)
+            if state is None:
+                if not typers:
+                    del self.rooms[room_id]
+                return
+            # the user's other sockets may still be typing
+            state[3].discard(channel)
+            if state[3]:
+                return
+            del typers[user_id]
+            if not typers:
+                del self.rooms[room_id]
+            self.changes.setdefault(room_id, {})[user_id] = (username, False)
+        self.ensure_timer()
+
+    def ensure_timer(self):
+        if self.timer is None:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(self.interval, self.tick)
+
+    def tick(self):
+        self.timer = None
+        now = asyncio.get_running_loop().time()
+
+        for room_id in list(self.rooms):
+            typers = self.rooms[room_id]
+            for user_id, state in list(typers.items()):
+                username, expires_at, announced_at, _ = state
+                if expires_at <= now:
+                    del typers[user_id]
+                    self.changes.setdefault(room_id, {})[user_id] = (username, False)
+                elif now - announced_at >= self.ttl / 2:
+                    state[2] = now
+                    self.changes.setdefault(room_id, {})[user_id] = (username, True)
+            if not typers:
+                del self.rooms[room_id]
+
+        if self.changes:
+            changes, self.changes = self.changes, {}
+            task = asyncio.ensure_future(self.broadcast(changes))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+        if self.rooms:
+            self.ensure_timer()
+
+    async def broadcast(self, changes):
+        channel_layer = get_channel_layer()
+        for room_id, users in changes.items():
+            event = frame_event(
+                'typing_indicator', 'typing',
+                room_id=str(room_id),
+                users=[
+                    {'user_id': user_id, 'username': username, 'is_typing': is_typing}
+                    for user_id, (username, is_typing) in users.items()
+                ],
+                ttl=self.ttl,
+            )
+            try:
+                await channel_layer.group_send(f'chat_{room_id}', event)
+            except Exception:
+                logger.exception('Failed to broadcast typing for room %s', room_id)
+
+
+class ReactionCoalescer:
+    '''Reaction and like changes broadcast per room as current totals, at most once per interval
+
+    A change only marks its message dirty. Each tick reads the totals of
+    every dirty message in one go and sends one event per room, so a burst
+    of reactions on a popular message costs one broadcast per interval
+    rather than one per reaction. Events carry totals, not deltas, so
+    workers flushing the same message both send correct counts.
+
+    Ticks run on the loop serving sockets, see attach(). Changes made on
+    other threads are handed to it by changed().
+    '''
+
+    def __init__(self, interval=None):
+        self.interval = interval or chat_config('REACTION_INTERVAL')
+        # room_id -> message ids
+        self.dirty = {}
+        self.timer = None
+        self.sending = set()
+        self.loop = None
+
+    def attach(self):
+        self.loop = asyncio.get_running_loop()
+
+    def changed(self, room_id, message_id):
+        '''Marking a message dirty from any thread but the loop's
+
+        Without a loop serving sockets, a process only answering http, the
+        message's totals are broadcast right away.
+        '''
+        loop = self.loop
+        if loop is not None and loop.is_running():
+            loop.call_soon_threadsafe(self.update, room_id, message_id)
+        else:
+            async_to_sync(self.send)({room_id: {message_id}}, reactions.message_totals([message_id]))
+
+    def update(self, room_id, message_id):
+        self.dirty.setdefault(room_id, set()).add(message_id)
+        if self.timer is None:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(self.interval, self.tick)
+
+    def tick(self):
+        self.timer = None
+        if self.dirty:
+            dirty, self.dirty = self.dirty, {}
+            task = asyncio.ensure_future(self.broadcast(dirty))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+    async def broadcast(self, dirty):
+        try:
+            totals = await chat_db_to_async(reactions.message_totals)(
+                [message_id for message_ids in dirty.values() for message_id in message_ids]
+            )
+        except Exception:
+            logger.exception('Failed to read reaction counts for %d rooms', len(dirty))
+            return
+        await self.send(dirty, totals)
+
+    async def send(self, dirty, totals):
+        channel_layer = get_channel_layer()
+        for room_id, message_ids in dirty.items():
+            event = frame_event(
+                'reaction_update', 'reactions',
+                room_id=str(room_id),
+                # deleted messages have no totals
+                messages=[
+                    {'message_id': str(message_id), **totals[message_id]}
+                    for message_id in message_ids if message_id in totals
+                ],
+            )
+            try:
+                await channel_layer.group_send(f'chat_{room_id}', event)
+            except Exception:
+                logger.exception('Failed to broadcast reactions for room %s', room_id)
+
+
+_typing = None
+
+def get_typing_coalescer():
+    global _typing
+    if _typing is None:
+        _typing = TypingCoalescer()
+    return _typing
+
+
+_reactions = None
+
+def get_reaction_coalescer():
+    global _reactions
+    if _reactions is None:
+        _reactions = ReactionCoalescer()
+    return _reactions
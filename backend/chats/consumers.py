@@ -1,49 +1,213 @@
+import asyncio
 import json
 import jwt
+import logging
+import uuid
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import ValidationError
+from django.db.models import Q
 
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from rest_framework.exceptions import APIException
+
+from users.authentication import token_user_cache
 from .models import ChatRoom, Message
+from .archive import RoomArchive
+from .coalescing import get_reaction_coalescer, get_typing_coalescer
+from .executors import chat_db_to_async, db_executor_stats
+from .fanout import get_fanout_hub, uses_fanout
+from .frames import (
+    MSGPACK_SUBPROTOCOL, binary_frames_enabled, decode_binary_frame,
+    binary_event_frame, encode_binary_frame, encode_frame, frame_event,
+)
+from .notifications import room_updates_group, send_room_update, update_room_ids, user_group
+from .outbound import OutboundQueue
+from .pagination import MessageCursorPagination, encode_cursor, paginate_messages
+from .persistence import (
+    build_message, get_write_buffer, persist_message, replay_messages, serialize_message,
+)
+from .presence import get_presence_tracker
+from .reactions import react, valid_emoji
+from .receipts import advance_read_watermark
+from .uploads import UploadUnavailable
+from .utils import chat_config
 
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
+
+def canonical_room_id(value):
+    '''The lowercase hyphenated form of a room id, None if it isn't a uuid
+
+    UUIDField lookups also take uppercase, braced and urn:uuid: spellings,
+    group names and self.rooms only ever see this one.
+    '''
+    try:
+        return str(uuid.UUID(str(value)))
+    except ValueError:
+        return None
 
 class chatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'chat_{self.room_id}'
+        # ws/chat/<room_id>/ joins that room straight away, ws/chat/ starts
+        # with no rooms and subscribes in-band
+        self.room_id = self.scope['url_route']['kwargs'].get('room_id')
+        if self.room_id is not None:
+            self.room_id = canonical_room_id(self.room_id) or self.room_id
+        self.rooms = set()
+        # rooms delivered through the process's fan-out hub rather than group membership
+        self.fanout_rooms = set()
+        # rooms whose room_updated topic this socket is in
+        self.update_rooms = set()
+        self.pending_acks = set()
+        self.slow_closed = False
 
         #Authenticate user before accepting connection
         user = await self.authenticate_user()
         if user is None or user.is_anonymous:
             await self.close(code=4001)
             return
-        
-        # join room group 
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        self.scope['user'] = user
 
-        await self.accept()
+        # checking access once so messages can be saved by room_id
+        if self.room_id is not None:
+            room = await self.get_room_access(user, self.room_id)
+            if room is None:
+                await self.close(code=4004)
+                return
+            # join room group 
+            await self.join_room(self.room_id, uses_fanout(room))
+        # every socket of the user, for events about the user
+        await self.channel_layer.group_add(user_group(user.id), self.channel_name)
+        self.user_group = user_group(user.id)
+        # and the room_updated topics of the user's rooms, dropped while subscribed
+        for room_id in await self.get_update_room_ids(user):
+            await self.channel_layer.group_add(room_updates_group(room_id), self.channel_name)
+            self.update_rooms.add(str(room_id))
+
+        # compact binary frames for clients asking for the msgpack subprotocol
+        self.binary = (
+            MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', ())
+            and binary_frames_enabled()
+        )
+        await self.accept(subprotocol=MSGPACK_SUBPROTOCOL if self.binary else None)
+        # reaction totals are coalesced on the loop serving sockets
+        get_reaction_coalescer().attach()
+
+        # everything sent to the client goes through a bounded buffer
+        self.outbound = OutboundQueue(
+            self.send_now, chat_config('OUTBOUND_QUEUE_SIZE'), chat_config('OUTBOUND_WINDOW'),
+            chat_config('OUTBOUND_MAX_BYTES'),
+        )
+        self.outbound.start()
 
-        # send online status
-        if self.scope['user'].is_authenticated:
-            await self.update_user_online_status(True)
+        # counting sockets, only the first one marks the user online
+        self.presence_joined = True
+        if await get_presence_tracker().connect(user.id):
+            await self.broadcast_presence(user, True)
 
     async def disconnect(self, close_code):
-        # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
+        for task in getattr(self, 'pending_acks', ()):
+            task.cancel()
+
+        outbound = getattr(self, 'outbound', None)
+        if outbound is not None:
+            outbound.stop()
+            logger.info('Chat socket closed (%s) with outbound stats %s', close_code, outbound.stats)
+
+        # Leave room groups
+        for room_id in list(getattr(self, 'rooms', ())):
+            await self.leave_room(room_id)
+        if getattr(self, 'user_group', None) is not None:
+            await self.channel_layer.group_discard(self.user_group, self.channel_name)
+        for room_id in list(getattr(self, 'update_rooms', ())):
+            await self.channel_layer.group_discard(room_updates_group(room_id), self.channel_name)
+
+        # update offline status once the user's last socket closes
+        if getattr(self, 'presence_joined', False):
+            user = self.scope['user']
+            if await get_presence_tracker().disconnect(user.id):
+                await self.broadcast_presence(user, False)
+
+    async def join_room(self, room_id, fanout=False):
+        if fanout:
+            await get_fanout_hub().subscribe(room_id, self)
+            self.fanout_rooms.add(room_id)
+        else:
+            await self.channel_layer.group_add(f'chat_{room_id}', self.channel_name)
+        self.rooms.add(room_id)
+
+    async def leave_room(self, room_id):
+        self.rooms.discard(room_id)
+        if room_id in self.fanout_rooms:
+            self.fanout_rooms.discard(room_id)
+            await get_fanout_hub().unsubscribe(room_id, self)
+        else:
+            await self.channel_layer.group_discard(f'chat_{room_id}', self.channel_name)
+        user = self.scope['user']
+        get_typing_coalescer().update(room_id, str(user.id), user.username, False, self.channel_name)
+
+    def resolve_room(self, data):
+        '''Room a client frame targets, its room_id or the room of the url'''
+        room_id = data.get('room_id') or self.room_id
+        if room_id is None:
+            return None
+        room_id = canonical_room_id(room_id)
+        return room_id if room_id in self.rooms else None
+
+    async def send_frame(self, frame, kind='message', key=None):
+        '''Queueing a frame for the client, disconnecting it if it can't keep up'''
+        if self.outbound.put(frame, kind, key):
+            return
+        if self.slow_closed:
+            return
+        # still full after shedding typing, the client has to resync
+        self.slow_closed = True
+        self.outbound.stop()
+        logger.warning('Disconnecting slow chat client, outbound stats %s', self.outbound.stats)
+        await self.send_now(self.encode('resync', reason='slow_consumer', rooms=sorted(self.rooms)))
+        await self.close(code=4008)
+
+    async def send_now(self, frame):
+        if isinstance(frame, bytes):
+            await super().send(bytes_data=frame)
+        else:
+            await super().send(text_data=frame)
+
+    def encode(self, frame_type, **fields):
+        if self.binary:
+            return encode_binary_frame(frame_type, **fields)
+        return encode_frame(frame_type, **fields)
+
+    async def reply(self, frame_type, **fields):
+        '''Frame for this client only, encoded for its protocol'''
+        await self.send_frame(self.encode(frame_type, **fields))
+
+    def event_frame(self, event):
+        # group events carry the JSON frame pre-encoded, the msgpack one is made once per process
+        if self.binary:
+            return binary_event_frame(event)
+        return event['text']
+
+    async def send_error(self, data, error):
+        await self.reply(
+            'error',
+            room_id=data.get('room_id') or self.room_id,
+            request_type=data.get('type'),
+            error=error,
         )
 
-        # update offline status
-        if self.scope['user'].is_authenticated:
-            await self.update_user_online_status(False)
+    async def broadcast_presence(self, user, is_online):
+        for room_id in await self.get_user_room_ids(user):
+            await self.channel_layer.group_send(f'chat_{room_id}', frame_event(
+                'user_presence', 'presence',
+                room_id=str(room_id),
+                user_id=str(user.id),
+                username=user.username,
+                is_online=is_online,
+            ))
 
     async def authenticate_user(self):
         #Authenticating user from token in query string or cookie
@@ -72,101 +236,326 @@ class chatConsumer(AsyncWebsocketConsumer):
         
         if not token:
             return AnonymousUser()
+
+        if isinstance(token, bytes):
+            token = token.decode('utf-8')
+        token = token.strip()
+        if token.startswith('"') and token.endswith('"'):
+            token = token[1:-1]
+
+        # reconnects with a token seen before skip the decode and users lookup
+        user = token_user_cache.get(token)
+        if user is not None:
+            return user
         
         return await self.get_user_from_token(token)
 
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            if not self.binary:
+                return
+            try:
+                text_data_json = decode_binary_frame(bytes_data)
+            except Exception:
+                return
+        else:
+            text_data_json = json.loads(text_data)
         message_type  = text_data_json.get('type')
         print("websocket message type: ",message_type)
 
-        if message_type == "chat_message":
+        if message_type == 'subscribe':
+            await self.handle_subscribe(text_data_json)
+        elif message_type == 'unsubscribe':
+            await self.handle_unsubscribe(text_data_json)
+        elif message_type == "chat_message":
             await self.handle_chat_message(text_data_json)
         elif message_type == "typing":
             await self.handle_typing_indicator(text_data_json)
         elif message_type == "message_read":
             await self.handle_message_read(text_data_json)
+        elif message_type == 'read_up_to':
+            await self.handle_message_read(text_data_json, frame_type='read_up_to')
+        elif message_type == 'reaction':
+            await self.handle_reaction(text_data_json)
+        elif message_type == 'resume':
+            await self.handle_resume(text_data_json)
+        elif message_type == 'fetch_history':
+            await self.handle_fetch_history(text_data_json)
+        elif message_type == 'frames_received':
+            # the client's running count of frames, what's in flight to it gates the writer
+            try:
+                self.outbound.acknowledge(int(text_data_json.get('count')))
+            except (TypeError, ValueError):
+                pass
+        elif message_type == 'connection_stats':
+            # staff also see how saturated the process's DB pools are
+            db_pools = db_executor_stats() if self.scope['user'].is_staff else None
+            await self.reply(
+                'connection_stats', depth=self.outbound.depth, unacknowledged=self.outbound.unacknowledged,
+                db_pools=db_pools, **self.outbound.stats
+            )
         elif message_type  == 'typing_start':
-            await self.handle_typing_indicator(True)
+            await self.handle_typing_indicator({**text_data_json, 'is_typing': True})
         elif message_type == 'typing_stop':
-            await self.handle_typing_indicator(False)
+            await self.handle_typing_indicator({**text_data_json, 'is_typing': False})
+
+    async def handle_subscribe(self, data):
+        user = self.scope['user']
+        room_id = canonical_room_id(data.get('room_id', ''))
+        if room_id is None:
+            await self.send_error(data, 'Room not found')
+            return
+        if room_id in self.rooms:
+            await self.reply('subscribed', room_id=room_id)
+            return
+        if len(self.rooms) >= chat_config('MAX_ROOMS_PER_CONNECTION'):
+            await self.send_error(data, 'Too many rooms on this connection')
+            return
+        room = await self.get_room_access(user, room_id)
+        if room is None:
+            await self.send_error(data, 'Room not found')
+            return
+        await self.join_room(room_id, uses_fanout(room))
+        await self.reply('subscribed', room_id=room_id)
+        if data.get('seq') is not None:
+            await self.handle_resume(data)
+
+    async def handle_unsubscribe(self, data):
+        room_id = canonical_room_id(data.get('room_id', '')) or str(data.get('room_id', ''))
+        if room_id in self.rooms:
+            await self.leave_room(room_id)
+        await self.reply('unsubscribed', room_id=room_id)
+
 
-        
     async def handle_chat_message(self, data):
-        message_content = data['message']
+        # text, or an attachment by the id of a completed upload with an optional caption
+        message_content = data.get('message') or ''
+        upload_id = data.get('upload_id')
         user = self.scope["user"]
         print("Message content and user: ",message_content, user)
 
+        room_id = self.resolve_room(data)
+        if room_id is None:
+            await self.send_error(data, 'Not subscribed to room')
+            return
+        if not message_content and not upload_id:
+            await self.send_error(data, 'Empty message')
+            return
+
         if user.is_authenticated:
-            # save message to database
-            print("started saving message")
-            message = await self.save_message(user, message_content)
-            
-            print("message saved and broadcasting")
-            # send message to room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': await self.message_to_dict(message),
-                    'sender_username': user.username,
-                }
+            durable = bool(data.get('durable', False))
+            # attachments claim their upload in the same transaction as the INSERT
+            write_behind = chat_config('WRITE_BEHIND') and not upload_id
+
+            if upload_id:
+                try:
+                    message, payload = await self.save_message(room_id, user, message_content, upload_id)
+                except (UploadUnavailable, ValidationError):
+                    await self.send_error(data, 'Upload not found or not ready')
+                    return
+            elif write_behind:
+                # queued for a batched insert, the buffer numbers and broadcasts it once committed
+                message = build_message(room_id, user, message_content)
+                saved = get_write_buffer().enqueue(message, durable=durable)
+            else:
+                # save message to database
+                print("started saving message")
+                message, payload = await self.save_message(room_id, user, message_content)
+
+            if not write_behind:
+                print("message saved and broadcasting")
+                # send message to room group, encoded once for every member
+                await self.channel_layer.group_send(
+                    f'chat_{room_id}',
+                    frame_event(
+                        'chat_message', 'chat_message',
+                        room_id=room_id,
+                        message=payload,
+                        sender_username=user.username,
+                    )
+                )
+                # one preview for the members elsewhere, whatever the room's size
+                await send_room_update(self.channel_layer, room_id, payload)
+
+            if durable:
+                if write_behind:
+                    task = asyncio.ensure_future(
+                        self.send_durable_ack(saved, room_id, message, data.get('client_id'))
+                    )
+                    self.pending_acks.add(task)
+                    task.add_done_callback(self.pending_acks.discard)
+                else:
+                    await self.send_message_ack(room_id, message, data.get('client_id'))
+
+    async def send_durable_ack(self, saved, room_id, message, client_id):
+        # acking only once the write-behind batch holding the message committed
+        try:
+            await saved
+        except Exception:
+            await self.reply(
+                'message_error',
+                room_id=room_id,
+                message_id=str(message.id),
+                client_id=client_id,
+                error='Message could not be saved',
             )
+            return
+        await self.send_message_ack(room_id, message, client_id)
+
+    async def send_message_ack(self, room_id, message, client_id):
+        await self.reply(
+            'message_ack',
+            room_id=room_id,
+            message_id=str(message.id),
+            client_id=client_id,
+        )
 
     async def handle_typing_indicator(self, data):
+        # only records state, the coalescer broadcasts per room on its own tick
+        user = self.scope['user']
+        room_id = self.resolve_room(data)
+        if room_id is not None and user.is_authenticated:
+            get_typing_coalescer().update(
+                room_id, str(user.id), user.username, bool(data.get('is_typing')), self.channel_name
+            )
+
+    async def handle_message_read(self, data, frame_type='message_read'):
+        # reads move the user's watermark, everything up to message_id is read
         user = self.scope['user']
+        room_id = self.resolve_room(data)
+        if room_id is None:
+            await self.send_error(data, 'Not subscribed to room')
+            return
+        try:
+            message_id = str(uuid.UUID(str(data.get('message_id'))))
+        except ValueError:
+            await self.send_error(data, 'Invalid message id')
+            return
+
         if user.is_authenticated:
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'typing_indicator',
-                    'user_id': str(user.id),
-                    'username': user.username,
-                    'is_typing': data['is_typing']
-                }
+            unread_count = await self.mark_read_up_to(user, room_id, message_id)
+            if unread_count is None:
+                # unknown message or the watermark is already past it
+                return
+            # the reader's own counter, to all their sockets, new messages from others count +1 client side
+            await self.channel_layer.group_send(self.user_group, frame_event(
+                'unread_count', 'unread_count', room_id=room_id, unread_count=unread_count,
+            ))
+
+            event = frame_event(
+                'message_read', frame_type,
+                room_id=room_id,
+                message_id=message_id,
+                user_id=str(user.id),
+                username=user.username,
             )
+            # a newer receipt from the same reader supersedes a queued one
+            event['coalesce_key'] = f'read:{room_id}:{user.id}'
+            await self.channel_layer.group_send(f'chat_{room_id}', event)
 
-    async def handle_message_read(self, data):
+    async def handle_reaction(self, data):
+        # applied right away, totals reach the room with the next coalesced batch
         user = self.scope['user']
-        message_id = data['message_id']
+        room_id = self.resolve_room(data)
+        if room_id is None:
+            await self.send_error(data, 'Not subscribed to room')
+            return
+        emoji = data.get('emoji')
+        try:
+            message_id = uuid.UUID(str(data.get('message_id')))
+        except ValueError:
+            message_id = None
+        if message_id is None or not valid_emoji(emoji):
+            await self.send_error(data, 'Invalid reaction')
+            return
 
         if user.is_authenticated:
-            await self.mark_message_as_read(user, message_id)
-
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'message_read',
-                    'message_id': message_id,
-                    'user_id': str(user.id),
-                    'username': user.username,
-                }
+            add = data.get('action', 'add') != 'remove'
+            changed = await self.apply_reaction(user, room_id, message_id, emoji, add)
+            if changed is None:
+                await self.send_error(data, 'Message not found')
+                return
+            await self.reply(
+                'reaction_ack', room_id=room_id, message_id=str(message_id), emoji=emoji, reacted=add
             )
 
+    async def handle_fetch_history(self, data):
+        # same cursors as the http history endpoint, answered on this socket only
+        room_id = self.resolve_room(data)
+        if room_id is None:
+            await self.send_error(data, 'Not subscribed to room')
+            return
+        try:
+            limit = min(int(data.get('limit', 50)), MessageCursorPagination.max_page_size)
+            history = await self.get_history(
+                room_id, data.get('before'), data.get('after'), data.get('around'), max(limit, 1)
+            )
+        except (APIException, ValueError, TypeError):
+            await self.reply(
+                'history_error', room_id=room_id, request_id=data.get('request_id'),
+                error='Invalid history request',
+            )
+            return
+        await self.reply(
+            'history', room_id=room_id, request_id=data.get('request_id'), **history
+        )
+
+    async def handle_resume(self, data):
+        # replays what a reconnecting client missed after the last seq it saw,
+        # live messages may overlap the replay so clients drop seqs they have
+        room_id = self.resolve_room(data)
+        if room_id is None:
+            await self.send_error(data, 'Not subscribed to room')
+            return
+        try:
+            after_seq = max(int(data.get('seq', 0)), 0)
+        except (ValueError, TypeError):
+            await self.send_error(data, 'Invalid seq')
+            return
+        if chat_config('WRITE_BEHIND'):
+            # numbered messages still queued in this process would look like gaps
+            await get_write_buffer().flush()
+        messages, has_more = await self.get_replay(room_id, after_seq)
+        await self.reply(
+            'replay', room_id=room_id, seq=after_seq, messages=messages, has_more=has_more
+        )
+
+    # group events carry the frame already encoded by the sender,
+    # members only forward it
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': event['message'],
-            'sender_username': event['sender_username'],
-        }))
+        await self.send_frame(self.event_frame(event))
         
     async def typing_indicator(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'typing',
-            'user_id': event['user_id'],
-            'username': event['username'],
-            'is_typing': event['is_typing'],
-        }))
+        await self.send_frame(self.event_frame(event), kind='typing')
 
     async def message_read(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'message_read',
-            'message_id': event['message_id'],
-            'user_id': event['user_id'],
-            'username': event['username'],
-        }))
-
-    @database_sync_to_async
+        await self.send_frame(self.event_frame(event), kind='read', key=event.get('coalesce_key'))
+
+    async def user_presence(self, event):
+        await self.send_frame(self.event_frame(event))
+
+    async def reaction_update(self, event):
+        await self.send_frame(self.event_frame(event))
+
+    async def room_updated(self, event):
+        # subscribed sockets see the message itself, senders know what they sent
+        if event['room_id'] not in self.rooms and event['sender_id'] != str(self.scope['user'].id):
+            await self.send_frame(self.event_frame(event), kind='room_update', key=f'room:{event["room_id"]}')
+
+    async def room_membership(self, event):
+        # the user joined or left a room since this socket connected
+        group = room_updates_group(event['room_id'])
+        if event['joined']:
+            await self.channel_layer.group_add(group, self.channel_name)
+            self.update_rooms.add(event['room_id'])
+        else:
+            await self.channel_layer.group_discard(group, self.channel_name)
+            self.update_rooms.discard(event['room_id'])
+
+    async def unread_count(self, event):
+        await self.send_frame(self.event_frame(event))
+
+    @chat_db_to_async
     def get_user_from_token(self, token):
         #validating token and returning user object
         try:
@@ -174,14 +563,6 @@ class chatConsumer(AsyncWebsocketConsumer):
             print("token type:", type(token))
 
             from django.conf import settings
-            if isinstance(token, bytes):
-                token = token.decode('utf-8')
-            
-            token.strip()
-            if token.startswith('"') and token.endswith('"'):
-                token = token[1:-1]
-
-            print(f'Cleaned token: {token}')
 
             payload = jwt.decode(
                 token,
@@ -194,6 +575,7 @@ class chatConsumer(AsyncWebsocketConsumer):
             if user_id:
                 user = User.objects.get(id=user_id)
                 print("Found user : ", user.username)
+                token_user_cache.set(token, user, payload.get('exp'))
                 return user
 
         except jwt.ExpiredSignatureError:
@@ -213,42 +595,58 @@ class chatConsumer(AsyncWebsocketConsumer):
 
         return  AnonymousUser()
 
-    @database_sync_to_async
-    def update_user_online_status(self, is_online):
-        user = User.objects.get(id=self.scope['user'].id)
-        user.is_online = is_online
-        user.save()
+    @chat_db_to_async
+    def get_user_room_ids(self, user):
+        return list(ChatRoom.objects.filter(participants=user).values_list('id', flat=True))
+
+    @chat_db_to_async
+    def get_update_room_ids(self, user):
+        return update_room_ids(user.id)
 
-    @database_sync_to_async
-    def mark_message_as_read(self, user, message_id):
+    @chat_db_to_async
+    def mark_read_up_to(self, user, room_id, message_id):
         try:
-            message = Message.objects.get(id=message_id)
-            message.read_by.add(user)
-        except Message.DoesNotExist:
-            pass
-    @database_sync_to_async
-    def message_to_dict(self, message):
+            message = Message.objects.only('id', 'room_id', 'created_at').get(id=message_id, room_id=room_id)
+        except (Message.DoesNotExist, ValidationError):
+            return None
+        return advance_read_watermark(user.id, message)
+
+    @chat_db_to_async
+    def apply_reaction(self, user, room_id, message_id, emoji, add):
+        # None when the message isn't in the room, else whether anything changed
+        if not Message.objects.filter(id=message_id, room_id=room_id).exists():
+            return None
+        _, changed = react(room_id, message_id, user.id, emoji, add)
+        return changed
+
+    @chat_db_to_async(pool='history')
+    def get_history(self, room_id, before, after, around, limit):
+        messages, has_before, has_after = paginate_messages(
+            Message.objects.filter(room_id=room_id).select_related('sender'),
+            before=before, after=after, around=around, limit=limit, archive=RoomArchive(room_id),
+        )
         return {
-            'id': str(message.id),
-            'content': message.content,
-            'sender': {
-                'id': str(message.sender.id),
-                'username': message.sender.username,
-                'avatar': message.sender.avatar.url if message.sender.avatar else None,
-
-            },
-            'created_at': message.created_at.isoformat(),
-            'message_type': message.message_type,
+            'messages': [serialize_message(message) for message in messages],
+            'before': encode_cursor(messages[0]) if messages and has_before else None,
+            'after': encode_cursor(messages[-1]) if messages and has_after else None,
         }
 
-    @database_sync_to_async
-    def save_message(self, user, content):
-        room = ChatRoom.objects.get(id=self.room_id)
-        print("Room for message: ", room)
-        message = Message.objects.create(
-            room=room,
-            sender=user,
-            content=content,
-        )
-        print("message created successfully: ", message)
-        return message
\ No newline at end of file
+    @chat_db_to_async(pool='history')
+    def get_replay(self, room_id, after_seq):
+        return replay_messages(room_id, after_seq, chat_config('REPLAY_LIMIT'))
+
+    @chat_db_to_async
+    def get_room_access(self, user, room_id):
+        # participants, or anyone for public channels, None without access
+        try:
+            return ChatRoom.objects.filter(
+                Q(participants=user) | Q(room_type='channel', is_private=False),
+                id=room_id,
+            ).values('room_type', 'is_private').first()
+        except ValidationError:
+            return None
+
+    @chat_db_to_async
+    def save_message(self, room_id, user, content, upload_id=None):
+        # one thread hop for the INSERT, the payload is built from objects in memory
+        return persist_message(room_id, user, content, upload_id=upload_id)
\ No newline at end of file
@@ -0,0 +1,160 @@
+'''Dedicated thread pools for the chat sockets' database work
+
+database_sync_to_async is thread sensitive, every call of the process runs
+on asgiref's one sync thread along with the auth middleware and any other
+sync_to_async work, so a single slow query holds all of them up. Django's
+async ORM methods wrap the same thread sensitive sync_to_async, so they
+share that thread too.
+
+chat_db_to_async runs calls on sized pools of their own instead. The
+'messages' pool takes the send path: auth, access checks, inserts, read
+receipts, reactions and presence. The 'history' pool takes history pages
+and reconnect replay, which read far more rows, so a burst of those queues
+behind its own workers and not in front of message sends.
+
+Each pool counts queued, busy and finished calls and how long calls waited
+for a worker, and logs a warning when a call waited longer than
+DB_SATURATION_WARNING seconds.
+'''
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+
+from channels.db import DatabaseSyncToAsync
+
+from .utils import chat_config
+
+logger = logging.getLogger(__name__)
+
+# pool name -> CHAT_CONFIG key of its worker count
+POOL_SIZES = {
+    'messages': 'DB_WORKERS',
+    'history': 'DB_HISTORY_WORKERS',
+}
+# seconds between saturation warnings of a pool
+WARNING_INTERVAL = 10.0
+
+
+class MeteredExecutor(ThreadPoolExecutor):
+    '''Thread pool keeping counters of its backlog and of how long calls waited'''
+
+    def __init__(self, name, max_workers, warn_after):
+        super().__init__(max_workers=max_workers, thread_name_prefix=f'chat-db-{name}')
+        self.name = name
+        self.warn_after = warn_after
+        self.warned_at = 0.0
+        self.lock = threading.Lock()
+        self.stats = {
+            'workers': max_workers,
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'queued': 0,
+            'busy': 0,
+            'peak_queued': 0,
+            'peak_busy': 0,
+            'saturated': 0,
+            'total_wait': 0.0,
+            'max_wait': 0.0,
+        }
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self.lock:
+            self.stats['submitted'] += 1
+            self.stats['queued'] += 1
+            self.stats['peak_queued'] = max(self.stats['peak_queued'], self.stats['queued'])
+        future = super().submit(self.run, time.monotonic(), fn, *args, **kwargs)
+        future.add_done_callback(self.cancelled)
+        return future
+
+    def cancelled(self, future):
+        # a call cancelled before a worker picked it up never ran
+        if future.cancelled():
+            with self.lock:
+                self.stats['queued'] -= 1
+
+    def run(self, submitted, fn, *args, **kwargs):
+        now = time.monotonic()
+        wait = now - submitted
+        with self.lock:
+            self.stats['queued'] -= 1
+            self.stats['busy'] += 1
+            self.stats['peak_busy'] = max(self.stats['peak_busy'], self.stats['busy'])
+            self.stats['total_wait'] += wait
+            self.stats['max_wait'] = max(self.stats['max_wait'], wait)
+            warn = wait > self.warn_after
+            if warn:
+                self.stats['saturated'] += 1
+                warn = now - self.warned_at > WARNING_INTERVAL
+                if warn:
+                    self.warned_at = now
+        if warn:
+            logger.warning(
+                'Chat %s DB pool saturated, a call waited %.3fs for a worker, stats %s',
+                self.name, wait, self.snapshot(),
+            )
+        failed = True
+        try:
+            result = fn(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            with self.lock:
+                self.stats['busy'] -= 1
+                self.stats['completed'] += 1
+                self.stats['failed'] += failed
+
+    def snapshot(self):
+        '''A copy of the counters with the mean wait'''
+        with self.lock:
+            stats = dict(self.stats)
+        started = stats['submitted'] - stats['queued']
+        stats['mean_wait'] = stats['total_wait'] / started if started else 0.0
+        return stats
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+def get_db_executor(name):
+    '''Process wide pool by name, created on first use'''
+    with _executors_lock:
+        executor = _executors.get(name)
+        if executor is None:
+            workers = chat_config(POOL_SIZES[name])
+            if name == 'messages' and connection.vendor == 'sqlite':
+                # SQLite takes one writer at a time, concurrent ones only fail with "database is locked"
+                workers = 1
+            executor = _executors[name] = MeteredExecutor(name, workers, chat_config('DB_SATURATION_WARNING'))
+        return executor
+
+def db_executor_stats():
+    '''Counters of every pool created so far, by name'''
+    with _executors_lock:
+        executors = dict(_executors)
+    return {name: executor.snapshot() for name, executor in executors.items()}
+
+
+class ChatDatabaseSyncToAsync(DatabaseSyncToAsync):
+    '''database_sync_to_async on one of the chat pools rather than the shared sync thread'''
+
+    def __init__(self, func, pool='messages'):
+        if pool not in POOL_SIZES:
+            raise ValueError(f'Unknown chat DB pool {pool!r}')
+        super().__init__(func, thread_sensitive=False)
+        self.pool = pool
+
+    async def __call__(self, *args, **kwargs):
+        # resolved per call so the pool is sized from settings at first use, not import
+        self._executor = get_db_executor(self.pool)
+        return await super().__call__(*args, **kwargs)
+
+
+def chat_db_to_async(func=None, pool='messages'):
+    '''Decorator and wrapper like database_sync_to_async, taking the pool to run on'''
+    if func is None:
+        return lambda func: ChatDatabaseSyncToAsync(func, pool)
+    return ChatDatabaseSyncToAsync(func, pool)
@@ -0,0 +1,138 @@
+'''Per-process fan-out for public channel rooms
+
+Which rooms use it: public channels, rooms with room_type 'channel' and
+is_private unset, while FANOUT_CHANNELS is on. Direct, group and private
+channel rooms always add each socket to chat_<room_id> themselves.
+
+Public channels can have tens of thousands of sockets subscribed. With every
+socket a member of chat_<room_id> each event is queued once per socket and
+every socket's consumer dispatches it separately, with a thread hop to close
+old database connections. In fan-out mode a process instead adds one channel
+of its own to the room's group when the first of its sockets subscribes, and
+hands everything arriving on it to its local sockets in memory.
+
+Getting events between processes stays the channel layer's job. With
+HybridChannelLayer, the default, a group_send is already published once per
+process however many of its sockets are members, so there the hub only
+saves the per-socket queueing and dispatch. With RedisChannelLayer it also
+turns one push per socket into one per process.
+
+Senders don't change, they keep sending to chat_<room_id>.
+'''
+import asyncio
+import logging
+
+from channels.consumer import get_handler_name
+from channels.layers import get_channel_layer
+
+from .utils import chat_config
+
+logger = logging.getLogger(__name__)
+
+
+def uses_fanout(room):
+    '''Whether a room, as a dict of its room_type and is_private, is delivered through the hub'''
+    return chat_config('FANOUT_CHANNELS') and room['room_type'] == 'channel' and not room['is_private']
+
+
+class FanoutHub:
+    '''A process's subscriptions to fan-out rooms and their local sockets
+
+    Each subscribed room has a layer channel in the room's group and a
+    reader task calling the group handler of every local socket, the same
+    handler the layer would have called for a socket in the group. The
+    handlers only queue the frame on the socket's outbound buffer, so one
+    slow client doesn't hold up the others, and a handler that fails is
+    logged and skipped. Group membership is refreshed every
+    FANOUT_REFRESH_INTERVAL seconds so layers expiring groups don't drop
+    long lived subscriptions.
+    '''
+
+    def __init__(self, channel_layer=None, refresh_interval=None):
+        self.channel_layer = channel_layer or get_channel_layer()
+        self.refresh_interval = refresh_interval or chat_config('FANOUT_REFRESH_INTERVAL')
+        # room_id -> set of local consumers
+        self.members = {}
+        # room_id -> (channel name, reader task)
+        self.channels = {}
+        self.lock = asyncio.Lock()
+        self.timer = None
+        self.refreshing = set()
+        self.stats = {'received': 0, 'delivered': 0, 'failed': 0}
+
+    async def subscribe(self, room_id, consumer):
+        # the lock keeps a concurrent last unsubscribe from discarding a fresh channel
+        async with self.lock:
+            members = self.members.setdefault(room_id, set())
+            members.add(consumer)
+            if room_id in self.channels:
+                return
+            channel = await self.channel_layer.new_channel('fanout')
+            await self.channel_layer.group_add(f'chat_{room_id}', channel)
+            self.channels[room_id] = (channel, asyncio.ensure_future(self.read(room_id, channel)))
+            self.ensure_timer()
+
+    async def unsubscribe(self, room_id, consumer):
+        async with self.lock:
+            members = self.members.get(room_id)
+            if members is None:
+                return
+            members.discard(consumer)
+            if members:
+                return
+            del self.members[room_id]
+            channel, reader = self.channels.pop(room_id)
+            reader.cancel()
+            await self.channel_layer.group_discard(f'chat_{room_id}', channel)
+
+    async def read(self, room_id, channel):
+        while True:
+            try:
+                event = await self.channel_layer.receive(channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # a lost layer connection, keep the subscription and retry
+                logger.exception('Fan-out channel of room %s failed to receive', room_id)
+                await asyncio.sleep(1)
+                continue
+            self.stats['received'] += 1
+            await self.deliver(room_id, event)
+
+    async def deliver(self, room_id, event):
+        # called directly rather than through dispatch(), which costs a thread hop per socket
+        handler_name = get_handler_name(event)
+        for consumer in list(self.members.get(room_id, ())):
+            try:
+                await getattr(consumer, handler_name)(event)
+                self.stats['delivered'] += 1
+            except Exception:
+                self.stats['failed'] += 1
+                logger.exception('Fan-out delivery of %s to a socket in room %s failed', handler_name, room_id)
+
+    def ensure_timer(self):
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.refresh_interval, self.tick)
+
+    def tick(self):
+        self.timer = None
+        if not self.channels:
+            return
+        task = asyncio.ensure_future(self.refresh())
+        self.refreshing.add(task)
+        task.add_done_callback(self.refreshing.discard)
+        self.ensure_timer()
+
+    async def refresh(self):
+        for room_id, (channel, _) in list(self.channels.items()):
+            await self.channel_layer.group_add(f'chat_{room_id}', channel)
+
+
+_fanout_hub = None
+
+def get_fanout_hub():
+    '''Process wide hub, created lazily on the running event loop'''
+    global _fanout_hub
+    if _fanout_hub is None:
+        _fanout_hub = FanoutHub()
+    return _fanout_hub
@@ -0,0 +1,111 @@
+import json
+import threading
+import uuid
+
+from collections import OrderedDict
+from datetime import datetime
+
+from .utils import chat_config
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# websocket subprotocol of the compact binary encoding
+MSGPACK_SUBPROTOCOL = 'chat.msgpack'
+# msgpack extension type carrying a uuid as its 16 raw bytes
+UUID_EXT_TYPE = 1
+# binary encodings of group event frames kept per process
+BINARY_CACHE_SIZE = 256
+
+
+def json_default(value):
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def msgpack_default(value):
+    # datetimes are packed natively as msgpack timestamps (datetime=True)
+    if isinstance(value, uuid.UUID):
+        return msgpack.ExtType(UUID_EXT_TYPE, value.bytes)
+    raise TypeError(f'{type(value).__name__} is not msgpack serializable')
+
+def msgpack_ext_hook(code, data):
+    if code == UUID_EXT_TYPE:
+        return uuid.UUID(bytes=data)
+    return msgpack.ExtType(code, data)
+
+
+def binary_frames_enabled():
+    return msgpack is not None and chat_config('BINARY_FRAMES')
+
+def encode_frame(frame_type, **fields):
+    '''Serializing an outgoing websocket frame once, ready to be forwarded as is'''
+    return json.dumps({'type': frame_type, **fields}, separators=(',', ':'), default=json_default)
+
+def encode_binary_frame(frame_type, **fields):
+    '''MessagePack version of encode_frame with uuids and timestamps packed as extension types'''
+    return msgpack.packb({'type': frame_type, **fields}, default=msgpack_default, datetime=True)
+
+def decode_binary_frame(data):
+    return msgpack.unpackb(data, ext_hook=msgpack_ext_hook, timestamp=3)
+
+def typed_paths(value, path=()):
+    '''[path, kind] of the uuids and datetimes in value, which JSON turns into strings'''
+    if isinstance(value, uuid.UUID):
+        yield [list(path), 'uuid']
+    elif isinstance(value, datetime):
+        yield [list(path), 'datetime']
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield from typed_paths(item, (*path, key))
+    elif isinstance(value, (list, tuple)):
+        for index, item in enumerate(value):
+            yield from typed_paths(item, (*path, index))
+
+def frame_event(handler, frame_type, **fields):
+    '''Channel layer event carrying a pre-encoded frame for the given consumer handler
+
+    Only the JSON text travels, with where its uuids and datetimes were when
+    msgpack clients are enabled, so members on the JSON protocol forward it
+    as is and binary_event_frame makes the msgpack copy where one is needed.
+    '''
+    event = {
+        'type': handler,
+        'text': encode_frame(frame_type, **fields),
+    }
+    if binary_frames_enabled():
+        typed = list(typed_paths(fields))
+        if typed:
+            event['typed'] = typed
+    return event
+
+_binary_frames = OrderedDict()
+_binary_frames_lock = threading.Lock()
+
+def binary_event_frame(event):
+    '''The msgpack encoding of a frame_event's frame, made once per process for all its members'''
+    text = event['text']
+    with _binary_frames_lock:
+        frame = _binary_frames.get(text)
+        if frame is not None:
+            _binary_frames.move_to_end(text)
+            return frame
+
+    fields = json.loads(text)
+    for path, kind in event.get('typed', ()):
+        *parents, last = path
+        parent = fields
+        for key in parents:
+            parent = parent[key]
+        parent[last] = uuid.UUID(parent[last]) if kind == 'uuid' else datetime.fromisoformat(parent[last])
+    frame = msgpack.packb(fields, default=msgpack_default, datetime=True)
+
+    with _binary_frames_lock:
+        _binary_frames[text] = frame
+        if len(_binary_frames) > BINARY_CACHE_SIZE:
+            _binary_frames.popitem(last=False)
+    return frame
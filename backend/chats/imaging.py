@@ -0,0 +1,123 @@
+'''Image work run in the media process pool
+
+Only depends on Pillow so pool workers can start without Django. Paths
+are absolute filesystem paths, results are plain dicts.
+'''
+import hashlib
+import io
+import math
+import os
+
+from PIL import Image, ImageOps
+
+BASE83 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+
+
+def make_preview(source, target, max_size, quality=80):
+    '''Writing a WebP preview of source no larger than max_size on either side
+
+    Returns the original and preview dimensions plus a BlurHash of the
+    image, or None when source isn't an image Pillow can read.
+    '''
+    try:
+        with Image.open(source) as image:
+            image = ImageOps.exif_transpose(image)
+            width, height = image.size
+            preview = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+    except (OSError, Image.DecompressionBombError):
+        return None
+
+    preview.thumbnail((max_size, max_size))
+    preview.save(target, 'WEBP', quality=quality, method=4)
+    return {
+        'width': width,
+        'height': height,
+        'preview_width': preview.width,
+        'preview_height': preview.height,
+        'blurhash': blurhash(preview),
+    }
+
+
+def make_renditions(source, folder, sizes, quality=80):
+    '''Writing square WebP and JPEG copies of source at each size into folder
+
+    Files are named after a hash of their bytes so their URLs can be cached
+    forever. Returns {size: {'webp': filename, 'jpeg': filename}}.
+    '''
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image).convert('RGBA')
+    # JPEG has no alpha, transparent avatars go on white
+    flat = Image.new('RGB', image.size, 'white')
+    flat.paste(image, mask=image)
+
+    os.makedirs(folder, exist_ok=True)
+    renditions = {}
+    for size in sizes:
+        renditions[size] = {}
+        for key, copy, format, extension in (('webp', image, 'WEBP', 'webp'), ('jpeg', flat, 'JPEG', 'jpg')):
+            buffer = io.BytesIO()
+            ImageOps.fit(copy, (size, size), Image.LANCZOS).save(buffer, format, quality=quality)
+            data = buffer.getvalue()
+            name = f'{size}-{hashlib.sha256(data).hexdigest()[:16]}.{extension}'
+            path = os.path.join(folder, name)
+            if not os.path.exists(path):
+                with open(path, 'wb') as file:
+                    file.write(data)
+            renditions[size][key] = name
+    return renditions
+
+
+def encode83(value, length):
+    return ''.join(BASE83[(value // 83 ** (length - i - 1)) % 83] for i in range(length))
+
+def srgb_to_linear(value):
+    value /= 255
+    return value / 12.92 if value <= 0.04045 else ((value + 0.055) / 1.055) ** 2.4
+
+def linear_to_srgb(value):
+    value = max(0.0, min(1.0, value))
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+def blurhash(image, components_x=4, components_y=3):
+    '''BlurHash placeholder string of image, computed on a 32px copy'''
+    small = image.convert('RGB')
+    small.thumbnail((32, 32))
+    width, height = small.size
+    pixels = [tuple(srgb_to_linear(channel) for channel in pixel) for pixel in small.getdata()]
+
+    factors = []
+    for j in range(components_y):
+        for i in range(components_x):
+            normalisation = 1 if i == 0 and j == 0 else 2
+            r = g = b = 0.0
+            for y in range(height):
+                cos_y = math.cos(math.pi * j * y / height)
+                for x in range(width):
+                    basis = normalisation * math.cos(math.pi * i * x / width) * cos_y
+                    pr, pg, pb = pixels[y * width + x]
+                    r += basis * pr
+                    g += basis * pg
+                    b += basis * pb
+            scale = 1 / (width * height)
+            factors.append((r * scale, g * scale, b * scale))
+
+    dc, ac = factors[0], factors[1:]
+    result = encode83(components_x - 1 + (components_y - 1) * 9, 1)
+    if ac:
+        quantised = max(0, min(82, int(max(abs(v) for factor in ac for v in factor) * 166 - 0.5)))
+        max_value = (quantised + 1) / 166
+        result += encode83(quantised, 1)
+    else:
+        max_value = 1
+        result += encode83(0, 1)
+
+    result += encode83((linear_to_srgb(dc[0]) << 16) + (linear_to_srgb(dc[1]) << 8) + linear_to_srgb(dc[2]), 4)
+    for factor in ac:
+        r, g, b = (
+            max(0, min(18, int(math.copysign(abs(v / max_value) ** 0.5, v) * 9 + 9.5)))
+            for v in factor
+        )
+        result += encode83(r * 19 * 19 + g * 19 + b, 2)
+    return result
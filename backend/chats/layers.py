@@ -0,0 +1,439 @@
+'''Channel layer delivering in process when it can, over Redis pub/sub when it must
+
+HybridChannelLayer is a drop-in for channels_redis' RedisChannelLayer
+taking the same hosts/prefix/capacity/group_expiry options. Each event loop
+using it gets a HybridLoopLayer with an id of its own, and specific
+channels are named after the loop layer that created them, so sends
+between sockets of one loop go straight onto an in-memory queue. Sends to
+a channel of another loop, in this process or another one, are published
+to that loop layer's inbox topic. A message for a local channel that is
+gone is dropped, as an expired one would be in Redis.
+
+Group messages are delivered to the local members in memory, then
+published once on the group's topic if any other loop layer has members.
+That is known from a sorted set per group holding the loop layers with
+members, cached for membership_cache seconds and refreshed early when a
+loop layer announces its first member on the joins topic. A loop layer
+joining a group may miss messages sent while the announcement is in
+flight, the same window any pub/sub subscription has, reconnecting clients
+catch up by seq.
+
+Any channel can be added to a group. Adding another loop layer's channel
+is forwarded to that layer's inbox and takes effect once the owner read it,
+a general channel (one without "!") is kept in the group's sorted set and
+group messages are published to it.
+
+Unlike RedisChannelLayer nothing is queued in Redis, a process that is
+down misses what is published meanwhile, and a general channel is a topic
+every receiver of it gets messages on.
+'''
+import asyncio
+import functools
+import logging
+import time
+import uuid
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+from channels_redis.serializers import registry
+from channels_redis.utils import _close_redis, _consistent_hash, _wrap_close, create_pool, decode_hosts
+from redis import asyncio as aioredis
+
+logger = logging.getLogger(__name__)
+
+LAYER_ID_LENGTH = 12
+# sorted set entries of general channels, next to the ids of loop layers with members
+GENERAL_MEMBER = 'channel:'
+# remote membership entries kept before expired ones are dropped
+MEMBERSHIP_CACHE_SIZE = 10000
+
+
+async def _async_proxy(obj, name, *args, **kwargs):
+    # a module level function, see https://bugs.python.org/issue38364
+    return await getattr(obj._get_layer(), name)(*args, **kwargs)
+
+
+class HybridChannelLayer:
+    '''Per event loop front of HybridLoopLayer, as channels_redis does for its pub/sub layer'''
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, *args, symmetric_encryption_keys=None, serializer_format='msgpack', **kwargs):
+        self._args = args
+        self._kwargs = kwargs
+        self._layers = {}
+        self._serializer = registry.get_serializer(
+            serializer_format, symmetric_encryption_keys=symmetric_encryption_keys,
+        )
+
+    def __getattr__(self, name):
+        if name in ('new_channel', 'send', 'receive', 'group_add', 'group_discard', 'group_send', 'flush'):
+            return functools.partial(_async_proxy, self, name)
+        return getattr(self._get_layer(), name)
+
+    def serialize(self, message):
+        return self._serializer.serialize(message)
+
+    def deserialize(self, message):
+        return self._serializer.deserialize(message)
+
+    def _get_layer(self):
+        loop = asyncio.get_running_loop()
+        try:
+            return self._layers[loop]
+        except KeyError:
+            layer = self._layers[loop] = HybridLoopLayer(*self._args, **self._kwargs, channel_layer=self)
+            _wrap_close(self, loop)
+            return layer
+
+
+class HybridLoopLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(
+        self, hosts=None, prefix='asgi', expiry=60, group_expiry=86400, capacity=100,
+        channel_capacity=None, membership_cache=5.0, channel_layer=None, **kwargs,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.prefix = prefix
+        self.group_expiry = group_expiry
+        self.membership_cache = membership_cache
+        self.channel_layer = channel_layer
+        # the id channels of this loop are named after, other loops of the process have their own
+        self.layer_id = uuid.uuid4().hex[:LAYER_ID_LENGTH]
+
+        # queues of this loop's channels, and the local members of each group
+        self.channels = {}
+        self.groups = {}
+        self.channel_groups = {}
+        # group -> (checked at, whether other loop layers have members, general channel members)
+        self.remote = {}
+        # group -> when this loop layer last registered as a member
+        self.registered = {}
+        self.stats = {'local': 0, 'published': 0, 'received': 0, 'skipped_publish': 0, 'dropped': 0}
+
+        self.shards = [Shard(host, self.receive_topic) for host in decode_hosts(hosts)]
+        self.started = False
+        # group changes forwarded by other loop layers, kept referenced until done
+        self.pending = set()
+
+    # topics and keys
+
+    def inbox_topic(self, layer_id):
+        return f'{self.prefix}:hybrid:layer:{layer_id}'
+
+    def group_topic(self, group):
+        return f'{self.prefix}:hybrid:group:{group}'
+
+    def channel_topic(self, channel):
+        return f'{self.prefix}:hybrid:channel:{channel}'
+
+    def members_key(self, group):
+        return f'{self.prefix}:hybrid:members:{group}'
+
+    @property
+    def joins_topic(self):
+        return f'{self.prefix}:hybrid:joins'
+
+    def shard(self, name):
+        return self.shards[_consistent_hash(name, len(self.shards))]
+
+    def owner(self, channel):
+        '''Loop layer id of a specific channel, None for general channels'''
+        if '!' not in channel:
+            return None
+        return channel.split('!', 1)[0][-LAYER_ID_LENGTH:]
+
+    async def start(self):
+        # the inbox for sends from other loop layers, the joins topic for membership news
+        if not self.started:
+            self.started = True
+            await self.shard(self.inbox_topic(self.layer_id)).subscribe(self.inbox_topic(self.layer_id))
+            await self.shard(self.joins_topic).subscribe(self.joins_topic)
+
+    def queue(self, channel):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return queue
+
+    def put(self, channel, message):
+        queue = self.channels.get(channel)
+        if queue is None:
+            # the channel's receiver is gone, nothing would ever drain a new queue
+            self.stats['dropped'] += 1
+            return
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            raise ChannelFull(channel)
+
+    # channel layer API
+
+    async def new_channel(self, prefix='specific'):
+        await self.start()
+        channel = f'{prefix}.{self.layer_id}!{uuid.uuid4().hex}'
+        self.queue(channel)
+        return channel
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        owner = self.owner(channel)
+        if owner == self.layer_id:
+            self.put(channel, dict(message))
+            self.stats['local'] += 1
+            return
+        await self.publish_to_channel(channel, {'channel': channel, 'message': message})
+
+    async def publish_to_channel(self, channel, envelope):
+        # a specific channel's owner reads its inbox, a general channel is a topic of its own
+        owner = self.owner(channel)
+        topic = self.channel_topic(channel) if owner is None else self.inbox_topic(owner)
+        await self.shard(topic).publish(topic, self.channel_layer.serialize({**envelope, 'origin': self.layer_id}))
+        self.stats['published'] += 1
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        await self.start()
+        if self.owner(channel) is None:
+            # general channels are topics every receiver subscribes to
+            await self.shard(self.channel_topic(channel)).subscribe(self.channel_topic(channel))
+        queue = self.queue(channel)
+        try:
+            return await queue.get()
+        except (asyncio.CancelledError, asyncio.TimeoutError, GeneratorExit):
+            # a cancelled receive means its consumer is exiting, as channels_redis assumes
+            await self.drop_channel(channel)
+            raise
+
+    async def drop_channel(self, channel):
+        self.channels.pop(channel, None)
+        for group in list(self.channel_groups.get(channel, ())):
+            try:
+                await self.group_discard(group, channel)
+            except Exception:
+                logger.exception('Could not leave %s while dropping a channel', group)
+        if self.owner(channel) is None:
+            await self.shard(self.channel_topic(channel)).unsubscribe(self.channel_topic(channel))
+
+    # groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        owner = self.owner(channel)
+        if owner is None:
+            await self.register(group, GENERAL_MEMBER + channel)
+            return
+        if owner != self.layer_id:
+            # only the owner delivers to the channel, it joins on our behalf
+            await self.publish_to_channel(channel, {'channel': channel, 'group_add': group})
+            return
+        await self.start()
+        members = self.groups.setdefault(group, set())
+        members.add(channel)
+        self.channel_groups.setdefault(channel, set()).add(group)
+
+        now = time.time()
+        if len(members) == 1:
+            await self.shard(self.group_topic(group)).subscribe(self.group_topic(group))
+        if now - self.registered.get(group, 0) > self.group_expiry / 2:
+            first = group not in self.registered
+            self.registered[group] = now
+            await self.register(group, self.layer_id, announce=first)
+
+    async def register(self, group, member, announce=True):
+        '''Adding a member to the group's sorted set, telling others so they publish to it'''
+        shard = self.shard(self.members_key(group))
+        await shard.redis().zadd(self.members_key(group), {member: time.time() + self.group_expiry})
+        await shard.redis().expire(self.members_key(group), int(self.group_expiry))
+        if announce:
+            await self.shard(self.joins_topic).publish(
+                self.joins_topic, self.channel_layer.serialize({'group': group, 'origin': self.layer_id})
+            )
+            self.remote.pop(group, None)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        owner = self.owner(channel)
+        if owner is None:
+            await self.shard(self.members_key(group)).redis().zrem(self.members_key(group), GENERAL_MEMBER + channel)
+            self.remote.pop(group, None)
+            return
+        if owner != self.layer_id:
+            await self.publish_to_channel(channel, {'channel': channel, 'group_discard': group})
+            return
+        self.channel_groups.get(channel, set()).discard(group)
+        if not self.channel_groups.get(channel, True):
+            del self.channel_groups[channel]
+        members = self.groups.get(group)
+        if not members or channel not in members:
+            return
+        members.discard(channel)
+        if members:
+            return
+        del self.groups[group]
+        self.registered.pop(group, None)
+        await self.shard(self.group_topic(group)).unsubscribe(self.group_topic(group))
+        await self.shard(self.members_key(group)).redis().zrem(self.members_key(group), self.layer_id)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_group_name(group)
+        self.deliver_local(group, message)
+        remote, general = await self.remote_members(group)
+        for channel in general:
+            await self.publish_to_channel(channel, {'channel': channel, 'message': message})
+        if not remote:
+            self.stats['skipped_publish'] += 1
+            return
+        await self.shard(self.group_topic(group)).publish(self.group_topic(group), self.channel_layer.serialize(
+            {'group': group, 'origin': self.layer_id, 'message': message}
+        ))
+        self.stats['published'] += 1
+
+    def deliver_local(self, group, message):
+        # a shallow copy per member, handlers read events without mutating nested values
+        for channel in list(self.groups.get(group, ())):
+            try:
+                self.put(channel, dict(message))
+                self.stats['local'] += 1
+            except ChannelFull:
+                # as with RedisChannelLayer, a full member misses group messages
+                pass
+
+    async def remote_members(self, group):
+        '''Whether other loop layers have members of the group, and its general channel members'''
+        now = time.time()
+        checked_at, remote, general = self.remote.get(group, (0, False, ()))
+        if now - checked_at < self.membership_cache:
+            return remote, general
+        members = [
+            member.decode() for member in
+            await self.shard(self.members_key(group)).redis().zrangebyscore(self.members_key(group), now, '+inf')
+        ]
+        general = tuple(member[len(GENERAL_MEMBER):] for member in members if member.startswith(GENERAL_MEMBER))
+        remote = any(member != self.layer_id and not member.startswith(GENERAL_MEMBER) for member in members)
+        if len(self.remote) > MEMBERSHIP_CACHE_SIZE:
+            self.remote = {
+                key: value for key, value in self.remote.items() if now - value[0] < self.membership_cache
+            }
+        self.remote[group] = (now, remote, general)
+        return remote, general
+
+    # messages from Redis
+
+    def receive_topic(self, topic, data):
+        envelope = self.channel_layer.deserialize(data)
+        if envelope.get('origin') == self.layer_id:
+            return
+        self.stats['received'] += 1
+        if topic == self.joins_topic:
+            # membership of the group changed elsewhere, look it up again on the next send
+            self.remote.pop(envelope['group'], None)
+        elif 'group' in envelope:
+            self.deliver_local(envelope['group'], envelope['message'])
+        elif 'group_add' in envelope or 'group_discard' in envelope:
+            self.forwarded(envelope)
+        else:
+            try:
+                self.put(envelope['channel'], envelope['message'])
+            except ChannelFull:
+                logger.warning('Dropped a message for full channel %s', envelope['channel'])
+
+    def forwarded(self, envelope):
+        # another loop layer added or discarded one of our channels
+        if 'group_add' in envelope:
+            if envelope['channel'] not in self.channels:
+                return
+            change = self.group_add(envelope['group_add'], envelope['channel'])
+        else:
+            change = self.group_discard(envelope['group_discard'], envelope['channel'])
+        task = asyncio.ensure_future(change)
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    # flush extension
+
+    async def flush(self):
+        for group in list(self.registered):
+            try:
+                await self.shard(self.members_key(group)).redis().zrem(self.members_key(group), self.layer_id)
+            except Exception:
+                logger.exception('Could not leave %s while flushing', group)
+        for shard in self.shards:
+            await shard.flush()
+        self.channels, self.groups, self.channel_groups = {}, {}, {}
+        self.remote, self.registered = {}, {}
+        self.started = False
+
+    async def close(self):
+        await self.flush()
+
+
+class Shard:
+    '''One Redis host, its pub/sub subscriptions and the task reading them'''
+
+    def __init__(self, host, on_message):
+        self.host = host
+        self.on_message = on_message
+        self.connection = None
+        self.pubsub = None
+        self.reader = None
+        self.topics = set()
+        self.lock = asyncio.Lock()
+
+    def redis(self):
+        if self.connection is None:
+            self.connection = aioredis.Redis(connection_pool=create_pool(self.host))
+        return self.connection
+
+    async def publish(self, topic, data):
+        await self.redis().publish(topic, data)
+
+    async def subscribe(self, topic):
+        async with self.lock:
+            if topic in self.topics:
+                return
+            if self.pubsub is None:
+                self.pubsub = self.redis().pubsub()
+            await self.pubsub.subscribe(topic)
+            self.topics.add(topic)
+            if self.reader is None:
+                self.reader = asyncio.ensure_future(self.read())
+
+    async def unsubscribe(self, topic):
+        async with self.lock:
+            if topic in self.topics:
+                self.topics.discard(topic)
+                await self.pubsub.unsubscribe(topic)
+
+    async def read(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is not None:
+                    topic = message['channel']
+                    self.on_message(topic.decode() if isinstance(topic, bytes) else topic, message['data'])
+            except (asyncio.CancelledError, GeneratorExit):
+                raise
+            except Exception:
+                logger.exception('Hybrid channel layer failed to read from Redis')
+                await asyncio.sleep(1)
+
+    async def flush(self):
+        async with self.lock:
+            if self.reader is not None:
+                self.reader.cancel()
+                try:
+                    await self.reader
+                except asyncio.CancelledError:
+                    pass
+                self.reader = None
+            if self.connection is not None:
+                await _close_redis(self.connection)
+            self.connection = self.pubsub = None
+            self.topics = set()
@@ -0,0 +1,46 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chats.archive import archive_room
+from chats.models import Message
+from chats.utils import chat_config
+
+
+class Command(BaseCommand):
+    help = 'Moves messages older than ARCHIVE_AFTER_DAYS into compressed per-room archive segments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Archive messages older than this many days (default ARCHIVE_AFTER_DAYS)')
+        parser.add_argument('--segment-size', type=int, default=None,
+                            help='Messages per segment (default ARCHIVE_SEGMENT_SIZE)')
+        parser.add_argument('--room', action='append', default=[],
+                            help='Only archive this room, may be repeated')
+        parser.add_argument('--max-segments', type=int, default=None,
+                            help='Stop after writing this many segments, for incremental runs')
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else chat_config('ARCHIVE_AFTER_DAYS')
+        segment_size = options['segment_size'] or chat_config('ARCHIVE_SEGMENT_SIZE')
+        cutoff = timezone.now() - timedelta(days=days)
+
+        rooms = Message.objects.filter(created_at__lt=cutoff)
+        if options['room']:
+            rooms = rooms.filter(room_id__in=options['room'])
+        room_ids = list(rooms.values_list('room_id', flat=True).distinct())
+
+        segments = archived = 0
+        for room_id in room_ids:
+            # each segment commits on its own, an interrupted run resumes where it stopped
+            while options['max_segments'] is None or segments < options['max_segments']:
+                count = archive_room(room_id, cutoff, segment_size)
+                if not count:
+                    break
+                segments += 1
+                archived += count
+                if count < segment_size:
+                    break
+
+        self.stdout.write(f'{archived} messages archived into {segments} segments across {len(room_ids)} rooms')
@@ -0,0 +1,56 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from chats.frames import encode_binary_frame, encode_frame, msgpack
+
+
+def sample_payload(content_length):
+    return {
+        'id': uuid.uuid4(),
+        'content': 'x' * content_length,
+        'sender': {
+            'id': uuid.uuid4(),
+            'username': 'bench',
+            'avatar': '/media/avatars/bench.png',
+        },
+        'created_at': timezone.now(),
+        'message_type': 'text',
+    }
+
+
+class Command(BaseCommand):
+    help = 'Compares frame size and encode speed of the JSON and MessagePack chat encodings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lengths', default='0,20,200,2000',
+                            help='Comma separated message content lengths')
+        parser.add_argument('--iterations', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        if msgpack is None:
+            raise CommandError('msgpack is not installed')
+
+        iterations = options['iterations']
+        self.stdout.write(
+            f"{'content':>8} {'json (B)':>9} {'msgpack (B)':>12} {'json (us)':>10} {'msgpack (us)':>13}"
+        )
+        for length in [int(length) for length in options['lengths'].split(',')]:
+            payload = sample_payload(length)
+            json_size = len(encode_frame('chat_message', room_id=str(uuid.uuid4()), message=payload).encode())
+            binary_size = len(encode_binary_frame('chat_message', room_id=str(uuid.uuid4()), message=payload))
+            json_time = self.time(encode_frame, payload, iterations)
+            binary_time = self.time(encode_binary_frame, payload, iterations)
+            self.stdout.write(
+                f'{length:>8} {json_size:>9} {binary_size:>12} '
+                f'{json_time * 1e6:>10.2f} {binary_time * 1e6:>13.2f}'
+            )
+
+    def time(self, encoder, payload, iterations):
+        '''Seconds per encoded chat_message frame'''
+        started = time.perf_counter()
+        for _ in range(iterations):
+            encoder('chat_message', message=payload, sender_username='bench')
+        return (time.perf_counter() - started) / iterations
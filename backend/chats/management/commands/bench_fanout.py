@@ -0,0 +1,73 @@
+import copy
+import json
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chats.frames import frame_event
+
+
+def sample_message():
+    return {
+        'id': str(uuid.uuid4()),
+        'content': 'benchmark message ' * 4,
+        'sender': {
+            'id': str(uuid.uuid4()),
+            'username': 'bench',
+            'avatar': '/media/avatars/bench.png',
+        },
+        'created_at': timezone.now().isoformat(),
+        'message_type': 'text',
+    }
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks per-message CPU of room fan-out, per-member json.dumps against encode-once frames'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,50,100,500,1000',
+                            help='Comma separated room sizes')
+        parser.add_argument('--messages', type=int, default=50,
+                            help='Messages sent per room size')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        count = options['messages']
+
+        self.stdout.write(f"{'members':>8} {'per-member (ms)':>16} {'encode-once (ms)':>17} {'speedup':>8}")
+        for size in sizes:
+            legacy = self.run(size, count, encode_once=False)
+            encoded = self.run(size, count, encode_once=True)
+            self.stdout.write(
+                f'{size:>8} {legacy * 1000:>16.3f} {encoded * 1000:>17.3f} {legacy / encoded:>7.2f}x'
+            )
+
+    def run(self, size, count, encode_once):
+        '''CPU seconds per message for building the event and every member forwarding it
+
+        Delivery to each member is modelled as a deep copy of the event, which
+        is what InMemoryChannelLayer does per channel, so the numbers isolate
+        the serialization work rather than layer bookkeeping.
+        '''
+        started = time.process_time()
+        for _ in range(count):
+            message = sample_message()
+            if encode_once:
+                event = frame_event('chat_message', 'chat_message',
+                                    message=message, sender_username='bench')
+            else:
+                event = {'type': 'chat_message', 'message': message, 'sender_username': 'bench'}
+
+            for _ in range(size):
+                delivered = copy.deepcopy(event)
+                if encode_once:
+                    text = delivered['text']
+                else:
+                    text = json.dumps({
+                        'type': 'chat_message',
+                        'message': delivered['message'],
+                        'sender_username': delivered['sender_username'],
+                    })
+        return (time.process_time() - started) / count
@@ -0,0 +1,90 @@
+import asyncio
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from channels.layers import InMemoryChannelLayer
+from channels_redis.core import RedisChannelLayer
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from chats.frames import frame_event
+from chats.layers import HybridChannelLayer
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks channel layers on sockets of one process, point to point sends '
+        'and group sends, HybridChannelLayer against RedisChannelLayer and InMemoryChannelLayer'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', default='1,10,100,500',
+                            help='Comma separated group sizes')
+        parser.add_argument('--messages', type=int, default=200,
+                            help='Messages sent per measurement')
+        parser.add_argument('--layers', default='memory,redis,hybrid',
+                            help='Comma separated layers to run, of memory, redis and hybrid')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['members'].split(',')]
+        asyncio.run(self.run_all(sizes, options))
+
+    def make_layer(self, name):
+        # the Redis layers use the hosts of the configured default layer
+        config = settings.CHANNEL_LAYERS.get('default', {}).get('CONFIG', {})
+        hosts = config.get('hosts', [('127.0.0.1', 6379)])
+        prefix = f'bench{uuid.uuid4().hex[:8]}'
+        if name == 'memory':
+            return InMemoryChannelLayer(capacity=1000)
+        if name == 'redis':
+            return RedisChannelLayer(hosts=hosts, prefix=prefix, capacity=1000)
+        return HybridChannelLayer(hosts=hosts, prefix=prefix, capacity=1000)
+
+    async def run_all(self, sizes, options):
+        count = options['messages']
+        self.stdout.write(f"{'layer':>8} {'test':>6} {'members':>8} {'per message (ms)':>17} {'msg/s':>10}")
+        for name in options['layers'].split(','):
+            layer = self.make_layer(name)
+            try:
+                elapsed = await self.send_round_trip(layer, count)
+                self.report(name, 'send', 1, elapsed, count)
+                for size in sizes:
+                    elapsed = await self.group_round_trip(layer, size, count)
+                    self.report(name, 'group', size, elapsed, count)
+                await layer.flush()
+            except (OSError, RedisConnectionError) as e:
+                self.stdout.write(f'{name:>8} unavailable: {e}')
+
+    def report(self, name, test, size, elapsed, count):
+        self.stdout.write(
+            f'{name:>8} {test:>6} {size:>8} {elapsed / count * 1000:>17.3f} {count / elapsed:>10.0f}'
+        )
+
+    async def send_round_trip(self, layer, count):
+        '''Seconds for count sends from one local socket to another, each received before the next'''
+        channel = await layer.new_channel()
+        event = frame_event('chat_message', 'chat_message', message={'content': 'benchmark message'})
+        started = time.perf_counter()
+        for _ in range(count):
+            await layer.send(channel, event)
+            await layer.receive(channel)
+        return time.perf_counter() - started
+
+    async def group_round_trip(self, layer, size, count):
+        '''Seconds for count group sends, each received by every member before the next'''
+        group = f'bench_{uuid.uuid4().hex}'
+        channels = [await layer.new_channel() for _ in range(size)]
+        for channel in channels:
+            await layer.group_add(group, channel)
+        event = frame_event('chat_message', 'chat_message', message={'content': 'benchmark message'})
+        try:
+            started = time.perf_counter()
+            for _ in range(count):
+                await layer.group_send(group, event)
+                await asyncio.gather(*(layer.receive(channel) for channel in channels))
+            return time.perf_counter() - started
+        finally:
+            for channel in channels:
+                await layer.group_discard(group, channel)
@@ -0,0 +1,121 @@
+import asyncio
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+
+from chats.fanout import FanoutHub
+from chats.frames import frame_event
+
+
+class Subscriber:
+    # stands in for a socket, only records when its frame arrived
+    def __init__(self, run):
+        self.run = run
+
+    async def chat_message(self, event):
+        self.run.arrived(time.perf_counter() - event['sent_at'])
+
+
+class Run:
+    def __init__(self, size):
+        self.size = size
+        self.latencies = []
+        self.count = 0
+        self.done = asyncio.Event()
+
+    def start(self):
+        self.count = 0
+        self.done.clear()
+
+    def arrived(self, latency):
+        self.latencies.append(latency)
+        self.count += 1
+        if self.count == self.size:
+            self.done.set()
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures channel room broadcast latency as subscribers grow, '
+        'one group member per socket against per-process fan-out'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscribers', default='100,1000,5000',
+                            help='Comma separated subscriber counts')
+        parser.add_argument('--messages', type=int, default=20,
+                            help='Messages broadcast per subscriber count')
+        parser.add_argument('--processes', type=int, default=4,
+                            help='Fan-out hubs the subscribers are spread over, one per simulated process')
+        parser.add_argument('--layer', choices=['default', 'memory'], default='default',
+                            help="The configured channel layer, or a fresh InMemoryChannelLayer")
+        parser.add_argument('--timeout', type=float, default=30.0,
+                            help='Seconds to wait for a broadcast to reach everyone')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['subscribers'].split(',')]
+        asyncio.run(self.run_all(sizes, options))
+
+    async def run_all(self, sizes, options):
+        layer = InMemoryChannelLayer() if options['layer'] == 'memory' else get_channel_layer()
+        if layer is None:
+            raise CommandError('No channel layer is configured')
+        self.stdout.write(f'{type(layer).__name__}, {options["processes"]} fan-out processes')
+        self.stdout.write(
+            f"{'subscribers':>11} {'mode':>8} {'send (ms)':>10} {'p50 (ms)':>9} {'p99 (ms)':>9} {'last (ms)':>10}"
+        )
+        for size in sizes:
+            for mode in ('group', 'fanout'):
+                send, latencies, last = await self.measure(layer, size, mode, options)
+                self.stdout.write(
+                    f'{size:>11} {mode:>8} {send * 1000:>10.2f} '
+                    f'{statistics.median(latencies) * 1000:>9.2f} '
+                    f'{statistics.quantiles(latencies, n=100)[98] * 1000:>9.2f} {last * 1000:>10.2f}'
+                )
+
+    async def measure(self, layer, size, mode, options):
+        '''Sender time per group_send, every delivery latency and the mean time to the last one'''
+        room_id = uuid.uuid4()
+        group = f'chat_{room_id}'
+        run = Run(size)
+        subscribers = [Subscriber(run) for _ in range(size)]
+
+        readers, channels, hubs = [], [], []
+        if mode == 'group':
+            for subscriber in subscribers:
+                channel = await layer.new_channel()
+                await layer.group_add(group, channel)
+                channels.append(channel)
+                readers.append(asyncio.ensure_future(self.read(layer, channel, subscriber)))
+        else:
+            hubs = [FanoutHub(layer) for _ in range(max(options['processes'], 1))]
+            for i, subscriber in enumerate(subscribers):
+                await hubs[i % len(hubs)].subscribe(room_id, subscriber)
+
+        sends, lasts = [], []
+        try:
+            for _ in range(options['messages']):
+                run.start()
+                event = frame_event('chat_message', 'chat_message', room_id=room_id, message={'content': 'load'})
+                event['sent_at'] = started = time.perf_counter()
+                await layer.group_send(group, event)
+                sends.append(time.perf_counter() - started)
+                await asyncio.wait_for(run.done.wait(), options['timeout'])
+                lasts.append(time.perf_counter() - started)
+        finally:
+            for reader in readers:
+                reader.cancel()
+            for channel in channels:
+                await layer.group_discard(group, channel)
+            for hub in hubs:
+                for subscriber in subscribers:
+                    await hub.unsubscribe(room_id, subscriber)
+        return statistics.mean(sends), run.latencies, statistics.mean(lasts)
+
+    async def read(self, layer, channel, subscriber):
+        while True:
+            await subscriber.chat_message(await layer.receive(channel))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chats.models import RoomParticipant
+from chats.receipts import recount_unread
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the per-participant unread counters from the read watermarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', action='append', default=[],
+                            help='Only repair this room, may be repeated')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report drifted counters without fixing them')
+
+    def handle(self, *args, **options):
+        participants = RoomParticipant.objects.all()
+        if options['room']:
+            participants = participants.filter(room_id__in=options['room'])
+
+        with transaction.atomic():
+            before = dict(participants.values_list('id', 'unread_count'))
+            updated = recount_unread(participants)
+            after = dict(participants.values_list('id', 'unread_count'))
+            drifted = sum(1 for pk, count in after.items() if before.get(pk) != count)
+            if options['dry_run']:
+                transaction.set_rollback(True)
+
+        self.stdout.write(
+            f'{updated} counters recomputed, {drifted} had drifted'
+            + (' (dry run, nothing saved)' if options['dry_run'] else '')
+        )
@@ -0,0 +1,70 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def read_by_to_watermarks(apps, schema_editor):
+    '''Creating participant rows and folding read_by into per-room watermarks
+
+    The watermark is the newest message each user had read in a room, so
+    older messages they had skipped count as read from now on. Only members
+    get one, read_by entries of non-members are dropped.
+    '''
+    ChatRoom = apps.get_model('chats', 'ChatRoom')
+    Message = apps.get_model('chats', 'Message')
+    RoomParticipant = apps.get_model('chats', 'RoomParticipant')
+
+    Membership = ChatRoom.participants.through
+    RoomParticipant.objects.bulk_create(
+        [
+            RoomParticipant(room_id=room_id, user_id=user_id)
+            for room_id, user_id in Membership.objects.values_list('chatroom_id', 'user_id').iterator()
+        ],
+        batch_size=500,
+        ignore_conflicts=True,
+    )
+
+    ReadBy = Message.read_by.through
+    newest_reads = (
+        ReadBy.objects
+        .values('user_id', 'message__room_id')
+        .annotate(last_read_at=Max('message__created_at'))
+    )
+    for row in newest_reads.iterator():
+        last_read_message = (
+            Message.objects
+            .filter(room_id=row['message__room_id'], created_at=row['last_read_at'])
+            .values_list('id', flat=True)
+            .first()
+        )
+        # reads of rooms the user has since left don't make them a member again
+        RoomParticipant.objects.filter(
+            room_id=row['message__room_id'], user_id=row['user_id'],
+        ).update(last_read_at=row['last_read_at'], last_read_message_id=last_read_message)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0003_chatroom_participants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roomparticipant',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='roomparticipant',
+            name='last_read_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chats.message'),
+        ),
+        migrations.RunPython(read_by_to_watermarks, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='read_by',
+        ),
+    ]
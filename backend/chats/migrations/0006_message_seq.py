@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:10
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def number_existing_messages(apps, schema_editor):
+    '''Numbering existing messages per room in (created_at, id) order'''
+    ChatRoom = apps.get_model('chats', 'ChatRoom')
+    Message = apps.get_model('chats', 'Message')
+
+    for room_id in ChatRoom.objects.values_list('id', flat=True).iterator():
+        messages = []
+        for seq, message in enumerate(
+            Message.objects.filter(room_id=room_id).only('id').order_by('created_at', 'id').iterator(),
+            start=1,
+        ):
+            message.seq = seq
+            messages.append(message)
+        Message.objects.bulk_update(messages, ['seq'], batch_size=500)
+        ChatRoom.objects.filter(id=room_id).update(last_seq=len(messages))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0005_message_history_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(number_existing_messages, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('room', 'seq'), name='chats_msg_room_seq_uniq'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:13
+
+from django.db import migrations, models
+from django.db.models import F, Func, OuterRef, Subquery
+
+
+def count_unread_messages(apps, schema_editor):
+    '''Counting each participant's unread messages from their read watermark'''
+    Message = apps.get_model('chats', 'Message')
+    RoomParticipant = apps.get_model('chats', 'RoomParticipant')
+
+    def unread(since=None):
+        messages = Message.objects.filter(room_id=OuterRef('room_id')).exclude(sender_id=OuterRef('user_id'))
+        if since is not None:
+            messages = messages.filter(created_at__gt=since)
+        return Subquery(messages.order_by().values(count=Func(F('id'), function='COUNT')))
+
+    RoomParticipant.objects.filter(last_read_at__isnull=True).update(unread_count=unread())
+    RoomParticipant.objects.filter(last_read_at__isnull=False).update(unread_count=unread(OuterRef('last_read_at')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0006_message_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roomparticipant',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_unread_messages, migrations.RunPython.noop),
+    ]
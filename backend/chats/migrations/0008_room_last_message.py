@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:16
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def point_rooms_at_last_message(apps, schema_editor):
+    '''Filling the last message of each room, rooms without one date from their creation'''
+    ChatRoom = apps.get_model('chats', 'ChatRoom')
+    Message = apps.get_model('chats', 'Message')
+
+    newest = Message.objects.filter(room_id=OuterRef('pk')).order_by('-seq')
+    ChatRoom.objects.update(
+        last_message_id=Subquery(newest.values('id')[:1]),
+        last_activity_at=Coalesce(Subquery(newest.values('created_at')[:1]), F('created_at')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0007_participant_unread_count'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='chatroom',
+            options={'ordering': ['-last_activity_at']},
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_activity_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chats.message'),
+        ),
+        migrations.RunPython(point_rooms_at_last_message, migrations.RunPython.noop),
+    ]
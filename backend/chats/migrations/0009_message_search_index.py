@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:24
+
+from django.db import migrations
+
+SQLITE_INDEX = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS chats_message_fts USING fts5(
+        content, content='chats_message', tokenize='unicode61 remove_diacritics 2'
+    )''',
+    '''CREATE TRIGGER IF NOT EXISTS chats_message_fts_ai AFTER INSERT ON chats_message BEGIN
+        INSERT INTO chats_message_fts(rowid, content) VALUES (new.rowid, new.content);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS chats_message_fts_ad AFTER DELETE ON chats_message BEGIN
+        INSERT INTO chats_message_fts(chats_message_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS chats_message_fts_au AFTER UPDATE OF content ON chats_message BEGIN
+        INSERT INTO chats_message_fts(chats_message_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+        INSERT INTO chats_message_fts(rowid, content) VALUES (new.rowid, new.content);
+    END''',
+    "INSERT INTO chats_message_fts(chats_message_fts) VALUES ('rebuild')",
+]
+
+POSTGRES_INDEX = [
+    '''CREATE INDEX IF NOT EXISTS chats_msg_content_fts_idx
+        ON chats_message USING GIN (to_tsvector('simple', content))''',
+]
+
+
+def run(schema_editor, statements):
+    with schema_editor.connection.cursor() as cursor:
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            cursor.execute(statement)
+
+def install(apps, schema_editor):
+    run(schema_editor, {'sqlite': SQLITE_INDEX, 'postgresql': POSTGRES_INDEX})
+
+def drop(apps, schema_editor):
+    run(schema_editor, {
+        'sqlite': [f'DROP TRIGGER IF EXISTS chats_message_fts_a{suffix}' for suffix in 'idu']
+                  + ['DROP TABLE IF EXISTS chats_message_fts'],
+        'postgresql': ['DROP INDEX IF EXISTS chats_msg_content_fts_idx'],
+    })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0008_room_last_message'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, drop),
+    ]
@@ -0,0 +1,90 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:24
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, Func, OuterRef, Subquery
+
+
+def move_reactions_to_tables(apps, schema_editor):
+    '''Counting likes and moving the reactions JSON into the reaction tables
+
+    Entries shaped {emoji: [user ids]} become memberships and counts, bare
+    {emoji: count} entries can only keep their count.
+    '''
+    Message = apps.get_model('chats', 'Message')
+    MessageReaction = apps.get_model('chats', 'MessageReaction')
+    MessageReactionCount = apps.get_model('chats', 'MessageReactionCount')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+
+    Likes = Message.likes.through
+    Message.objects.update(likes_count=Subquery(
+        Likes.objects.filter(message_id=OuterRef('pk')).order_by()
+        .values(count=Func(F('id'), function='COUNT'))
+    ))
+
+    user_ids = {str(pk) for pk in User.objects.values_list('pk', flat=True)}
+    reactions, counts = [], []
+    for message_id, data in Message.objects.exclude(reactions={}).values_list('id', 'reactions').iterator():
+        if not isinstance(data, dict):
+            continue
+        for emoji, value in data.items():
+            emoji = str(emoji)[:32]
+            if isinstance(value, list):
+                reactors = {str(user_id) for user_id in value} & user_ids
+                reactions += [MessageReaction(message_id=message_id, user_id=user_id, emoji=emoji) for user_id in reactors]
+                count = len(reactors)
+            elif isinstance(value, int):
+                count = max(value, 0)
+            else:
+                continue
+            if count:
+                counts.append(MessageReactionCount(message_id=message_id, emoji=emoji, count=count))
+    MessageReaction.objects.bulk_create(reactions, batch_size=500, ignore_conflicts=True)
+    MessageReactionCount.objects.bulk_create(counts, batch_size=500, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0009_message_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='likes_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='MessageReaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('emoji', models.CharField(max_length=32)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_reactions', to='chats.message')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='message_reactions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('message', 'user', 'emoji'), name='chats_reaction_uniq')],
+            },
+        ),
+        migrations.CreateModel(
+            name='MessageReactionCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('emoji', models.CharField(max_length=32)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reaction_counts', to='chats.message')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('message', 'emoji'), name='chats_reaction_count_uniq')],
+            },
+        ),
+        migrations.RunPython(move_reactions_to_tables, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='reactions',
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def run(schema_editor, statements):
+    with schema_editor.connection.cursor() as cursor:
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            cursor.execute(statement)
+
+def install(apps, schema_editor):
+    run(schema_editor, {
+        'sqlite': [
+            '''CREATE VIRTUAL TABLE IF NOT EXISTS chats_archive_fts USING fts5(
+                content, content='', tokenize='unicode61 remove_diacritics 2'
+            )''',
+        ],
+        'postgresql': [
+            'ALTER TABLE chats_messagearchivesegment ADD COLUMN IF NOT EXISTS search_vector tsvector',
+            '''CREATE INDEX IF NOT EXISTS chats_archive_fts_idx
+                ON chats_messagearchivesegment USING GIN (search_vector)''',
+        ],
+    })
+
+def drop(apps, schema_editor):
+    run(schema_editor, {
+        'sqlite': ['DROP TABLE IF EXISTS chats_archive_fts'],
+        'postgresql': ['ALTER TABLE chats_messagearchivesegment DROP COLUMN IF EXISTS search_vector'],
+    })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0010_message_reactions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchiveSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_seq', models.PositiveBigIntegerField()),
+                ('last_seq', models.PositiveBigIntegerField()),
+                ('first_created_at', models.DateTimeField()),
+                ('last_created_at', models.DateTimeField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archive_segments', to='chats.chatroom')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'last_created_at'], name='chats_archive_room_time_idx')],
+                'constraints': [models.UniqueConstraint(fields=('room', 'first_seq'), name='chats_archive_room_seq_uniq')],
+            },
+        ),
+        migrations.RunPython(install, drop),
+    ]
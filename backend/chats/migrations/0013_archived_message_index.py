@@ -0,0 +1,67 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:23
+
+import json
+import zlib
+
+from datetime import datetime
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import F, Func, Max, OuterRef, Q, Subquery
+
+
+def index_archived_messages(apps, schema_editor):
+    '''Recording where each message of the existing segments went'''
+    MessageArchiveSegment = apps.get_model('chats', 'MessageArchiveSegment')
+    ArchivedMessage = apps.get_model('chats', 'ArchivedMessage')
+    for segment in MessageArchiveSegment.objects.iterator(chunk_size=4):
+        ArchivedMessage.objects.bulk_create(
+            ArchivedMessage(
+                id=record['id'],
+                segment_id=segment.id,
+                created_at=datetime.fromisoformat(record['created_at']),
+            )
+            for record in json.loads(zlib.decompress(bytes(segment.data)))
+        )
+
+
+def mark_archived_messages_read(apps, schema_editor):
+    '''Moving read watermarks past the messages already archived'''
+    Message = apps.get_model('chats', 'Message')
+    MessageArchiveSegment = apps.get_model('chats', 'MessageArchiveSegment')
+    RoomParticipant = apps.get_model('chats', 'RoomParticipant')
+
+    archived = MessageArchiveSegment.objects.values('room_id').annotate(newest=Max('last_created_at'))
+    for room_id, newest in archived.values_list('room_id', 'newest'):
+        unread = (
+            Message.objects
+            .filter(room_id=room_id, created_at__gt=newest)
+            .exclude(sender_id=OuterRef('user_id'))
+        )
+        RoomParticipant.objects.filter(
+            Q(last_read_at__isnull=True) | Q(last_read_at__lt=newest), room_id=room_id,
+        ).update(
+            last_read_message=None,
+            last_read_at=newest,
+            unread_count=Subquery(unread.order_by().values(count=Func(F('id'), function='COUNT'))),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0012_chat_uploads'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.UUIDField(editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField()),
+                ('segment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='chats.messagearchivesegment')),
+            ],
+        ),
+        migrations.RunPython(index_archived_messages, migrations.RunPython.noop),
+        migrations.RunPython(mark_archived_messages_read, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,112 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:02
+
+import json
+import zlib
+
+from django.db import migrations
+
+MESSAGE_TRIGGERS = [f'chats_message_fts_a{suffix}' for suffix in 'idu']
+
+# message index keyed by an INTEGER PRIMARY KEY per message, which VACUUM keeps
+SQLITE_MESSAGE_INDEX = [
+    '''CREATE TABLE chats_message_search (
+        id INTEGER PRIMARY KEY, message_id char(32) NOT NULL UNIQUE
+    )''',
+    '''CREATE VIRTUAL TABLE chats_message_fts USING fts5(
+        content, content='', tokenize='unicode61 remove_diacritics 2'
+    )''',
+    '''CREATE TRIGGER chats_message_fts_ai AFTER INSERT ON chats_message BEGIN
+        INSERT INTO chats_message_search(message_id) VALUES (new.id);
+        INSERT INTO chats_message_fts(rowid, content)
+            SELECT id, new.content FROM chats_message_search WHERE message_id = new.id;
+    END''',
+    '''CREATE TRIGGER chats_message_fts_ad AFTER DELETE ON chats_message BEGIN
+        INSERT INTO chats_message_fts(chats_message_fts, rowid, content)
+            SELECT 'delete', id, old.content FROM chats_message_search WHERE message_id = old.id;
+        DELETE FROM chats_message_search WHERE message_id = old.id;
+    END''',
+    '''CREATE TRIGGER chats_message_fts_au AFTER UPDATE OF content ON chats_message BEGIN
+        INSERT INTO chats_message_fts(chats_message_fts, rowid, content)
+            SELECT 'delete', id, old.content FROM chats_message_search WHERE message_id = old.id;
+        INSERT INTO chats_message_fts(rowid, content)
+            SELECT id, new.content FROM chats_message_search WHERE message_id = new.id;
+    END''',
+    'INSERT INTO chats_message_search(message_id) SELECT id FROM chats_message',
+    '''INSERT INTO chats_message_fts(rowid, content)
+        SELECT keys.id, message.content FROM chats_message_search keys
+        JOIN chats_message message ON message.id = keys.message_id''',
+]
+
+# the rowid keyed index of 0009
+SQLITE_ROWID_INDEX = [
+    '''CREATE VIRTUAL TABLE chats_message_fts USING fts5(
+        content, content='chats_message', tokenize='unicode61 remove_diacritics 2'
+    )''',
+    '''CREATE TRIGGER chats_message_fts_ai AFTER INSERT ON chats_message BEGIN
+        INSERT INTO chats_message_fts(rowid, content) VALUES (new.rowid, new.content);
+    END''',
+    '''CREATE TRIGGER chats_message_fts_ad AFTER DELETE ON chats_message BEGIN
+        INSERT INTO chats_message_fts(chats_message_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+    END''',
+    '''CREATE TRIGGER chats_message_fts_au AFTER UPDATE OF content ON chats_message BEGIN
+        INSERT INTO chats_message_fts(chats_message_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+        INSERT INTO chats_message_fts(rowid, content) VALUES (new.rowid, new.content);
+    END''',
+    "INSERT INTO chats_message_fts(chats_message_fts) VALUES ('rebuild')",
+]
+
+# the archive index keeps its text so deleted segments can take their rows along
+SQLITE_ARCHIVE_INDEX = [
+    '''CREATE VIRTUAL TABLE chats_archive_fts USING fts5(
+        content, tokenize='unicode61 remove_diacritics 2'
+    )''',
+    '''CREATE TRIGGER chats_archive_fts_ad AFTER DELETE ON chats_messagearchivesegment BEGIN
+        DELETE FROM chats_archive_fts WHERE rowid = old.id;
+    END''',
+]
+
+SQLITE_CONTENTLESS_ARCHIVE_INDEX = [
+    '''CREATE VIRTUAL TABLE chats_archive_fts USING fts5(
+        content, content='', tokenize='unicode61 remove_diacritics 2'
+    )''',
+]
+
+
+def reindex_archive(apps, cursor):
+    MessageArchiveSegment = apps.get_model('chats', 'MessageArchiveSegment')
+    for segment in MessageArchiveSegment.objects.iterator(chunk_size=4):
+        records = json.loads(zlib.decompress(bytes(segment.data)))
+        cursor.execute(
+            'INSERT INTO chats_archive_fts(rowid, content) VALUES (%s, %s)',
+            [segment.id, '\n'.join(record['content'] for record in records)],
+        )
+
+def rekey(apps, schema_editor, message_index, archive_index):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for statement in (
+            [f'DROP TRIGGER IF EXISTS {name}' for name in MESSAGE_TRIGGERS]
+            + ['DROP TRIGGER IF EXISTS chats_archive_fts_ad']
+            + [f'DROP TABLE IF EXISTS {table}' for table in ('chats_message_fts', 'chats_message_search', 'chats_archive_fts')]
+            + message_index + archive_index
+        ):
+            cursor.execute(statement)
+        reindex_archive(apps, cursor)
+
+def forwards(apps, schema_editor):
+    rekey(apps, schema_editor, SQLITE_MESSAGE_INDEX, SQLITE_ARCHIVE_INDEX)
+
+def backwards(apps, schema_editor):
+    rekey(apps, schema_editor, SQLITE_ROWID_INDEX, SQLITE_CONTENTLESS_ARCHIVE_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0013_archived_message_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
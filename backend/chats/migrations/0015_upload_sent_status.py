@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:04
+
+import json
+import zlib
+
+from django.db import migrations, models
+
+
+def mark_sent_uploads(apps, schema_editor):
+    '''Marking uploads sent with a message, including messages already archived'''
+    ChatUpload = apps.get_model('chats', 'ChatUpload')
+    MessageArchiveSegment = apps.get_model('chats', 'MessageArchiveSegment')
+    ChatUpload.objects.filter(message__isnull=False).update(status='sent')
+    for segment in MessageArchiveSegment.objects.iterator(chunk_size=4):
+        files = [record['file'] for record in json.loads(zlib.decompress(bytes(segment.data))) if record['file']]
+        if files:
+            ChatUpload.objects.filter(room_id=segment.room_id, status='complete', file__in=files).update(status='sent')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0014_stable_search_keys'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatupload',
+            name='status',
+            field=models.CharField(choices=[('uploading', 'Uploading'), ('processing', 'Processing'), ('complete', 'Complete'), ('sent', 'Sent'), ('failed', 'Failed')], default='uploading', max_length=10),
+        ),
+        migrations.RunPython(mark_sent_uploads, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0015_upload_sent_status'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatupload',
+            name='status',
+            field=models.CharField(choices=[('uploading', 'Uploading'), ('writing', 'Writing'), ('processing', 'Processing'), ('complete', 'Complete'), ('sent', 'Sent'), ('failed', 'Failed')], default='uploading', max_length=10),
+        ),
+    ]
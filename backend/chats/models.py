@@ -1,4 +1,6 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 from django.conf import settings
 
@@ -20,16 +22,39 @@ class ChatRoom(models.Model):
     participants = models.ManyToManyField('users.User', related_name='chat_rooms', blank=True)
     is_private = models.BooleanField(default=False)
     max_participants  = models.IntegerField(default=100)
+    # last sequence number handed to a message of this room
+    last_seq = models.PositiveBigIntegerField(default=0)
+    # newest message and when it was sent, kept in step with message saves
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    last_activity_at = models.DateTimeField(default=timezone.now, db_index=True)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
-        ordering = ['-updated_at']
+        ordering = ['-last_activity_at']
     
     def __str__(self):
         return f'{self.name} {self.room_type}'
 
+    @staticmethod
+    def allocate_seq(room_id, count=1):
+        '''Reserving count consecutive message sequence numbers, returning the first
+
+        Must run inside a transaction, the UPDATE holds the room row until
+        commit so concurrent writers get consecutive, gap-free ranges.
+        '''
+        ChatRoom.objects.filter(id=room_id).update(last_seq=F('last_seq') + count)
+        return ChatRoom.objects.values_list('last_seq', flat=True).get(id=room_id) - count + 1
+
+    @staticmethod
+    def record_last_message(message):
+        '''Pointing the room at message unless a later numbered one is already recorded'''
+        ChatRoom.objects.filter(
+            Q(last_message__isnull=True) | Q(last_message__seq__lt=message.seq),
+            id=message.room_id,
+        ).update(last_message_id=message.id, last_activity_at=message.created_at)
+
 
 class Message(models.Model):
     MESSAGE_TYPES = (
@@ -41,17 +66,18 @@ class Message(models.Model):
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages')
+    # gap-free per room ordering, assigned on first save
+    seq = models.PositiveBigIntegerField(blank=True, null=True)
     sender = models.ForeignKey('users.User', on_delete=models.CASCADE, related_name='sent_messages')
     content = models.TextField()
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPES, default='text')
     file = models.FileField(upload_to='chat_files/', blank=True, null=True)
+    # name, size, type and image preview of file, copied from its ChatUpload
+    attachment_meta = models.JSONField(default=dict, blank=True)
 
-    # Reactions
+    # Reactions, emoji reactions live in MessageReaction/MessageReactionCount
     likes = models.ManyToManyField('users.User', related_name='liked_messages', blank=True )
-    reactions = models.JSONField(default=dict) #stores emoji reactions
-
-    # read receipts
-    read_by = models.ManyToManyField('users.User', related_name='read_messages', blank=True)
+    likes_count = models.PositiveIntegerField(default=0)
 
     # edit history
     is_edited = models.BooleanField(default=False)
@@ -66,9 +92,27 @@ class Message(models.Model):
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # keyset history pages walk (created_at, id) within a room
+            models.Index(fields=['room', 'created_at', 'id'], name='chats_msg_room_created_idx'),
+        ]
+        constraints = [
+            # also serves the seq range queries of reconnect catch-up
+            models.UniqueConstraint(fields=['room', 'seq'], name='chats_msg_room_seq_uniq'),
+        ]
 
     def __str__(self):
         return f'{self.sender.username}: {self.content[:50]}'
+
+    def save(self, *args, **kwargs):
+        if self.seq is None and self._state.adding:
+            with transaction.atomic():
+                self.seq = ChatRoom.allocate_seq(self.room_id)
+                super().save(*args, **kwargs)
+                ChatRoom.record_last_message(self)
+                RoomParticipant.count_new_messages(self.room_id, self.sender_id)
+            return
+        super().save(*args, **kwargs)
     
 
 
@@ -85,8 +129,126 @@ class RoomParticipant(models.Model):
     joined_at = models.DateTimeField(auto_now_add=True)
     is_banned = models.BooleanField(default=False)
 
+    # read receipts, everything up to this message counts as read
+    last_read_message = models.ForeignKey(Message, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    last_read_at = models.DateTimeField(blank=True, null=True)
+    # messages from others after the watermark, kept up to date incrementally
+    unread_count = models.PositiveIntegerField(default=0)
+
     class Meta: 
         unique_together  = ['user', 'room']
 
     def __str__(self):
         return f'{self.user.username} in {self.room.name}'
+
+    @staticmethod
+    def count_new_messages(room_id, sender_id, count=1):
+        '''Bumping the unread counters of everyone in the room but the sender'''
+        RoomParticipant.objects.filter(room_id=room_id).exclude(user_id=sender_id).update(
+            unread_count=F('unread_count') + count
+        )
+
+
+class MessageReaction(models.Model):
+    # who reacted with what, one row per (message, user, emoji)
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='user_reactions')
+    user = models.ForeignKey('users.User', on_delete=models.CASCADE, related_name='message_reactions')
+    emoji = models.CharField(max_length=32)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['message', 'user', 'emoji'], name='chats_reaction_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} {self.emoji} on {self.message_id}'
+
+
+class MessageReactionCount(models.Model):
+    # running total per (message, emoji), only ever changed with F() updates
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='reaction_counts')
+    emoji = models.CharField(max_length=32)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['message', 'emoji'], name='chats_reaction_count_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.emoji} x{self.count} on {self.message_id}'
+
+
+class MessageArchiveSegment(models.Model):
+    '''A run of a room's oldest messages, moved out of Message into one compressed row
+
+    data is zlib compressed JSON of the messages in seq order, see chats.archive.
+    '''
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='archive_segments')
+    first_seq = models.PositiveBigIntegerField()
+    last_seq = models.PositiveBigIntegerField()
+    first_created_at = models.DateTimeField()
+    last_created_at = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'first_seq'], name='chats_archive_room_seq_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['room', 'last_created_at'], name='chats_archive_room_time_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.room_id} seq {self.first_seq}-{self.last_seq}'
+
+
+class ArchivedMessage(models.Model):
+    '''Where an archived message went, so lookups by id don't decompress segments'''
+    id = models.UUIDField(primary_key=True, editable=False)
+    segment = models.ForeignKey(MessageArchiveSegment, on_delete=models.CASCADE, related_name='entries')
+    created_at = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.id} in segment {self.segment_id}'
+
+
+
+class ChatUpload(models.Model):
+    '''A resumable upload of a chat attachment
+
+    Chunks are appended to a partial file until received reaches size, the
+    file then moves under chat_files/ and images get their preview made in
+    the media process pool, see chats.uploads.
+    '''
+    STATUSES = (
+        ('uploading', 'Uploading'),
+        ('writing', 'Writing'),
+        ('processing', 'Processing'),
+        ('complete', 'Complete'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    )
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey('users.User', on_delete=models.CASCADE, related_name='chat_uploads')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='uploads')
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100, blank=True)
+    size = models.PositiveBigIntegerField()
+    # bytes written so far, the offset the next chunk must start at
+    received = models.PositiveBigIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUSES, default='uploading')
+    file = models.FileField(upload_to='chat_files/', blank=True, null=True)
+    meta = models.JSONField(default=dict, blank=True)
+    # the message the upload was sent with, an upload is sent at most once. Its
+    # status stays 'sent' once the message is archived and this goes NULL
+    message = models.OneToOneField(Message, on_delete=models.SET_NULL, blank=True, null=True, related_name='upload')
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.filename} {self.received}/{self.size}'
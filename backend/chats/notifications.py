@@ -0,0 +1,96 @@
+'''Per-user notification channel and per-room update topics
+
+Every socket of a user joins user_<id>, for events about the user such as
+their unread counters, and room_updates_<room id> of each of their rooms
+with up to ROOM_UPDATE_MAX_PARTICIPANTS members. Once a message is stored
+one room_updated event with a short preview of it goes to the room's
+topic, however many members it has, and each consumer drops it when it is
+subscribed to the room or sent the message. Clients count it as one more
+unread message, absolute counters come with the room list and the
+unread_count frames of their own reads.
+'''
+import logging
+import re
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import OuterRef
+
+from .frames import frame_event
+from .models import ChatRoom
+from .utils import chat_config, count_subquery
+
+logger = logging.getLogger(__name__)
+
+MENTION = re.compile(r'(?<!\w)@([\w.@+-]+)')
+
+
+def user_group(user_id):
+    return f'user_{user_id}'
+
+def message_preview(payload):
+    '''The part of a message payload a room list entry shows'''
+    return {
+        'id': payload['id'],
+        'seq': payload['seq'],
+        'sender': payload['sender']['username'],
+        'content': payload['content'][:chat_config('ROOM_UPDATE_PREVIEW_LENGTH')],
+        'message_type': payload['message_type'],
+        'created_at': payload['created_at'],
+    }
+
+def room_updates_group(room_id):
+    return f'room_updates_{room_id}'
+
+def update_room_ids(user_id):
+    '''Rooms of the user whose room_updated topic its sockets join
+
+    Rooms above ROOM_UPDATE_MAX_PARTICIPANTS are left out, a preview per
+    message for every connected member is too much for those and their
+    members refresh the room list instead.
+    '''
+    members = ChatRoom.participants.through.objects.filter(chatroom_id=OuterRef('pk'))
+    return list(
+        ChatRoom.objects
+        .filter(participants=user_id)
+        .annotate(member_count=count_subquery(members))
+        .filter(member_count__lte=chat_config('ROOM_UPDATE_MAX_PARTICIPANTS'))
+        .values_list('id', flat=True)
+    )
+
+def mentions(content):
+    return set(MENTION.findall(content))
+
+async def send_room_update(channel_layer, room_id, payload, mentioned=None, new_messages=1):
+    '''One room_updated event with the preview of payload for the room's topic
+
+    mentioned defaults to the usernames mentioned in payload. Batches pass
+    those of all the messages of one sender, and how many there were.
+    '''
+    if mentioned is None:
+        mentioned = mentions(payload['content'])
+    event = frame_event(
+        'room_updated', 'room_updated',
+        room_id=str(room_id),
+        new_messages=new_messages,
+        mentions=sorted(mentioned),
+        last_message=message_preview(payload),
+    )
+    # lets consumers drop it without decoding
+    event['room_id'] = str(room_id)
+    event['sender_id'] = str(payload['sender']['id'])
+    await channel_layer.group_send(room_updates_group(room_id), event)
+
+def membership_changed(room_id, user_ids, joined):
+    '''Telling the users' sockets to join or leave the room's topic, once the change commits'''
+    def send():
+        channel_layer = get_channel_layer()
+        try:
+            for user_id in user_ids:
+                async_to_sync(channel_layer.group_send)(user_group(user_id), {
+                    'type': 'room_membership', 'room_id': str(room_id), 'joined': joined,
+                })
+        except Exception:
+            logger.exception('Failed to tell %d users about room %s', len(user_ids), room_id)
+    transaction.on_commit(send)
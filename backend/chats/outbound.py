@@ -0,0 +1,146 @@
+import asyncio
+import logging
+
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class OutboundQueue:
+    '''Bounded per-connection send buffer drained by a single writer task
+
+    Frames are tagged with a kind. Frames sharing a coalesce key, read
+    receipts and room updates, replace each other while still queued. When
+    the buffer is full, or the bytes it holds plus those still in flight
+    pass max_bytes, queued typing frames are shed first, new typing frames
+    are dropped, and if that still leaves no room put() returns False so
+    the caller can disconnect the slow client.
+
+    Under daphne websocket.send hands the frame to Twisted and returns
+    without waiting for the socket, so a slow client never holds up the
+    writer on its own. Clients report how many frames they have received
+    and the writer stops with window frames unacknowledged, counted from
+    the start of the socket, so a client that is slow or never reports
+    ends up with a full buffer and gets disconnected like any other.
+    '''
+
+    def __init__(self, send, max_size, window=None, max_bytes=None):
+        self.send = send
+        self.max_size = max_size
+        self.window = window
+        self.max_bytes = max_bytes
+        self.frames = deque()
+        self.keys = {}
+        # sizes of the queued frames, and of the frames sent but not yet acknowledged
+        self.queued_bytes = 0
+        self.in_flight = deque()
+        self.in_flight_bytes = 0
+        self.ready = asyncio.Event()
+        # set while the client's window has room
+        self.open = asyncio.Event()
+        self.open.set()
+        self.acknowledged = 0
+        self.task = None
+        self.stats = {
+            'sent': 0,
+            'dropped_typing': 0,
+            'coalesced_reads': 0,
+            'coalesced_room_updates': 0,
+            'max_depth': 0,
+            'max_unacknowledged': 0,
+            'max_bytes': 0,
+        }
+
+    @property
+    def unacknowledged(self):
+        return self.stats['sent'] - self.acknowledged if self.window else 0
+
+    @property
+    def depth(self):
+        return len(self.frames)
+
+    @property
+    def held_bytes(self):
+        return self.queued_bytes + self.in_flight_bytes
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def put(self, frame, kind='message', key=None):
+        if key is not None and key in self.keys:
+            entry = self.keys[key]
+            self.queued_bytes += len(frame) - len(entry[2])
+            entry[2] = frame
+            self.stats['coalesced_room_updates' if kind == 'room_update' else 'coalesced_reads'] += 1
+            return True
+
+        if self.full(len(frame)):
+            if kind == 'typing':
+                self.stats['dropped_typing'] += 1
+                return True
+            self.shed()
+            if self.full(len(frame)):
+                return False
+
+        entry = [kind, key, frame]
+        self.frames.append(entry)
+        if key is not None:
+            self.keys[key] = entry
+        self.queued_bytes += len(frame)
+        self.stats['max_depth'] = max(self.stats['max_depth'], len(self.frames))
+        self.stats['max_bytes'] = max(self.stats['max_bytes'], self.held_bytes)
+        self.ready.set()
+        return True
+
+    def full(self, size):
+        if len(self.frames) >= self.max_size:
+            return True
+        return self.max_bytes is not None and self.held_bytes + size > self.max_bytes
+
+    def acknowledge(self, received):
+        '''Recording the client's count of frames received on this socket'''
+        if not self.window:
+            return
+        received = min(received, self.stats['sent'])
+        while self.acknowledged < received:
+            self.acknowledged += 1
+            self.in_flight_bytes -= self.in_flight.popleft()
+        if self.unacknowledged < self.window:
+            self.open.set()
+
+    def shed(self):
+        '''Dropping queued typing frames'''
+        kept = deque()
+        for entry in self.frames:
+            if entry[0] == 'typing':
+                self.queued_bytes -= len(entry[2])
+            else:
+                kept.append(entry)
+        self.stats['dropped_typing'] += len(self.frames) - len(kept)
+        self.frames = kept
+
+    async def run(self):
+        while True:
+            if not self.frames:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+            if self.window and self.unacknowledged >= self.window:
+                self.open.clear()
+                await self.open.wait()
+                continue
+            _, key, frame = self.frames.popleft()
+            if key is not None:
+                self.keys.pop(key, None)
+            self.queued_bytes -= len(frame)
+            await self.send(frame)
+            self.stats['sent'] += 1
+            if self.window:
+                self.in_flight.append(len(frame))
+                self.in_flight_bytes += len(frame)
+            self.stats['max_unacknowledged'] = max(self.stats['max_unacknowledged'], self.unacknowledged)
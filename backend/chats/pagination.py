@@ -0,0 +1,165 @@
+import base64
+import uuid
+
+from datetime import datetime
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .archive import merge, position
+
+
+def encode_cursor(message):
+    '''Opaque cursor pointing at a message's (created_at, id) position'''
+    raw = f'{message.created_at.isoformat()}|{message.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    # websocket requests carry any JSON value here, not just strings
+    if not isinstance(cursor, str):
+        raise ValidationError({'cursor': 'Invalid cursor'})
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        created_at, message_id = raw.split('|')
+        return datetime.fromisoformat(created_at), uuid.UUID(message_id)
+    except (ValueError, UnicodeError):
+        raise ValidationError({'cursor': 'Invalid cursor'})
+
+def older_than(created_at, message_id):
+    return Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id)
+
+def newer_than(created_at, message_id):
+    return Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=message_id)
+
+
+def take_older(newest_first, archive, before, count):
+    '''count messages positioned before before (None for the newest), newest first'''
+    page = newest_first.filter(older_than(*before)) if before is not None else newest_first
+    page = list(page[:count])
+    if archive is not None:
+        # archived messages only matter if they sort above the last hot one
+        floor = position(page[-1]) if len(page) == count else None
+        page = merge(page, archive.older(before, count, floor=floor), count, reverse=True)
+    return page
+
+def take_newer(oldest_first, archive, after, count, inclusive=False):
+    '''count messages positioned after after, oldest first'''
+    condition = newer_than(*after)
+    if inclusive:
+        condition |= Q(id=after[1])
+    page = list(oldest_first.filter(condition)[:count])
+    if archive is not None:
+        ceiling = position(page[-1]) if len(page) == count else None
+        page = merge(page, archive.newer(after, count, ceiling=ceiling, inclusive=inclusive), count)
+    return page
+
+def paginate_messages(queryset, before=None, after=None, around=None, limit=50, archive=None):
+    '''Keyset page of messages ordered by (created_at, id)
+
+    before/after are cursors, around is a message id whose page is centred on
+    it. Without any of them the newest page is returned. Every mode walks the
+    (room, created_at, id) index instead of OFFSET scanning. Passing the
+    room's RoomArchive merges archived messages in. Returns the messages
+    oldest first plus whether more exist on either side.
+    '''
+    newest_first = queryset.order_by('-created_at', '-id')
+    oldest_first = queryset.order_by('created_at', 'id')
+
+    if around is not None:
+        try:
+            anchor = queryset.values_list('created_at', 'id').get(id=around)
+        except (queryset.model.DoesNotExist, DjangoValidationError):
+            anchor = archive.locate(around) if archive is not None else None
+            if anchor is None:
+                raise NotFound('Message not found')
+        half = limit // 2
+        older = take_older(newest_first, archive, anchor, half + 1)
+        newer = take_newer(oldest_first, archive, anchor, limit - half + 1, inclusive=True)
+        has_before = len(older) > half
+        has_after = len(newer) > limit - half
+        return older[:half][::-1] + newer[:limit - half], has_before, has_after
+
+    if after is not None:
+        page = take_newer(oldest_first, archive, decode_cursor(after), limit + 1)
+        return page[:limit], True, len(page) > limit
+
+    page = take_older(newest_first, archive, decode_cursor(before) if before is not None else None, limit + 1)
+    return page[:limit][::-1], len(page) > limit, before is not None
+
+
+class MessageCursorPagination(BasePagination):
+    '''Cursor pagination for room history using ?before=, ?after= or ?around='''
+    page_size = 50
+    max_page_size = 200
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        params = request.query_params
+        try:
+            limit = min(int(params.get('limit', self.page_size)), self.max_page_size)
+        except ValueError:
+            limit = self.page_size
+
+        page, self.has_before, self.has_after = paginate_messages(
+            queryset,
+            before=params.get('before'),
+            after=params.get('after'),
+            around=params.get('around'),
+            limit=max(limit, 1),
+            archive=view.get_archive() if hasattr(view, 'get_archive') else None,
+        )
+        self.page = page
+        return page
+
+    def get_link(self, param, message):
+        url = self.request.build_absolute_uri()
+        for name in ('before', 'after', 'around'):
+            url = remove_query_param(url, name)
+        return replace_query_param(url, param, encode_cursor(message))
+
+    def get_paginated_response(self, data):
+        previous_link = next_link = None
+        if self.page and self.has_before:
+            previous_link = self.get_link('before', self.page[0])
+        if self.page and self.has_after:
+            next_link = self.get_link('after', self.page[-1])
+        return Response({
+            'previous': previous_link,
+            'next': next_link,
+            'results': data,
+        })
+
+
+class SearchCursorPagination(MessageCursorPagination):
+    '''Newest first keyset pagination for search results using ?before='''
+    page_size = 20
+    max_page_size = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        params = request.query_params
+        try:
+            limit = max(min(int(params.get('limit', self.page_size)), self.max_page_size), 1)
+        except ValueError:
+            limit = self.page_size
+
+        before = decode_cursor(params['before']) if params.get('before') is not None else None
+        page = queryset.order_by('-created_at', '-id')
+        if before is not None:
+            page = page.filter(older_than(*before))
+        page = list(page[:limit + 1])
+        if hasattr(view, 'search_archive'):
+            page = merge(page, view.search_archive(before, limit + 1), limit + 1, reverse=True)
+        self.page, self.has_more = page[:limit], len(page) > limit
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_link('before', self.page[-1]) if self.has_more else None,
+            'results': data,
+        })
@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import uuid
+from collections import Counter
+
+from django.db import transaction
+from django.utils import timezone
+
+from channels.layers import get_channel_layer
+
+from .archive import RoomArchive
+from .executors import chat_db_to_async
+from .frames import frame_event
+from .models import ChatRoom, ChatUpload, Message, RoomParticipant
+from .notifications import mentions, send_room_update
+from .uploads import UploadUnavailable, attach_upload
+from .utils import chat_config
+
+from users.avatars import avatar_url
+
+logger = logging.getLogger(__name__)
+
+
+def serialize_message(message):
+    '''Broadcast payload of a message
+
+    Only reads the message and its already attached sender instance, so it
+    never lazy loads relations and is safe to call outside the db thread.
+    '''
+    sender = message.sender
+    # ids and timestamps stay native, chats.frames picks their wire encoding
+    return {
+        'id': message.id,
+        'seq': message.seq,
+        'content': message.content,
+        'sender': {
+            'id': sender.id,
+            'username': sender.username,
+            'avatar': avatar_url(sender),
+        },
+        'created_at': message.created_at,
+        'message_type': message.message_type,
+        # file details and image preview, stored on the message when it was sent
+        'attachment': message.attachment_meta or None,
+    }
+
+def persist_message(room_id, user, content, message_type='text', upload_id=None):
+    '''Saving a message in one transaction, returning it with its broadcast payload
+
+    Message.save numbers the message from its room's counter in the same
+    transaction as the INSERT. With upload_id the user's completed upload
+    to the room is attached and claimed, so it can only be sent once.
+    '''
+    message = Message(room_id=room_id, sender=user, content=content, message_type=message_type)
+    with transaction.atomic():
+        if upload_id is not None:
+            upload = ChatUpload.objects.filter(
+                id=upload_id, user=user, room_id=room_id, status='complete', message__isnull=True,
+            ).first()
+            if upload is None:
+                raise UploadUnavailable()
+            attach_upload(message, upload)
+        message.save()
+        if upload_id is not None and not ChatUpload.objects.filter(
+            id=upload_id, status='complete', message__isnull=True
+        ).update(message=message, status='sent'):
+            raise UploadUnavailable()
+    return message, serialize_message(message)
+
+def build_message(room_id, user, content, message_type='text'):
+    '''Building an unsaved message with a server assigned id'''
+    return Message(
+        id=uuid.uuid4(),
+        room_id=room_id,
+        sender=user,
+        content=content,
+        message_type=message_type,
+        created_at=timezone.now(),
+    )
+
+
+def replay_messages(room_id, after_seq, limit):
+    '''Messages of a room numbered after after_seq, oldest first
+
+    Returns the payloads and whether more messages follow the last one.
+    '''
+    messages = list(
+        Message.objects
+        .filter(room_id=room_id, seq__gt=after_seq)
+        .select_related('sender')
+        .order_by('seq')[:limit + 1]
+    )
+    if any(message.seq != after_seq + i for i, message in enumerate(messages, start=1)) or not messages:
+        # gaps in the hot range may have been archived
+        messages = sorted(
+            messages + RoomArchive(room_id).after_seq(after_seq, limit + 1),
+            key=lambda message: message.seq,
+        )[:limit + 1]
+    return [serialize_message(message) for message in messages[:limit]], len(messages) > limit
+
+
+class MessageWriteBuffer:
+    '''Write-behind buffer persisting chat messages in batches
+
+    Messages are queued in memory and flushed with a single bulk_create once
+    max_batch messages are pending or max_delay seconds have passed since the
+    first one was queued. Messages queued with durable=True get a future that
+    resolves once their batch is committed, used for durable acks.
+
+    created_at is auto_now_add so it is re-stamped at flush time, at most
+    max_delay after the message was queued. Sequence numbers are assigned
+    at flush as well, one range per room and batch, and messages are only
+    broadcast once their batch committed, in seq order. A batch that fails
+    to commit is neither numbered nor broadcast.
+
+    That makes every message up to max_delay later to reach the room than
+    with the per-message path, which is why WRITE_BEHIND is off by default.
+    '''
+
+    def __init__(self, max_batch=None, max_delay=None):
+        self.max_batch = max_batch or chat_config('WRITE_BEHIND_MAX_BATCH')
+        self.max_delay = max_delay or chat_config('WRITE_BEHIND_MAX_DELAY')
+        self.pending = []
+        self.timer = None
+        self.flushing = set()
+
+    def enqueue(self, message, durable=False):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future() if durable else None
+        self.pending.append((message, future))
+
+        if len(self.pending) >= self.max_batch:
+            self.schedule_flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_delay, self.schedule_flush)
+        return future
+
+    def schedule_flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        task = asyncio.ensure_future(self.write_batch(batch))
+        # keeping a reference so the task is not garbage collected mid flush
+        self.flushing.add(task)
+        task.add_done_callback(self.flushing.discard)
+
+    async def flush(self):
+        '''Flushing everything pending and waiting for in-flight batches'''
+        self.schedule_flush()
+        if self.flushing:
+            await asyncio.gather(*self.flushing, return_exceptions=True)
+
+    async def write_batch(self, batch):
+        messages = [message for message, _ in batch]
+        try:
+            await chat_db_to_async(self.bulk_insert)(messages)
+        except Exception as e:
+            logger.exception('Failed to flush %d chat messages', len(messages))
+            for _, future in batch:
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            return
+
+        try:
+            await self.broadcast(messages)
+        except Exception:
+            logger.exception('Failed to broadcast %d chat messages', len(messages))
+
+        for _, future in batch:
+            if future is not None and not future.done():
+                future.set_result(True)
+
+        try:
+            await self.notify(messages)
+        except Exception:
+            logger.exception('Failed to send room updates for %d chat messages', len(messages))
+
+    @staticmethod
+    def bulk_insert(messages):
+        '''Numbering and inserting a batch in one transaction
+
+        bulk_create skips Message.save, so seqs, room pointers and unread
+        counters are kept here.
+        '''
+        by_room = {}
+        for message in messages:
+            by_room.setdefault(message.room_id, []).append(message)
+        with transaction.atomic():
+            for room_id, room_messages in by_room.items():
+                first = ChatRoom.allocate_seq(room_id, len(room_messages))
+                for offset, message in enumerate(room_messages):
+                    message.seq = first + offset
+            Message.objects.bulk_create(messages, batch_size=500)
+            newest = newest_per_room(messages)
+            for message in newest.values():
+                ChatRoom.record_last_message(message)
+            for (room_id, sender_id), count in Counter(
+                (message.room_id, message.sender_id) for message in messages
+            ).items():
+                RoomParticipant.count_new_messages(room_id, sender_id, count)
+
+    @staticmethod
+    async def broadcast(messages):
+        channel_layer = get_channel_layer()
+        for message in sorted(messages, key=lambda message: (str(message.room_id), message.seq)):
+            await channel_layer.group_send(f'chat_{message.room_id}', frame_event(
+                'chat_message', 'chat_message',
+                room_id=str(message.room_id),
+                message=serialize_message(message),
+                sender_username=message.sender.username,
+            ))
+
+    @staticmethod
+    async def notify(messages):
+        # one room_updated per room and sender counting their messages, the room's newest last
+        channel_layer = get_channel_layer()
+        by_sender = {}
+        for message in sorted(messages, key=lambda message: (str(message.room_id), message.seq)):
+            by_sender.setdefault((message.room_id, message.sender_id), []).append(message)
+        for (room_id, _), sent in sorted(by_sender.items(), key=lambda item: (str(item[0][0]), item[1][-1].seq)):
+            await send_room_update(
+                channel_layer, room_id, serialize_message(sent[-1]),
+                set().union(*(mentions(message.content) for message in sent)), len(sent),
+            )
+
+
+def newest_per_room(messages):
+    newest = {}
+    for message in messages:
+        if message.room_id not in newest or message.seq > newest[message.room_id].seq:
+            newest[message.room_id] = message
+    return newest
+
+
+_write_buffer = None
+
+def get_write_buffer():
+    '''Process wide write buffer, created lazily on the running event loop'''
+    global _write_buffer
+    if _write_buffer is None:
+        _write_buffer = MessageWriteBuffer()
+    return _write_buffer
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+
+from users.models import User
+from .executors import chat_db_to_async
+from .utils import chat_config
+
+logger = logging.getLogger(__name__)
+
+
+class LocalPresenceStore:
+    '''Connection refcounts kept in this process, enough for a single worker'''
+
+    def __init__(self):
+        self.counts = {}
+
+    async def incr(self, user_id):
+        self.counts[user_id] = self.counts.get(user_id, 0) + 1
+        return self.counts[user_id]
+
+    async def decr(self, user_id):
+        count = self.counts.get(user_id, 0) - 1
+        if count <= 0:
+            self.counts.pop(user_id, None)
+            return 0
+        self.counts[user_id] = count
+        return count
+
+    async def refresh(self):
+        # nothing outlives the process, so nothing to keep alive
+        return False
+
+
+class RedisPresenceStore:
+    '''Connection refcounts shared by every worker through PRESENCE_REDIS_URL
+
+    Keys expire PRESENCE_TTL seconds after they were last touched. Every live
+    worker refreshes the keys of the users it holds sockets of, so
+    counts a crashed worker leaked lapse within the TTL instead of pinning
+    users online.
+    '''
+
+    def __init__(self):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise ImproperlyConfigured('PRESENCE_BACKEND "redis" requires the redis package')
+
+        url = chat_config('PRESENCE_REDIS_URL')
+        if not url:
+            raise ImproperlyConfigured('PRESENCE_BACKEND "redis" requires PRESENCE_REDIS_URL')
+        self.redis = redis.Redis.from_url(url)
+        self.ttl = int(chat_config('PRESENCE_TTL'))
+        # this worker's sockets per user, the keys it keeps alive
+        self.held = {}
+
+    async def incr(self, user_id):
+        key = f'presence:{user_id}'
+        hold(self.held, user_id, 1)
+        async with self.redis.pipeline() as pipe:
+            count, _ = await pipe.incr(key).expire(key, self.ttl).execute()
+        return count
+
+    async def decr(self, user_id):
+        key = f'presence:{user_id}'
+        hold(self.held, user_id, -1)
+        count = await self.redis.decr(key)
+        if count <= 0:
+            await self.redis.delete(key)
+            return 0
+        return count
+
+    async def refresh(self):
+        '''Pushing back the expiry of the keys this worker holds sockets of, False when it holds none'''
+        keys = [f'presence:{user_id}' for user_id in self.held]
+        if not keys:
+            return False
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.expire(key, self.ttl)
+            await pipe.execute()
+        return True
+
+
+def hold(counts, key, delta):
+    count = counts.get(key, 0) + delta
+    if count > 0:
+        counts[key] = count
+    else:
+        counts.pop(key, None)
+
+
+class PresenceTracker:
+    '''Per-user connection refcounts with batched is_online/last_seen writes
+
+    connect/disconnect return True only when the user actually goes online
+    (first socket) or offline (last socket). State changes are collected and
+    written every PRESENCE_FLUSH_INTERVAL seconds with one UPDATE per state.
+    While sockets are open the store's keys are refreshed three times per
+    PRESENCE_TTL.
+    '''
+
+    def __init__(self, store, flush_interval=None):
+        self.store = store
+        self.flush_interval = flush_interval or chat_config('PRESENCE_FLUSH_INTERVAL')
+        self.refresh_interval = chat_config('PRESENCE_TTL') / 3
+        self.dirty = {}
+        self.timer = None
+        self.refresher = None
+        self.flushing = set()
+
+    async def connect(self, user_id):
+        self.keep_alive()
+        online = await self.store.incr(user_id) == 1
+        if online:
+            self.mark(user_id, True)
+        return online
+
+    async def disconnect(self, user_id):
+        offline = await self.store.decr(user_id) == 0
+        if offline:
+            self.mark(user_id, False)
+        return offline
+
+    def keep_alive(self):
+        if self.refresher is None:
+            loop = asyncio.get_running_loop()
+            self.refresher = loop.call_later(self.refresh_interval, self.schedule_refresh)
+
+    def schedule_refresh(self):
+        self.refresher = None
+        task = asyncio.ensure_future(self.refresh())
+        self.flushing.add(task)
+        task.add_done_callback(self.flushing.discard)
+
+    async def refresh(self):
+        try:
+            held = await self.store.refresh()
+        except Exception:
+            logger.exception('Failed to refresh presence keys')
+            held = True
+        if held:
+            self.keep_alive()
+
+    def mark(self, user_id, is_online):
+        self.dirty[user_id] = is_online
+        if self.timer is None:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(self.flush_interval, self.schedule_flush)
+
+    def schedule_flush(self):
+        self.timer = None
+        if not self.dirty:
+            return
+        changes, self.dirty = self.dirty, {}
+        task = asyncio.ensure_future(self.write_changes(changes))
+        self.flushing.add(task)
+        task.add_done_callback(self.flushing.discard)
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.refresher is not None:
+            self.refresher.cancel()
+            self.refresher = None
+        self.schedule_flush()
+        if self.flushing:
+            await asyncio.gather(*self.flushing, return_exceptions=True)
+
+    async def write_changes(self, changes):
+        try:
+            await chat_db_to_async(self.bulk_update)(changes)
+        except Exception:
+            logger.exception('Failed to flush presence for %d users', len(changes))
+
+    @staticmethod
+    def bulk_update(changes):
+        now = timezone.now()
+        online = [user_id for user_id, is_online in changes.items() if is_online]
+        offline = [user_id for user_id, is_online in changes.items() if not is_online]
+        # update() skips auto_now and signals, only the two presence columns are written
+        if online:
+            User.objects.filter(id__in=online).update(is_online=True, last_seen=now)
+        if offline:
+            User.objects.filter(id__in=offline).update(is_online=False, last_seen=now)
+
+
+PRESENCE_STORES = {
+    'local': LocalPresenceStore,
+    'redis': RedisPresenceStore,
+}
+
+_tracker = None
+
+def get_presence_tracker():
+    '''Process wide presence tracker using the PRESENCE_BACKEND store'''
+    global _tracker
+    if _tracker is None:
+        store = PRESENCE_STORES[chat_config('PRESENCE_BACKEND')]()
+        _tracker = PresenceTracker(store)
+    return _tracker
@@ -0,0 +1,114 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from . import coalescing
+from .models import Message, MessageReaction, MessageReactionCount
+
+MAX_EMOJI_LENGTH = 32
+
+
+def valid_emoji(emoji):
+    return isinstance(emoji, str) and 0 < len(emoji) <= MAX_EMOJI_LENGTH and not emoji.isspace()
+
+def add_reaction(message_id, user_id, emoji):
+    '''Adding a user's emoji to a message, returns False if it was already there
+
+    The membership row's unique constraint decides who counts, the total is
+    only ever moved with an F() update so concurrent reactions never lose
+    increments.
+    '''
+    with transaction.atomic():
+        try:
+            with transaction.atomic():
+                MessageReaction.objects.create(message_id=message_id, user_id=user_id, emoji=emoji)
+        except IntegrityError:
+            return False
+        MessageReactionCount.objects.bulk_create(
+            [MessageReactionCount(message_id=message_id, emoji=emoji)], ignore_conflicts=True
+        )
+        MessageReactionCount.objects.filter(message_id=message_id, emoji=emoji).update(
+            count=F('count') + 1
+        )
+    return True
+
+def remove_reaction(message_id, user_id, emoji):
+    '''Removing a user's emoji from a message, returns False if it wasn't there'''
+    with transaction.atomic():
+        removed, _ = MessageReaction.objects.filter(
+            message_id=message_id, user_id=user_id, emoji=emoji
+        ).delete()
+        if not removed:
+            return False
+        MessageReactionCount.objects.filter(message_id=message_id, emoji=emoji, count__gt=0).update(
+            count=F('count') - 1
+        )
+    return True
+
+def react(room_id, message_id, user_id, emoji, add=None):
+    '''Adding or removing a user's emoji, toggling it when add is None, and queueing the room's totals
+
+    The one write path of sockets and http views. Returns (reacted, changed).
+    '''
+    if add is None:
+        reacted, changed = toggle_reaction(message_id, user_id, emoji), True
+    else:
+        reacted, changed = add, (add_reaction if add else remove_reaction)(message_id, user_id, emoji)
+    if changed:
+        coalescing.get_reaction_coalescer().changed(room_id, message_id)
+    return reacted, changed
+
+def toggle_reaction(message_id, user_id, emoji):
+    '''Adding the emoji, or removing it if the user had it already. Returns whether it is now set'''
+    if remove_reaction(message_id, user_id, emoji):
+        return False
+    add_reaction(message_id, user_id, emoji)
+    return True
+
+def reaction_counts(message_ids):
+    '''Current totals as {message_id: {emoji: count}}, messages without reactions map to {}'''
+    counts = {message_id: {} for message_id in message_ids}
+    for message_id, emoji, count in (
+        MessageReactionCount.objects
+        .filter(message_id__in=message_ids, count__gt=0)
+        .order_by('emoji')
+        .values_list('message_id', 'emoji', 'count')
+    ):
+        counts[message_id][emoji] = count
+    return counts
+
+def message_totals(message_ids):
+    '''Reaction totals and like counts as broadcast, {message_id: {'reactions': ..., 'likes_count': ...}}'''
+    counts = reaction_counts(message_ids)
+    return {
+        message_id: {'reactions': counts[message_id], 'likes_count': likes_count}
+        for message_id, likes_count in Message.objects.filter(id__in=message_ids).values_list('id', 'likes_count')
+    }
+
+def like(room_id, message_id, user_id):
+    '''toggle_like, queueing the room's totals like react()'''
+    liked, likes_count = toggle_like(message_id, user_id)
+    coalescing.get_reaction_coalescer().changed(room_id, message_id)
+    return liked, likes_count
+
+def toggle_like(message_id, user_id):
+    '''Liking or unliking a message, returns (liked, likes_count)
+
+    The likes M2M is the membership table, Message.likes_count is moved in
+    the same transaction instead of being recounted.
+    '''
+    Likes = Message.likes.through
+    messages = Message.objects.filter(id=message_id)
+    with transaction.atomic():
+        removed, _ = Likes.objects.filter(message_id=message_id, user_id=user_id).delete()
+        if removed:
+            messages.filter(likes_count__gt=0).update(likes_count=F('likes_count') - 1)
+        else:
+            try:
+                with transaction.atomic():
+                    Likes.objects.create(message_id=message_id, user_id=user_id)
+                messages.update(likes_count=F('likes_count') + 1)
+            except IntegrityError:
+                # a concurrent request liked it first and already counted it
+                pass
+        likes_count = messages.values_list('likes_count', flat=True).get()
+    return not removed, likes_count
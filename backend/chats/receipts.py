@@ -0,0 +1,58 @@
+from django.db.models import OuterRef, Q
+
+from .models import Message, RoomParticipant
+from .utils import count_subquery
+
+
+def unread_messages(room_id, user_id, since=None):
+    '''COUNT subquery of messages from others in the room newer than since
+
+    Arguments may be plain values or OuterRef expressions.
+    '''
+    messages = Message.objects.filter(room_id=room_id).exclude(sender_id=user_id)
+    if since is not None:
+        messages = messages.filter(created_at__gt=since)
+    return count_subquery(messages)
+
+def advance_read_watermark(user_id, message):
+    '''Moving the user's read watermark in the message's room up to message
+
+    Done in a single conditional UPDATE so the watermark never moves back,
+    recounting the unread messages left after it in the same statement.
+    Only existing participant rows move, reading a public channel doesn't
+    make anyone a member. Returns the new unread count, or None when the
+    watermark didn't move or the user has no participant row.
+    '''
+    participants = RoomParticipant.objects.filter(user_id=user_id, room_id=message.room_id)
+    advanced = participants.filter(
+        Q(last_read_at__isnull=True) | Q(last_read_at__lt=message.created_at),
+    ).update(
+        last_read_message_id=message.id,
+        last_read_at=message.created_at,
+        unread_count=unread_messages(message.room_id, user_id, message.created_at),
+    )
+    if advanced:
+        return participants.values_list('unread_count', flat=True).first()
+    return None
+
+def get_read_watermark(user_id, room_id):
+    return (
+        RoomParticipant.objects
+        .filter(user_id=user_id, room_id=room_id)
+        .values_list('last_read_at', flat=True)
+        .first()
+    )
+
+def recount_unread(participants):
+    '''Recomputing the unread counters of participants from their watermarks
+
+    Two UPDATEs with a correlated COUNT, one for participants that never
+    read anything. Only hot messages are counted, archived ones count as
+    read since archive_room moves watermarks past them. Returns the number
+    of rows updated.
+    '''
+    return participants.filter(last_read_at__isnull=True).update(
+        unread_count=unread_messages(OuterRef('room_id'), OuterRef('user_id'))
+    ) + participants.filter(last_read_at__isnull=False).update(
+        unread_count=unread_messages(OuterRef('room_id'), OuterRef('user_id'), OuterRef('last_read_at'))
+    )
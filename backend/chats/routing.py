@@ -2,5 +2,7 @@ from django.urls import re_path
 from . import consumers
 
 websocket_urlpatterns = [
+    # one socket for every room, subscribed in-band
+    re_path(r'ws/chat/$', consumers.chatConsumer.as_asgi()),
     re_path(r'ws/chat/(?P<room_id>[^/]+)/$', consumers.chatConsumer.as_asgi()),
 ]
\ No newline at end of file
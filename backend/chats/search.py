@@ -0,0 +1,286 @@
+'''Full-text search over message content
+
+SQLite gets a contentless FTS5 table kept in sync by triggers, keyed by
+chats_message_search, an INTEGER PRIMARY KEY per message uuid, since
+chats_message's implicit rowid is renumbered by VACUUM and table rebuilds.
+Postgres gets a GIN index on to_tsvector(content) which needs no upkeep.
+Both are installed by a migration and checked again after every migrate,
+since SQLite drops the triggers whenever Django rebuilds a table for a
+schema change. A contentless table keeps no text to cut snippets from, so
+SQLite snippets are made in Python like archived ones, see message_snippet.
+
+Archived messages are indexed per segment, an FTS5 table keyed by segment
+id on SQLite and a tsvector column on Postgres, written by the archiver
+itself. The SQLite table keeps its text so a trigger can drop the rows of
+deleted segments. Matching segments are then filtered per message in
+Python, see chats.archive.
+
+Both backends match every term, the last one as a prefix.
+'''
+import html
+import logging
+import re
+
+from django.db import connection
+from django.db.models import BooleanField, CharField
+from django.db.models.expressions import RawSQL
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'chats_message_fts'
+FTS_KEYS_TABLE = 'chats_message_search'
+ARCHIVE_FTS_TABLE = 'chats_archive_fts'
+TS_CONFIG = 'simple'
+SNIPPET_TOKENS = 12
+
+# private use characters around matches, swapped for <mark> once escaped
+MATCH_START, MATCH_END = '\ue000', '\ue001'
+
+SQLITE_INDEX = [
+    f'''CREATE TABLE IF NOT EXISTS {FTS_KEYS_TABLE} (
+        id INTEGER PRIMARY KEY, message_id char(32) NOT NULL UNIQUE
+    )''',
+    f'''CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        content, content='', tokenize='unicode61 remove_diacritics 2'
+    )''',
+    f'''CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON chats_message BEGIN
+        INSERT INTO {FTS_KEYS_TABLE}(message_id) VALUES (new.id);
+        INSERT INTO {FTS_TABLE}(rowid, content)
+            SELECT id, new.content FROM {FTS_KEYS_TABLE} WHERE message_id = new.id;
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON chats_message BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content)
+            SELECT 'delete', id, old.content FROM {FTS_KEYS_TABLE} WHERE message_id = old.id;
+        DELETE FROM {FTS_KEYS_TABLE} WHERE message_id = old.id;
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF content ON chats_message BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content)
+            SELECT 'delete', id, old.content FROM {FTS_KEYS_TABLE} WHERE message_id = old.id;
+        INSERT INTO {FTS_TABLE}(rowid, content)
+            SELECT id, new.content FROM {FTS_KEYS_TABLE} WHERE message_id = new.id;
+    END''',
+]
+
+SQLITE_REBUILD = [
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('delete-all')",
+    f'DELETE FROM {FTS_KEYS_TABLE}',
+    f'INSERT INTO {FTS_KEYS_TABLE}(message_id) SELECT id FROM chats_message',
+    f'''INSERT INTO {FTS_TABLE}(rowid, content)
+        SELECT keys.id, message.content FROM {FTS_KEYS_TABLE} keys
+        JOIN chats_message message ON message.id = keys.message_id''',
+]
+
+POSTGRES_INDEX = [
+    f'''CREATE INDEX IF NOT EXISTS chats_msg_content_fts_idx
+        ON chats_message USING GIN (to_tsvector('{TS_CONFIG}', content))''',
+]
+
+SQLITE_ARCHIVE_INDEX = [
+    f'''CREATE VIRTUAL TABLE IF NOT EXISTS {ARCHIVE_FTS_TABLE} USING fts5(
+        content, tokenize='unicode61 remove_diacritics 2'
+    )''',
+    f'''CREATE TRIGGER IF NOT EXISTS {ARCHIVE_FTS_TABLE}_ad AFTER DELETE ON chats_messagearchivesegment BEGIN
+        DELETE FROM {ARCHIVE_FTS_TABLE} WHERE rowid = old.id;
+    END''',
+]
+
+POSTGRES_ARCHIVE_INDEX = [
+    'ALTER TABLE chats_messagearchivesegment ADD COLUMN IF NOT EXISTS search_vector tsvector',
+    '''CREATE INDEX IF NOT EXISTS chats_archive_fts_idx
+        ON chats_messagearchivesegment USING GIN (search_vector)''',
+]
+
+# triggers each SQLite table needs, reinstalled when a rebuild drops them
+SQLITE_TRIGGERS = {
+    FTS_TABLE: {f'{FTS_TABLE}_a{suffix}' for suffix in 'idu'},
+    ARCHIVE_FTS_TABLE: {f'{ARCHIVE_FTS_TABLE}_ad'},
+}
+
+
+def install_search_index(using=connection):
+    '''Creating the index and its triggers if missing, rebuilding the SQLite one'''
+    if using.vendor == 'sqlite':
+        statements = SQLITE_INDEX + SQLITE_REBUILD
+    elif using.vendor == 'postgresql':
+        statements = POSTGRES_INDEX
+    else:
+        logger.warning('No full-text index for %s, message search is unavailable', using.vendor)
+        return
+    with using.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+def repair_search_index(using=connection):
+    '''Reinstalling SQLite triggers lost to a table rebuild, returns whether it had to'''
+    if using.vendor != 'sqlite':
+        return False
+    with using.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')")
+        names = {name for name, in cursor.fetchall()}
+    # no table means the index was never installed or was dropped on purpose
+    missing = [table for table, triggers in SQLITE_TRIGGERS.items() if table in names and not triggers <= names]
+    if FTS_TABLE in missing:
+        logger.warning('Message search triggers were missing, rebuilding the index')
+        install_search_index(using)
+    if ARCHIVE_FTS_TABLE in missing:
+        logger.warning('Archive search trigger was missing, dropping rows of deleted segments')
+        install_archive_index(using)
+        with using.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {ARCHIVE_FTS_TABLE} WHERE rowid NOT IN (SELECT id FROM chats_messagearchivesegment)'
+            )
+    return bool(missing)
+
+def drop_search_index(using=connection):
+    if using.vendor == 'sqlite':
+        statements = [f'DROP TRIGGER IF EXISTS {name}' for name in SQLITE_TRIGGERS[FTS_TABLE]]
+        statements += [f'DROP TABLE IF EXISTS {FTS_TABLE}', f'DROP TABLE IF EXISTS {FTS_KEYS_TABLE}']
+    elif using.vendor == 'postgresql':
+        statements = ['DROP INDEX IF EXISTS chats_msg_content_fts_idx']
+    else:
+        return
+    with using.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def install_archive_index(using=connection):
+    statements = {'sqlite': SQLITE_ARCHIVE_INDEX, 'postgresql': POSTGRES_ARCHIVE_INDEX}.get(using.vendor, [])
+    with using.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+def drop_archive_index(using=connection):
+    statements = {
+        'sqlite': [f'DROP TRIGGER IF EXISTS {ARCHIVE_FTS_TABLE}_ad', f'DROP TABLE IF EXISTS {ARCHIVE_FTS_TABLE}'],
+        'postgresql': ['ALTER TABLE chats_messagearchivesegment DROP COLUMN IF EXISTS search_vector'],
+    }.get(using.vendor, [])
+    with using.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+def index_archive_segment(segment_id, text, using=connection):
+    '''Indexing the combined text of a freshly written archive segment'''
+    with using.cursor() as cursor:
+        if using.vendor == 'sqlite':
+            cursor.execute(f'INSERT INTO {ARCHIVE_FTS_TABLE}(rowid, content) VALUES (%s, %s)', [segment_id, text])
+        elif using.vendor == 'postgresql':
+            cursor.execute(
+                f"UPDATE chats_messagearchivesegment SET search_vector = to_tsvector('{TS_CONFIG}', %s) WHERE id = %s",
+                [text, segment_id],
+            )
+
+def archive_segment_matches(text):
+    '''Condition on MessageArchiveSegment for segments that may hold a match of text'''
+    if connection.vendor == 'sqlite':
+        return RawSQL(
+            f'chats_messagearchivesegment.id IN (SELECT rowid FROM {ARCHIVE_FTS_TABLE} WHERE {ARCHIVE_FTS_TABLE} MATCH %s)',
+            [fts5_query(text)], output_field=BooleanField(),
+        )
+    if connection.vendor == 'postgresql':
+        return RawSQL(
+            f"chats_messagearchivesegment.search_vector @@ to_tsquery('{TS_CONFIG}', %s)",
+            [ts_query(text)], output_field=BooleanField(),
+        )
+    raise NotImplementedError(f'Message search is not available on {connection.vendor}')
+
+def fts5_query(text):
+    '''Quoting every term so user input can't break the FTS5 query syntax
+
+    Terms must all match, the last one as a prefix so results follow typing.
+    '''
+    terms = ['"{}"'.format(term.replace('"', '""')) for term in text.split()]
+    if terms:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+def ts_query(text):
+    '''Postgres to_tsquery version of fts5_query, every term quoted and the last one a prefix'''
+    terms = ["'{}'".format(term.replace('\\', '\\\\').replace("'", "''")) for term in text.split()]
+    if terms:
+        terms[-1] += ':*'
+    return ' & '.join(terms)
+
+def search_messages(queryset, text):
+    '''Narrowing a Message queryset to matches of text
+
+    On Postgres matches come annotated with a snippet, which marks matches
+    with MATCH_START/MATCH_END, see message_snippet() and highlight().
+    '''
+    if connection.vendor == 'sqlite':
+        return queryset.filter(RawSQL(
+            f'''chats_message.id IN (SELECT message_id FROM {FTS_KEYS_TABLE} WHERE id IN (
+                SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s))''',
+            [fts5_query(text)], output_field=BooleanField(),
+        ))
+    if connection.vendor == 'postgresql':
+        tsquery = f"to_tsquery('{TS_CONFIG}', %s)"
+        query = ts_query(text)
+        # same expression as the GIN index so the planner can use it
+        matches = RawSQL(
+            f"to_tsvector('{TS_CONFIG}', chats_message.content) @@ {tsquery}",
+            [query], output_field=BooleanField(),
+        )
+        snippet = RawSQL(
+            f"ts_headline('{TS_CONFIG}', chats_message.content, {tsquery}, %s)",
+            [query, f'StartSel={MATCH_START}, StopSel={MATCH_END}, MaxWords={SNIPPET_TOKENS * 2}, '
+                    f'MinWords={SNIPPET_TOKENS}, MaxFragments=1, FragmentDelimiter=…'],
+            output_field=CharField(),
+        )
+        return queryset.filter(matches).annotate(snippet=snippet)
+    raise NotImplementedError(f'Message search is not available on {connection.vendor}')
+
+def message_snippet(message, text):
+    '''The snippet of a search result, cut here when the database had none to give'''
+    snippet = getattr(message, 'snippet', None)
+    if snippet is None:
+        # diacritics and tokenizer quirks can match what the patterns miss
+        snippet = text_snippet(message.content, term_patterns(text))
+    if snippet is None:
+        words = message.content.split()
+        snippet = ' '.join(words[:SNIPPET_TOKENS]) + ('…' if len(words) > SNIPPET_TOKENS else '')
+    return snippet
+
+def term_patterns(text):
+    '''Case insensitive word patterns for the terms of text, the last one a prefix
+
+    Mirrors fts5_query for filtering and marking archived messages in Python.
+    '''
+    terms = text.split()
+    return [
+        re.compile(r'\b' + re.escape(term) + (r'' if i == len(terms) - 1 else r'\b'), re.IGNORECASE)
+        for i, term in enumerate(terms)
+    ]
+
+def text_snippet(content, patterns):
+    '''Snippet of content around its first match with every match marked, or None if a term is missing'''
+    spans = []
+    for pattern in patterns:
+        found = [match.span() for match in pattern.finditer(content)]
+        if not found:
+            return None
+        spans += found
+    spans.sort()
+
+    words = list(re.finditer(r'\S+', content))
+    first = next((i for i, word in enumerate(words) if word.end() > spans[0][0]), 0)
+    start = max(first - SNIPPET_TOKENS // 2, 0)
+    end = min(start + SNIPPET_TOKENS, len(words))
+    lo, hi = (words[start].start(), words[end - 1].end()) if words else (0, len(content))
+
+    marked, position = [], lo
+    for span_start, span_end in spans:
+        if span_start < position or span_end > hi:
+            continue
+        marked += [content[position:span_start], MATCH_START, content[span_start:span_end], MATCH_END]
+        position = span_end
+    marked.append(content[position:hi])
+    return ('…' if lo > 0 else '') + ''.join(marked) + ('…' if hi < len(content) else '')
+
+def highlight(snippet):
+    '''HTML escaped snippet with matches wrapped in <mark>'''
+    return (
+        html.escape(snippet or '')
+        .replace(MATCH_START, '<mark>')
+        .replace(MATCH_END, '</mark>')
+    )
@@ -1,36 +1,104 @@
-from .models import ChatRoom , Message,  RoomParticipant
+from django.db.models import Exists, OuterRef, Prefetch
+
+from .models import ChatRoom , Message, MessageReaction, MessageReactionCount, RoomParticipant
+from .persistence import serialize_message
+from .search import highlight, message_snippet
 
 from rest_framework import serializers
 
-from users.serializers import UserSerializer
+from users.models import User
+from users.serializers import UserSerializer, UserSummarySerializer
+
+def annotate_messages(queryset, user):
+    '''Fetching what MessageSerializer reads along with the messages
+
+    is_liked comes back as an annotation, the sender with its profile is
+    joined in, and the liker ids, reaction totals and the user's own
+    reactions are prefetched in one query each, so a page serializes
+    without per message queries.
+    '''
+    likes = Message.likes.through.objects.filter(message_id=OuterRef('pk'))
+    return queryset.select_related('sender__profile').prefetch_related(
+        Prefetch('likes', queryset=User.objects.only('id')),
+        Prefetch('reaction_counts', queryset=MessageReactionCount.objects.filter(count__gt=0).order_by('emoji')),
+        Prefetch('user_reactions', queryset=MessageReaction.objects.filter(user_id=user.id), to_attr='own_reactions'),
+    ).annotate(
+        liked_by_user=Exists(likes.filter(user_id=user.id)),
+    )
 
 class MessageSerializer(serializers.ModelSerializer):
     sender = UserSerializer(read_only=True)
     reply_to = serializers.PrimaryKeyRelatedField(read_only=True)
-    likes_count = serializers.SerializerMethodField()
     is_liked = serializers.SerializerMethodField()
+    reactions = serializers.SerializerMethodField()
+    my_reactions = serializers.SerializerMethodField()
     is_read = serializers.SerializerMethodField()
+    read_count = serializers.SerializerMethodField()
 
     class Meta: 
         model = Message
         fields = '__all__'
-        read_only_fields = ('sender' ,'created_at', 'updated_at', 'room')
-    
-    def get_likes_count(self, obj):
-        return obj.likes.count()
+        read_only_fields = ('sender' ,'created_at', 'updated_at', 'room', 'seq', 'likes_count')
     
     def get_is_liked(self, obj):
         request = self.context.get('request', '')
         if request and request.user.is_authenticated:
+            if hasattr(obj, 'liked_by_user'):
+                return obj.liked_by_user
             return obj.likes.filter(id=request.user.id).exists()
         return False
     
+    def get_reactions(self, obj):
+        # {emoji: count}, the shape the old reactions JSON had
+        if hasattr(obj, 'reaction_totals'):
+            return obj.reaction_totals
+        return {reaction.emoji: reaction.count for reaction in obj.reaction_counts.all() if reaction.count}
+
+    def get_my_reactions(self, obj):
+        request = self.context.get('request', '')
+        if request and request.user.is_authenticated:
+            if hasattr(obj, 'own_reactions'):
+                return [reaction.emoji for reaction in obj.own_reactions]
+            return list(obj.user_reactions.filter(user=request.user).values_list('emoji', flat=True))
+        return []
+
     def get_is_read(self, obj):
         request = self.context.get('request', '')
         if request and request.user.is_authenticated:
-            return obj.read_by.filter(id=request.user.id).exists()
+            last_read_at = self.get_read_watermarks(obj.room_id).get(request.user.id)
+            return last_read_at is not None and last_read_at >= obj.created_at
         return False
 
+    def get_read_count(self, obj):
+        # participants other than the sender whose watermark passed the message,
+        # public channels keep members' read state to themselves as the participant list does
+        if self.is_public_channel(obj.room_id):
+            return None
+        return sum(
+            1 for user_id, last_read_at in self.get_read_watermarks(obj.room_id).items()
+            if user_id != obj.sender_id and last_read_at >= obj.created_at
+        )
+
+    def get_read_watermarks(self, room_id):
+        # fetched once per room and shared by every message of the page
+        watermarks = self.context.setdefault('read_watermarks', {})
+        if room_id not in watermarks:
+            participants = RoomParticipant.objects.filter(room_id=room_id, last_read_at__isnull=False)
+            if self.is_public_channel(room_id):
+                # only the caller's own is needed there
+                request = self.context.get('request', '')
+                participants = participants.filter(user_id=request.user.id if request else None)
+            watermarks[room_id] = dict(participants.values_list('user_id', 'last_read_at'))
+        return watermarks[room_id]
+
+    def is_public_channel(self, room_id):
+        public_channels = self.context.setdefault('public_channels', {})
+        if room_id not in public_channels:
+            public_channels[room_id] = ChatRoom.objects.filter(
+                id=room_id, room_type='channel', is_private=False
+            ).exists()
+        return public_channels[room_id]
+
 class ChatRoomSerializer(serializers.ModelSerializer):
     created_by = UserSerializer(read_only=True)
     participants = UserSerializer(many=True, read_only=True)
@@ -40,23 +108,59 @@ class ChatRoomSerializer(serializers.ModelSerializer):
     class Meta:
         model = ChatRoom
         fields = '__all__'
-        read_only_fields = ('created_by', 'created_at', 'updated_at')
+        read_only_fields = ('created_by', 'created_at', 'updated_at', 'last_seq', 'last_activity_at')
 
     def get_last_message(self , obj):
-        last_message = obj.messages.last()
-        if last_message: 
-            return MessageSerializer(last_message).data
+        # the same preview the websocket broadcasts, from the denormalized pointer
+        if obj.last_message is not None:
+            return serialize_message(obj.last_message)
         return None
     
     def get_unread_count(self, obj):
         request = self.context.get('request', '')
         if request and request.user.is_authenticated:
-            return obj.messages.exclude(read_by=request.user).count()
+            if hasattr(obj, 'my_unread_count'):
+                return obj.my_unread_count or 0
+            return (
+                RoomParticipant.objects
+                .filter(room=obj, user=request.user)
+                .values_list('unread_count', flat=True)
+                .first()
+            ) or 0
         return 0
     
+class ChatRoomListSerializer(ChatRoomSerializer):
+    '''Room list entry, a participant sample instead of every participant
+
+    Reads participant_count, my_role, my_unread_count and
+    participant_sample as prepared by ChatRoomListCreateView.
+    '''
+    created_by = UserSummarySerializer(read_only=True)
+    participants = UserSummarySerializer(source='participant_sample', many=True, read_only=True)
+    participant_count = serializers.IntegerField(read_only=True)
+    my_role = serializers.CharField(read_only=True, allow_null=True)
+
+    class Meta(ChatRoomSerializer.Meta):
+        fields = (
+            'id', 'name', 'description', 'room_type', 'is_private', 'max_participants',
+            'created_by', 'created_at', 'last_activity_at', 'last_seq', 'last_message',
+            'unread_count', 'participant_count', 'participants', 'my_role',
+        )
+
 class RoomParticipantsSerializer(serializers.ModelSerializer):
-    user = UserSerializer(read_only=True)
-    
+    # other members see who is in the room, never their read state or email
+    user = UserSummarySerializer(read_only=True)
+
     class Meta:
         model = RoomParticipant
-        fields = '__all__'
\ No newline at end of file
+        fields = ('id', 'user', 'role', 'joined_at')
+
+
+class MessageSearchSerializer(serializers.BaseSerializer):
+    # the broadcast payload plus where it was found and the highlighted match
+    def to_representation(self, message):
+        return {
+            **serialize_message(message),
+            'room_id': message.room_id,
+            'snippet': highlight(message_snippet(message, self.context['request'].query_params['q'])),
+        }
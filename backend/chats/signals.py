@@ -0,0 +1,51 @@
+from django.db import connections
+from django.db.models.signals import m2m_changed, post_migrate
+from django.dispatch import receiver
+
+from .models import ChatRoom, RoomParticipant
+from .notifications import membership_changed
+from .search import repair_search_index
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def sync_room_participants(sender, instance, action, reverse, pk_set, **kwargs):
+    '''Keeping RoomParticipant rows (role, read watermark) in step with ChatRoom.participants'''
+    if action == 'post_add':
+        if reverse:
+            pairs = [(room_id, instance.pk) for room_id in pk_set]
+        else:
+            pairs = [(instance.pk, user_id) for user_id in pk_set]
+        RoomParticipant.objects.bulk_create(
+            [RoomParticipant(room_id=room_id, user_id=user_id) for room_id, user_id in pairs],
+            ignore_conflicts=True,
+        )
+        notify_members(pairs, True)
+    elif action == 'post_remove':
+        if reverse:
+            RoomParticipant.objects.filter(user_id=instance.pk, room_id__in=pk_set).delete()
+            notify_members([(room_id, instance.pk) for room_id in pk_set], False)
+        else:
+            RoomParticipant.objects.filter(room_id=instance.pk, user_id__in=pk_set).delete()
+            notify_members([(instance.pk, user_id) for user_id in pk_set], False)
+    elif action == 'post_clear':
+        if reverse:
+            participants = RoomParticipant.objects.filter(user_id=instance.pk)
+        else:
+            participants = RoomParticipant.objects.filter(room_id=instance.pk)
+        notify_members(list(participants.values_list('room_id', 'user_id')), False)
+        participants.delete()
+
+def notify_members(pairs, joined):
+    # sockets of the users join or leave the room_updated topics, see chats.notifications
+    by_room = {}
+    for room_id, user_id in pairs:
+        by_room.setdefault(room_id, []).append(user_id)
+    for room_id, user_ids in by_room.items():
+        membership_changed(room_id, user_ids, joined)
+
+
+@receiver(post_migrate)
+def check_search_index(sender, using, **kwargs):
+    # SQLite drops triggers along with the table whenever a migration rebuilds it
+    if sender.name == 'chats':
+        repair_search_index(connections[using])
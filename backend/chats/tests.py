@@ -1,3 +1,877 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import tempfile
+import unittest
+import uuid
 
-# Create your tests here.
+from datetime import datetime, timedelta
+
+from asgiref.sync import async_to_sync
+from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from users.models import User
+from . import coalescing, fanout, persistence, presence, routing
+from .archive import RoomArchive, archive_room
+from .consumers import chatConsumer
+from .executors import get_db_executor
+from .fanout import FanoutHub, uses_fanout
+from .frames import binary_event_frame, decode_binary_frame, encode_binary_frame, frame_event
+from .layers import HybridChannelLayer
+from .models import ChatRoom, ChatUpload, Message, MessageArchiveSegment, RoomParticipant
+from .notifications import room_updates_group, send_room_update
+from .outbound import OutboundQueue
+from .pagination import decode_cursor, encode_cursor
+from .persistence import MessageWriteBuffer, persist_message
+from .presence import LocalPresenceStore, PresenceTracker, RedisPresenceStore
+from .reactions import react
+from .receipts import advance_read_watermark, recount_unread
+from .search import ARCHIVE_FTS_TABLE, FTS_TABLE, repair_search_index, search_messages, ts_query
+from .uploads import UploadConflict, UploadUnavailable, create_upload, partial_path, write_chunk
+from .utils import chat_config
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def redis_available():
+    try:
+        import redis
+        return redis.Redis.from_url(chat_config('PRESENCE_REDIS_URL'), socket_connect_timeout=0.2).ping()
+    except Exception:
+        return False
+
+def make_room(*users, **fields):
+    room = ChatRoom.objects.create(name=fields.pop('name', 'room'), created_by=users[0], **fields)
+    room.participants.add(*users)
+    return room
+
+def make_users(count, prefix='user'):
+    return [
+        User.objects.create_user(username=f'{prefix}{i}', email=f'{prefix}{i}@example.com', password='pw')
+        for i in range(count)
+    ]
+
+
+class ReadWatermarkTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', email='alice@example.com', password='pw')
+        self.carol = User.objects.create_user(username='carol', email='carol@example.com', password='pw')
+        self.room = ChatRoom.objects.create(name='news', room_type='channel', created_by=self.alice)
+        self.room.participants.add(self.alice)
+
+    def test_reading_a_public_channel_does_not_join_it(self):
+        message = Message.objects.create(room=self.room, sender=self.alice, content='hello')
+        self.assertIsNone(advance_read_watermark(self.carol.id, message))
+        self.assertFalse(RoomParticipant.objects.filter(user=self.carol).exists())
+
+    def test_watermark_moves_forward_only(self):
+        first = Message.objects.create(room=self.room, sender=self.carol, content='one')
+        second = Message.objects.create(room=self.room, sender=self.carol, content='two')
+        self.assertEqual(advance_read_watermark(self.alice.id, second), 0)
+        self.assertIsNone(advance_read_watermark(self.alice.id, first))
+
+
+class CursorTests(TestCase):
+    def test_round_trip(self):
+        user = User.objects.create_user(username='alice', email='alice@example.com', password='pw')
+        message = Message.objects.create(room=make_room(user), sender=user, content='hi')
+        self.assertEqual(decode_cursor(encode_cursor(message)), (message.created_at, message.id))
+
+    def test_rejects_malformed_cursors(self):
+        for cursor in ('not a cursor', 12, ['a'], {'a': 1}):
+            with self.assertRaises(ValidationError):
+                decode_cursor(cursor)
+
+
+class OutboundQueueTests(SimpleTestCase):
+    async def drain(self):
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+    async def test_unacknowledged_frames_fill_the_buffer(self):
+        sent = []
+        async def send(frame):
+            # returns straight away, as daphne's send does
+            sent.append(frame)
+
+        queue = OutboundQueue(send, max_size=3, window=2)
+        queue.start()
+        queue.acknowledge(0)
+        for i in range(5):
+            self.assertTrue(queue.put(f'frame {i}'))
+            await self.drain()
+        self.assertEqual(len(sent), 2)
+        self.assertFalse(queue.put('one too many'))
+
+        queue.acknowledge(2)
+        await self.drain()
+        self.assertEqual(len(sent), 4)
+        queue.stop()
+
+    async def test_clients_without_reports_are_held(self):
+        sent = []
+        async def send(frame):
+            sent.append(frame)
+
+        queue = OutboundQueue(send, max_size=3, window=2)
+        queue.start()
+        for i in range(5):
+            self.assertTrue(queue.put(f'frame {i}'))
+            await self.drain()
+        self.assertEqual(len(sent), 2)
+        self.assertFalse(queue.put('one too many'))
+        queue.stop()
+
+    async def test_bytes_in_flight_count_against_the_cap(self):
+        sent = []
+        async def send(frame):
+            sent.append(frame)
+
+        queue = OutboundQueue(send, max_size=100, window=100, max_bytes=25)
+        queue.start()
+        self.assertTrue(queue.put('x' * 10))
+        self.assertTrue(queue.put('x' * 10))
+        await self.drain()
+        self.assertTrue(queue.put('typing', kind='typing'))
+        self.assertFalse(queue.put('x' * 10))
+        self.assertEqual(queue.stats['dropped_typing'], 1)
+
+        queue.acknowledge(2)
+        self.assertTrue(queue.put('x' * 10))
+        queue.stop()
+
+    async def test_coalescing_is_counted_per_kind(self):
+        async def send(frame):
+            pass
+
+        queue = OutboundQueue(send, max_size=10, window=1)
+        queue.start()
+        queue.put('first')
+        await self.drain()
+        queue.put('read 1', kind='read', key='read:r:u')
+        queue.put('read 2', kind='read', key='read:r:u')
+        queue.put('room 1', kind='room_update', key='room:r')
+        queue.put('room 2', kind='room_update', key='room:r')
+        queue.put('room 3', kind='room_update', key='room:r')
+        self.assertEqual(queue.depth, 2)
+        self.assertEqual(queue.stats['coalesced_reads'], 1)
+        self.assertEqual(queue.stats['coalesced_room_updates'], 2)
+        self.assertEqual(queue.queued_bytes, len('read 2') + len('room 3'))
+        queue.stop()
+
+
+class RoomUpdateTests(SimpleTestCase):
+    async def test_one_event_per_message_whatever_the_room_size(self):
+        layer = InMemoryChannelLayer()
+        sends = []
+        group_send = layer.group_send
+
+        async def counting_group_send(group, message):
+            sends.append(group)
+            await group_send(group, message)
+
+        layer.group_send = counting_group_send
+        members = [await layer.new_channel() for _ in range(50)]
+        for channel in members:
+            await layer.group_add(room_updates_group('room'), channel)
+
+        payload = {
+            'id': 'm', 'seq': 1, 'sender': {'id': 'a', 'username': 'alice'}, 'content': 'hi @carol',
+            'message_type': 'text', 'created_at': '2026-01-01T00:00:00',
+        }
+        await send_room_update(layer, 'room', payload)
+
+        self.assertEqual(sends, [room_updates_group('room')])
+        events = [await layer.receive(channel) for channel in members]
+        self.assertEqual({event['text'] for event in events}, {events[0]['text']})
+        self.assertEqual(json.loads(events[0]['text'])['mentions'], ['carol'])
+        self.assertEqual(events[0]['sender_id'], 'a')
+
+
+@override_settings(CHAT_CONFIG=dict(settings.CHAT_CONFIG, BINARY_FRAMES=True))
+class FrameTests(SimpleTestCase):
+    def test_binary_frames_are_made_where_needed_and_once(self):
+        fields = {
+            'room_id': uuid.uuid4(),
+            'message': {'id': uuid.uuid4(), 'created_at': timezone.now(), 'content': str(uuid.uuid4())},
+        }
+        event = frame_event('chat_message', 'chat_message', **fields)
+        self.assertNotIn('bytes', event)
+        frame = binary_event_frame(event)
+        self.assertEqual(decode_binary_frame(frame), decode_binary_frame(encode_binary_frame('chat_message', **fields)))
+        # content that merely looks like a uuid stays a string
+        self.assertIsInstance(decode_binary_frame(frame)['message']['content'], str)
+        self.assertIs(binary_event_frame(dict(event)), frame)
+
+
+class TypingCoalescerTests(SimpleTestCase):
+    class Coalescer(coalescing.TypingCoalescer):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.sent = []
+
+        async def broadcast(self, changes):
+            self.sent.append(changes)
+
+    async def test_keystrokes_are_broadcast_once_per_interval(self):
+        typing = self.Coalescer(interval=0.05, ttl=5.0)
+        for _ in range(20):
+            typing.update('room', 'u1', 'alice', True, 'socket')
+        typing.update('room', 'u2', 'bob', True, 'socket')
+        await asyncio.sleep(0.1)
+        self.assertEqual(typing.sent, [{'room': {'u1': ('alice', True), 'u2': ('bob', True)}}])
+        typing.timer.cancel()
+
+    async def test_quiet_typers_expire(self):
+        typing = self.Coalescer(interval=0.05, ttl=0.1)
+        typing.update('room', 'u1', 'alice', True, 'socket')
+        await asyncio.sleep(0.25)
+        self.assertEqual(typing.sent[-1], {'room': {'u1': ('alice', False)}})
+        self.assertEqual(typing.rooms, {})
+
+    async def test_typing_stops_with_the_users_last_socket(self):
+        typing = self.Coalescer(interval=0.05, ttl=5.0)
+        typing.update('room', 'u1', 'alice', True, 'phone')
+        typing.update('room', 'u1', 'alice', True, 'laptop')
+        await asyncio.sleep(0.1)
+        # the phone leaving the room doesn't stop the laptop typing
+        typing.update('room', 'u1', 'alice', False, 'phone')
+        await asyncio.sleep(0.1)
+        self.assertEqual(typing.sent, [{'room': {'u1': ('alice', True)}}])
+        self.assertIn('u1', typing.rooms['room'])
+
+        typing.update('room', 'u1', 'alice', False, 'laptop')
+        await asyncio.sleep(0.1)
+        self.assertEqual(typing.sent[-1], {'room': {'u1': ('alice', False)}})
+        self.assertEqual(typing.rooms, {})
+
+
+class PresenceTests(SimpleTestCase):
+    async def test_only_first_and_last_sockets_change_state(self):
+        tracker = PresenceTracker(LocalPresenceStore(), flush_interval=60.0)
+        self.assertTrue(await tracker.connect('u'))
+        self.assertFalse(await tracker.connect('u'))
+        self.assertFalse(await tracker.disconnect('u'))
+        self.assertEqual(tracker.dirty, {'u': True})
+        self.assertTrue(await tracker.disconnect('u'))
+        self.assertEqual(tracker.dirty, {'u': False})
+        tracker.timer.cancel()
+        tracker.refresher.cancel()
+
+    @unittest.skipUnless(redis_available(), 'needs redis at PRESENCE_REDIS_URL')
+    async def test_live_workers_refresh_their_keys(self):
+        store = RedisPresenceStore()
+        user_id = uuid.uuid4().hex
+        key = f'presence:{user_id}'
+        try:
+            self.assertEqual(await store.incr(user_id), 1)
+            self.assertLessEqual(await store.redis.ttl(key), store.ttl)
+            await store.redis.expire(key, 1)
+            self.assertTrue(await store.refresh())
+            self.assertGreater(await store.redis.ttl(key), 1)
+            self.assertEqual(await store.decr(user_id), 0)
+            self.assertFalse(await store.refresh())
+        finally:
+            await store.redis.delete(key)
+            await store.redis.aclose()
+
+
+@unittest.skipUnless(redis_available(), 'needs redis at PRESENCE_REDIS_URL')
+class HybridLayerTests(SimpleTestCase):
+    def make_layer(self):
+        return HybridChannelLayer(hosts=[chat_config('PRESENCE_REDIS_URL')], prefix=f'test{uuid.uuid4().hex[:8]}')
+
+    async def receive(self, layer, channel):
+        return await asyncio.wait_for(layer.receive(channel), 2)
+
+    async def test_sends_within_a_loop_skip_redis(self):
+        layer = self.make_layer()
+        try:
+            first, second = await layer.new_channel(), await layer.new_channel()
+            await layer.send(first, {'type': 'direct'})
+            self.assertEqual(await self.receive(layer, first), {'type': 'direct'})
+            await layer.group_add('room', first)
+            await layer.group_add('room', second)
+            await layer.group_send('room', {'type': 'group'})
+            self.assertEqual((await self.receive(layer, first))['type'], 'group')
+            self.assertEqual((await self.receive(layer, second))['type'], 'group')
+            self.assertEqual(layer.stats['published'], 0)
+        finally:
+            await layer.flush()
+
+    async def test_other_loops_reach_this_loops_channels(self):
+        # as async_to_sync from a view or a management command would
+        layer = self.make_layer()
+        try:
+            channel = await layer.new_channel()
+            await layer.group_add('room', channel)
+
+            async def send_from_another_loop():
+                await layer.send(channel, {'type': 'direct'})
+                await layer.group_send('room', {'type': 'group'})
+            await asyncio.to_thread(asyncio.run, send_from_another_loop())
+
+            received = {(await self.receive(layer, channel))['type'] for _ in range(2)}
+            self.assertEqual(received, {'direct', 'group'})
+        finally:
+            await layer.flush()
+
+    async def test_channels_of_other_loops_can_join_groups(self):
+        layer = self.make_layer()
+        try:
+            channel = await layer.new_channel()
+
+            async def add_from_another_loop():
+                await layer.group_add('room', channel)
+            await asyncio.to_thread(asyncio.run, add_from_another_loop())
+
+            for _ in range(100):
+                if channel in layer.groups.get('room', ()):
+                    break
+                await asyncio.sleep(0.02)
+            await layer.group_send('room', {'type': 'group'})
+            self.assertEqual((await self.receive(layer, channel))['type'], 'group')
+        finally:
+            await layer.flush()
+
+    async def test_sends_to_gone_channels_are_dropped(self):
+        layer = self.make_layer()
+        try:
+            channel = await layer.new_channel()
+            receiving = asyncio.ensure_future(layer.receive(channel))
+            await asyncio.sleep(0)
+            receiving.cancel()
+            await asyncio.gather(receiving, return_exceptions=True)
+            await layer.send(channel, {'type': 'late'})
+            self.assertNotIn(channel, layer.channels)
+            self.assertEqual(layer.stats['dropped'], 1)
+        finally:
+            await layer.flush()
+
+
+class FanoutTests(SimpleTestCase):
+    class Socket:
+        def __init__(self, fail=False):
+            self.events = []
+            self.fail = fail
+
+        async def chat_message(self, event):
+            if self.fail:
+                raise RuntimeError('socket gone')
+            self.events.append(event)
+
+    async def wait_for(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+
+    async def test_one_layer_channel_per_room_for_all_local_sockets(self):
+        layer = InMemoryChannelLayer()
+        hub = FanoutHub(layer, refresh_interval=60)
+        sockets = [self.Socket() for _ in range(3)]
+        for socket in sockets:
+            await hub.subscribe('room', socket)
+        self.assertEqual(len(layer.groups['chat_room']), 1)
+
+        await layer.group_send('chat_room', {'type': 'chat.message', 'text': 'hi'})
+        await self.wait_for(lambda: hub.stats['delivered'] == 3)
+        self.assertEqual([socket.events for socket in sockets], [[{'type': 'chat.message', 'text': 'hi'}]] * 3)
+        self.assertEqual(hub.stats['received'], 1)
+
+        for socket in sockets:
+            await hub.unsubscribe('room', socket)
+        self.assertNotIn('chat_room', layer.groups)
+        self.assertEqual(hub.channels, {})
+
+    async def test_a_failing_socket_doesnt_stop_delivery(self):
+        layer = InMemoryChannelLayer()
+        hub = FanoutHub(layer, refresh_interval=60)
+        broken, working = self.Socket(fail=True), self.Socket()
+        await hub.subscribe('room', broken)
+        await hub.subscribe('room', working)
+
+        with self.assertLogs('chats.fanout', 'ERROR'):
+            await layer.group_send('chat_room', {'type': 'chat.message'})
+            await self.wait_for(lambda: hub.stats['delivered'] == 1)
+        self.assertEqual(len(working.events), 1)
+        self.assertEqual(hub.stats['failed'], 1)
+        for socket in (broken, working):
+            await hub.unsubscribe('room', socket)
+
+    def test_only_public_channels_use_the_hub(self):
+        self.assertTrue(uses_fanout({'room_type': 'channel', 'is_private': False}))
+        self.assertFalse(uses_fanout({'room_type': 'channel', 'is_private': True}))
+        self.assertFalse(uses_fanout({'room_type': 'group', 'is_private': False}))
+        with self.settings(CHAT_CONFIG=dict(settings.CHAT_CONFIG, FANOUT_CHANNELS=False)):
+            self.assertFalse(uses_fanout({'room_type': 'channel', 'is_private': False}))
+
+
+class QueryCountTests(TestCase):
+    def setUp(self):
+        self.users = make_users(6)
+        self.client = APIClient()
+        self.client.force_authenticate(self.users[0])
+
+    def add_rooms(self, count):
+        for i in range(count):
+            room = make_room(*self.users, name=f'room {i}', room_type='group')
+            for user in self.users[:3]:
+                Message.objects.create(room=room, sender=user, content=f'hello from {user.username}')
+
+    def test_room_list_queries_do_not_grow_with_rooms(self):
+        # count, the annotated page and the participant samples
+        self.add_rooms(3)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('room-list'))
+        self.assertEqual(response.status_code, 200)
+
+        self.add_rooms(5)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('room-list'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_history_page_queries_do_not_grow_with_messages(self):
+        room = make_room(*self.users, room_type='group')
+        for i in range(60):
+            Message.objects.create(room=room, sender=self.users[i % 6], content=f'message {i}')
+        # access check, page, likes, reaction counts, own reactions, archive segments,
+        # room type, read watermarks
+        with self.assertNumQueries(8):
+            response = self.client.get(reverse('message-list', kwargs={'room_id': room.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 50)
+
+
+class ParticipantListTests(TestCase):
+    def test_public_channel_participants_hide_read_state(self):
+        alice, bob, carol = make_users(3)
+        room = make_room(alice, bob, room_type='channel')
+        advance_read_watermark(bob.id, Message.objects.create(room=room, sender=alice, content='hi'))
+        client = APIClient()
+        client.force_authenticate(carol)
+        response = client.get(reverse('room-participants', kwargs={'room_id': room.id}))
+        self.assertEqual(response.status_code, 200)
+        for item in response.data['results']:
+            self.assertEqual(set(item), {'id', 'user', 'role', 'joined_at'})
+            self.assertNotIn('email', item['user'])
+
+    def test_public_channel_history_hides_read_counts(self):
+        alice, bob = make_users(2)
+        channel = make_room(alice, bob, room_type='channel')
+        group = make_room(alice, bob, room_type='group')
+        for room in (channel, group):
+            advance_read_watermark(bob.id, Message.objects.create(room=room, sender=alice, content='hi'))
+        client = APIClient()
+        client.force_authenticate(bob)
+        for room, read_count in ((channel, None), (group, 1)):
+            message, = client.get(reverse('message-list', kwargs={'room_id': room.id})).data['results']
+            self.assertEqual(message['read_count'], read_count)
+            self.assertTrue(message['is_read'])
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.alice, self.bob = make_users(2)
+        self.room = make_room(self.alice, self.bob, room_type='group')
+        self.messages = [
+            Message.objects.create(room=self.room, sender=self.alice, content=f'message {i}') for i in range(5)
+        ]
+        ChatRoom.objects.filter(id=self.room.id).update(last_message=self.messages[-1])
+        self.cutoff = timezone.now() + timedelta(seconds=1)
+
+    def test_archived_messages_count_as_read(self):
+        participants = RoomParticipant.objects.filter(room=self.room)
+        recount_unread(participants)
+        self.assertEqual(archive_room(self.room.id, self.cutoff, 3), 3)
+        bob = participants.get(user=self.bob)
+        self.assertEqual(bob.unread_count, 2)
+        recount_unread(participants)
+        bob.refresh_from_db()
+        self.assertEqual(bob.unread_count, 2)
+
+    def test_archived_uploads_cannot_be_sent_again(self):
+        upload = ChatUpload.objects.create(
+            user=self.alice, room=self.room, filename='a.txt', size=1, received=1,
+            status='complete', file='chat_files/a.txt',
+        )
+        persist_message(self.room.id, self.alice, '', upload_id=upload.id)
+        last = Message.objects.create(room=self.room, sender=self.alice, content='last')
+        ChatRoom.objects.filter(id=self.room.id).update(last_message=last)
+        archive_room(self.room.id, timezone.now() + timedelta(seconds=1), 10)
+        upload.refresh_from_db()
+        self.assertEqual((upload.status, upload.message_id), ('sent', None))
+        with self.assertRaises(UploadUnavailable):
+            persist_message(self.room.id, self.alice, '', upload_id=upload.id)
+
+    def test_locate_does_not_unpack_segments(self):
+        archive_room(self.room.id, self.cutoff, 3)
+        archived = self.messages[1]
+        with self.assertNumQueries(1):
+            located = RoomArchive(self.room.id).locate(archived.id)
+        self.assertEqual(located, (archived.created_at, archived.id))
+        self.assertIsNone(RoomArchive(self.room.id).locate(self.messages[-1].id))
+
+
+
+class SearchQueryTests(SimpleTestCase):
+    def test_postgres_query_matches_the_last_term_as_a_prefix(self):
+        self.assertEqual(ts_query("it's a\\b hel"), "'it''s' & 'a\\\\b' & 'hel':*")
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'the FTS5 index is SQLite only')
+class SearchIndexTests(TransactionTestCase):
+    def setUp(self):
+        self.alice, = make_users(1)
+        self.room = make_room(self.alice, room_type='group')
+
+    def search(self, text):
+        return set(search_messages(Message.objects.all(), text).values_list('content', flat=True))
+
+    def fts_rows(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT COUNT(*) FROM {table}')
+            return cursor.fetchone()[0]
+
+    def test_matches_survive_renumbered_rowids(self):
+        for content in ('hello there', 'general kenobi'):
+            Message.objects.create(room=self.room, sender=self.alice, content=content)
+        # what VACUUM is allowed to do to a table without an INTEGER PRIMARY KEY
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE chats_message SET rowid = -rowid')
+        self.assertEqual(self.search('hel'), {'hello there'})
+        self.assertEqual(self.search('kenobi'), {'general kenobi'})
+
+    def test_edits_and_deletes_update_the_index(self):
+        message = Message.objects.create(room=self.room, sender=self.alice, content='hello there')
+        Message.objects.filter(id=message.id).update(content='goodbye there')
+        self.assertEqual(self.search('hello'), set())
+        self.assertEqual(self.search('goodbye'), {'goodbye there'})
+        message.delete()
+        self.assertEqual(self.search('there'), set())
+
+    def test_deleted_segments_leave_the_archive_index(self):
+        for i in range(3):
+            Message.objects.create(room=self.room, sender=self.alice, content=f'archived {i}')
+        archive_room(self.room.id, timezone.now() + timedelta(seconds=1), 3)
+        self.assertEqual(self.fts_rows(ARCHIVE_FTS_TABLE), 1)
+        self.room.delete()
+        self.assertFalse(MessageArchiveSegment.objects.exists())
+        self.assertEqual(self.fts_rows(ARCHIVE_FTS_TABLE), 0)
+
+    def test_snippets_are_cut_from_the_message(self):
+        Message.objects.create(room=self.room, sender=self.alice, content='say <hello> there')
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        response = client.get(reverse('message-search'), {'q': 'hel'})
+        self.assertEqual([result['snippet'] for result in response.data['results']], ['say &lt;<mark>hel</mark>lo&gt; there'])
+
+    def test_repair_reinstalls_dropped_triggers(self):
+        self.assertFalse(repair_search_index(connection))
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TRIGGER {FTS_TABLE}_ai')
+        self.assertTrue(repair_search_index(connection))
+        Message.objects.create(room=self.room, sender=self.alice, content='hello there')
+        self.assertEqual(self.search('hello'), {'hello there'})
+
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class ReactionBroadcastTests(TransactionTestCase):
+    def setUp(self):
+        coalescing._reactions = None
+        self.addCleanup(setattr, coalescing, '_reactions', None)
+        self.alice, self.bob = make_users(2)
+        self.room = make_room(self.alice, self.bob, room_type='group')
+        self.message = Message.objects.create(room=self.room, sender=self.alice, content='hi')
+        self.layer = get_channel_layer()
+        self.channel = async_to_sync(self.layer.new_channel)()
+        async_to_sync(self.layer.group_add)(f'chat_{self.room.id}', self.channel)
+
+    def receive_totals(self):
+        event = async_to_sync(self.layer.receive)(self.channel)
+        return json.loads(event['text'])['messages']
+
+    def test_http_likes_and_reactions_reach_the_room(self):
+        client = APIClient()
+        client.force_authenticate(self.bob)
+        client.post(reverse('like-message', kwargs={'message_id': self.message.id}))
+        self.assertEqual(self.receive_totals()[0]['likes_count'], 1)
+        client.post(reverse('react-message', kwargs={'message_id': self.message.id}), {'emoji': '👍'})
+        self.assertEqual(self.receive_totals(), [
+            {'message_id': str(self.message.id), 'reactions': {'👍': 1}, 'likes_count': 1},
+        ])
+
+    async def test_changes_from_other_threads_join_one_tick(self):
+        coalescer = coalescing.get_reaction_coalescer()
+        coalescer.interval = 0.05
+        coalescer.attach()
+        for user in (self.alice, self.bob):
+            await asyncio.to_thread(react, self.room.id, self.message.id, user.id, '🎉')
+        event = await asyncio.wait_for(self.layer.receive(self.channel), 2)
+        self.assertEqual(json.loads(event['text'])['messages'][0]['reactions'], {'🎉': 2})
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(self.layer.receive(self.channel), 0.2)
+
+
+class UploadChunkTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(self.settings(MEDIA_ROOT=media.name))
+        user, = make_users(1)
+        self.upload = create_upload(user, make_room(user).id, 'notes.txt', 10, 'text/plain')
+
+    def test_stale_offset_leaves_the_file_alone(self):
+        stale = ChatUpload.objects.get(id=self.upload.id)
+        self.assertEqual(write_chunk(self.upload, 0, io.BytesIO(b'hello')), 5)
+        with self.assertRaises(UploadConflict):
+            write_chunk(stale, 0, io.BytesIO(b'HELLO world'))
+        with open(partial_path(self.upload), 'rb') as part:
+            self.assertEqual(part.read(), b'hello')
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.received, 5)
+
+
+    def test_a_chunk_being_written_holds_the_offset(self):
+        class Stream(io.BytesIO):
+            def read(inner, size=-1):
+                # a second client arriving while the first one's chunk is copied
+                with self.assertRaises(UploadConflict):
+                    write_chunk(ChatUpload.objects.get(id=self.upload.id), 0, io.BytesIO(b'HELLO'))
+                return super().read(size)
+
+        self.assertEqual(write_chunk(self.upload, 0, Stream(b'hello')), 5)
+        with open(partial_path(self.upload), 'rb') as part:
+            self.assertEqual(part.read(), b'hello')
+
+    def test_abandoned_writes_can_be_taken_over(self):
+        ChatUpload.objects.filter(id=self.upload.id).update(
+            status='writing', updated_at=timezone.now() - timedelta(hours=1),
+        )
+        self.assertEqual(write_chunk(ChatUpload.objects.get(id=self.upload.id), 0, io.BytesIO(b'hello')), 5)
+
+    def test_chunks_after_the_last_one_leave_the_file_alone(self):
+        late = ChatUpload.objects.get(id=self.upload.id)
+        late.received = 10
+        self.assertEqual(write_chunk(self.upload, 0, io.BytesIO(b'0123456789')), 10)
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.status, 'complete')
+        with self.assertRaises(UploadConflict):
+            write_chunk(late, 10, io.BytesIO(b'more'))
+        with open(default_storage.path(self.upload.file.name), 'rb') as complete:
+            self.assertEqual(complete.read(), b'0123456789')
+
+# presence flushes also run on the messages pool, kept out of the hop counts
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_LAYERS,
+    CHAT_CONFIG=dict(settings.CHAT_CONFIG, WRITE_BEHIND=False, PRESENCE_BACKEND='local', PRESENCE_FLUSH_INTERVAL=60.0),
+)
+class SendPathTests(TransactionTestCase):
+    def setUp(self):
+        # the process wide tracker, made again with the local store of the override
+        presence._tracker = None
+        self.addCleanup(setattr, presence, '_tracker', None)
+        self.alice, self.bob, self.carol = make_users(3)
+        self.room = make_room(self.alice, self.bob, self.carol, room_type='group')
+
+    def test_save_message_queries(self):
+        # one transaction for seq, INSERT, last message and unread bumps
+        save_message = vars(chatConsumer)['save_message'].func
+        with self.assertNumQueries(9):
+            message, payload = save_message(None, self.room.id, self.alice, 'hi')
+        self.assertEqual(payload['sender']['username'], self.alice.username)
+
+    def test_one_pool_hop_per_message(self):
+        seqs, hops = async_to_sync(self.send_messages)(5)
+        self.assertEqual(hops, 5)
+        self.assertEqual(seqs, [1, 2, 3, 4, 5])
+
+    def test_write_behind_numbers_a_batch_in_one_hop(self):
+        with self.settings(CHAT_CONFIG=dict(
+            settings.CHAT_CONFIG, WRITE_BEHIND=True, PRESENCE_BACKEND='local', PRESENCE_FLUSH_INTERVAL=60.0,
+        )):
+            persistence._write_buffer = MessageWriteBuffer(max_delay=0.5)
+            try:
+                seqs, hops = async_to_sync(self.send_messages)(5, wait_each=False)
+            finally:
+                persistence._write_buffer = None
+        self.assertEqual(hops, 1)
+        self.assertEqual(seqs, [1, 2, 3, 4, 5])
+        self.assertEqual(list(Message.objects.order_by('seq').values_list('seq', flat=True)), seqs)
+
+    def test_room_id_spellings_share_one_subscription(self):
+        async def subscribe_twice():
+            app = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+            socket = WebsocketCommunicator(app, f'/ws/chat/?token={AccessToken.for_user(self.alice)}')
+            await socket.connect()
+            replies = []
+            for room_id in ('{%s}' % str(self.room.id).upper(), f'urn:uuid:{self.room.id}', 'not a room'):
+                await socket.send_json_to({'type': 'subscribe', 'room_id': room_id})
+                replies.append(await socket.receive_json_from(timeout=2))
+            await socket.send_json_to({'type': 'chat_message', 'room_id': str(self.room.id).upper(), 'message': 'hi'})
+            seq = await self.receive_seq(socket)
+            await socket.disconnect()
+            return replies, seq
+
+        replies, seq = async_to_sync(subscribe_twice)()
+        self.assertEqual([reply['type'] for reply in replies], ['subscribed', 'subscribed', 'error'])
+        self.assertEqual({reply['room_id'] for reply in replies[:2]}, {str(self.room.id)})
+        self.assertEqual(seq, 1)
+
+    def test_read_receipts_without_a_message_id_get_an_error(self):
+        async def send_bad_receipts():
+            app = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+            socket = WebsocketCommunicator(app, f'/ws/chat/{self.room.id}/?token={AccessToken.for_user(self.alice)}')
+            await socket.connect()
+            replies = []
+            for receipt in ({'type': 'message_read'}, {'type': 'read_up_to', 'message_id': 'nope'}):
+                await socket.send_json_to(receipt)
+                reply = await socket.receive_json_from(timeout=2)
+                while reply['type'] != 'error':
+                    reply = await socket.receive_json_from(timeout=2)
+                replies.append(reply)
+            await socket.disconnect()
+            return replies
+
+        replies = async_to_sync(send_bad_receipts)()
+        self.assertEqual([reply['error'] for reply in replies], ['Invalid message id'] * 2)
+        self.assertEqual([reply['request_type'] for reply in replies], ['message_read', 'read_up_to'])
+
+    def test_room_updates_reach_members_elsewhere(self):
+        dave, = make_users(1, prefix='dave')
+
+        async def send_with_members_around():
+            app = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+            sockets = {}
+            # alice sends from the room and has a socket elsewhere
+            for name, user, path in (
+                ('sender', self.alice, f'{self.room.id}/'), ('alice', self.alice, ''), ('bob', self.bob, ''),
+                ('carol', self.carol, f'{self.room.id}/'), ('dave', dave, ''),
+            ):
+                sockets[name] = WebsocketCommunicator(app, f'/ws/chat/{path}?token={AccessToken.for_user(user)}')
+                await sockets[name].connect()
+            # joining after connecting, the socket is told to follow the room
+            await database_sync_to_async(self.room.participants.add)(dave)
+            await asyncio.sleep(0.1)
+            await sockets['sender'].send_json_to({'type': 'chat_message', 'message': 'hi @' + self.bob.username})
+            frames = {}
+            for name, socket in sockets.items():
+                frames[name] = []
+                while not await socket.receive_nothing(0.3):
+                    frames[name].append(await socket.receive_json_from())
+                await socket.disconnect()
+            return {
+                name: [frame for frame in received if frame['type'] == 'room_updated']
+                for name, received in frames.items()
+            }
+
+        updates = async_to_sync(send_with_members_around)()
+        self.assertEqual((updates['sender'], updates['alice'], updates['carol']), ([], [], []))
+        bob, = updates['bob']
+        self.assertEqual((bob['new_messages'], bob['mentions']), (1, [self.bob.username]))
+        self.assertEqual(len(updates['dave']), 1)
+
+    def test_msgpack_is_negotiated_per_socket(self):
+        async def send_binary():
+            app = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+            path = f'/ws/chat/{self.room.id}/?token='
+            binary = WebsocketCommunicator(app, path + str(AccessToken.for_user(self.alice)), subprotocols=['chat.msgpack'])
+            text = WebsocketCommunicator(app, path + str(AccessToken.for_user(self.bob)))
+            _, subprotocol = await binary.connect()
+            await text.connect()
+            await binary.send_to(bytes_data=encode_binary_frame('chat_message', message='hi'))
+            while True:
+                frame = decode_binary_frame((await binary.receive_output(timeout=2))['bytes'])
+                if frame['type'] == 'chat_message':
+                    break
+            seq = await self.receive_seq(text)
+            await binary.disconnect()
+            await text.disconnect()
+            return subprotocol, frame, seq
+
+        subprotocol, frame, seq = async_to_sync(send_binary)()
+        self.assertEqual(subprotocol, 'chat.msgpack')
+        self.assertEqual(frame['message']['content'], 'hi')
+        self.assertEqual(seq, frame['message']['seq'])
+        # uuids and timestamps come back typed rather than as strings
+        self.assertIsInstance(frame['message']['id'], uuid.UUID)
+        self.assertIsInstance(frame['message']['created_at'], datetime)
+
+    def test_msgpack_can_be_turned_off(self):
+        async def connect():
+            app = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+            socket = WebsocketCommunicator(
+                app, f'/ws/chat/{self.room.id}/?token={AccessToken.for_user(self.alice)}', subprotocols=['chat.msgpack'],
+            )
+            connected, subprotocol = await socket.connect()
+            await socket.disconnect()
+            return connected, subprotocol
+
+        with self.settings(CHAT_CONFIG=dict(settings.CHAT_CONFIG, BINARY_FRAMES=False)):
+            connected, subprotocol = async_to_sync(connect)()
+        self.assertTrue(connected)
+        self.assertIsNone(subprotocol)
+
+    def test_public_channel_sockets_share_one_hub_channel(self):
+        channel_room = make_room(self.alice, self.bob, room_type='channel')
+
+        async def send_to_channel():
+            fanout._fanout_hub = None
+            app = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+            sockets = []
+            for user in (self.alice, self.bob, self.bob):
+                socket = WebsocketCommunicator(app, f'/ws/chat/{channel_room.id}/?token={AccessToken.for_user(user)}')
+                await socket.connect()
+                sockets.append(socket)
+            hub = fanout.get_fanout_hub()
+            channels = len(hub.channels)
+            await sockets[0].send_json_to({'type': 'chat_message', 'message': 'hello'})
+            seqs = [await self.receive_seq(socket) for socket in sockets]
+            for socket in sockets:
+                await socket.disconnect()
+            return channels, seqs, hub.channels
+
+        self.addCleanup(setattr, fanout, '_fanout_hub', None)
+        channels, seqs, left = async_to_sync(send_to_channel)()
+        self.assertEqual(channels, 1)
+        self.assertEqual(seqs, [1, 1, 1])
+        self.assertEqual(left, {})
+
+    async def send_messages(self, count, wait_each=True):
+        '''Seqs of the broadcasts of count messages and the messages pool calls they took'''
+        app = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+        socket = WebsocketCommunicator(app, f'/ws/chat/{self.room.id}/?token={AccessToken.for_user(self.alice)}')
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+        pool = get_db_executor('messages')
+        before = pool.snapshot()['submitted']
+        seqs = []
+        for i in range(count):
+            await socket.send_json_to({'type': 'chat_message', 'message': f'message {i}'})
+            if wait_each:
+                seqs.append(await self.receive_seq(socket))
+        while len(seqs) < count:
+            seqs.append(await self.receive_seq(socket))
+        hops = pool.snapshot()['submitted'] - before
+        await socket.disconnect()
+        return seqs, hops
+
+    async def receive_seq(self, socket):
+        while True:
+            frame = await socket.receive_json_from(timeout=2)
+            if frame['type'] == 'chat_message':
+                return frame['message']['seq']
@@ -0,0 +1,225 @@
+'''Resumable chunked uploads of chat attachments
+
+A client creates a ChatUpload with the file's name and size, then sends
+the bytes in order with PATCH requests carrying an Upload-Offset header.
+Each chunk is streamed from the request onto the end of a partial file
+under MEDIA_ROOT/chat_files/partial/, so a dropped connection resumes from
+the stored offset and no file is ever held in memory.
+
+Once the last byte arrives the file moves to chat_files/<upload id>/ and
+images are handed to the media process pool, which writes a WebP preview
+and a BlurHash placeholder (chats.imaging). The upload is then sent as a
+message with the chat_message websocket frame's upload_id.
+'''
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, connection
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+
+from .imaging import make_preview
+from .models import ChatUpload
+from .utils import chat_config
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = 'chat_files'
+READ_SIZE = 64 * 1024
+
+
+class UploadConflict(Exception):
+    '''A chunk that doesn't start at the upload's current offset'''
+
+class UploadUnavailable(Exception):
+    '''An upload that isn't complete, isn't the sender's or was sent already'''
+
+
+_media_pool = None
+
+def get_media_pool():
+    '''Process wide pool for CPU bound media work, created on first use
+
+    Workers are spawned rather than forked so they don't inherit the
+    server's event loop, threads and database connections.
+    '''
+    global _media_pool
+    if _media_pool is None:
+        _media_pool = ProcessPoolExecutor(
+            max_workers=chat_config('MEDIA_WORKERS'),
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+    return _media_pool
+
+def on_own_thread(record, *args):
+    '''A done callback calling record(*args, future) on a thread of its own
+
+    Done callbacks run on the pool's management thread, or straight away on
+    the caller's thread when the future already finished, so the database
+    work and the closing of its connection can't happen there.
+    '''
+    return lambda future: threading.Thread(target=record, args=(*args, future)).start()
+
+
+def partial_path(upload):
+    return default_storage.path(f'{UPLOAD_DIR}/partial/{upload.id}.part')
+
+def create_upload(user, room_id, filename, size, content_type=''):
+    '''Registering an upload and creating its empty partial file'''
+    upload = ChatUpload.objects.create(
+        user=user,
+        room_id=room_id,
+        filename=os.path.basename(filename)[:255],
+        size=size,
+        content_type=content_type[:100],
+    )
+    path = partial_path(upload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    return upload
+
+def write_chunk(upload, offset, stream):
+    '''Appending the bytes of stream at offset, returns the new offset
+
+    The offset is claimed before the file is touched by moving the upload
+    to 'writing' with an UPDATE conditioned on it, so of two clients
+    resuming the same upload one gets UploadConflict and leaves the file
+    alone. The chunk is written outside any transaction, SQLite would
+    otherwise hold its write lock for the whole copy, and the new offset is
+    only stored if the claim is still ours. The last chunk moves the upload
+    straight to 'processing', so no PATCH can reach the file once
+    finish_upload moves it. Bytes beyond the declared size are not written.
+    '''
+    if upload.status not in ('uploading', 'writing') or offset != upload.received:
+        raise UploadConflict()
+
+    # the claim's timestamp is its token, a write abandoned for UPLOAD_CLAIM_TIMEOUT can be taken over
+    claimed_at = timezone.now()
+    abandoned = claimed_at - timedelta(seconds=chat_config('UPLOAD_CLAIM_TIMEOUT'))
+    if not ChatUpload.objects.filter(
+        Q(status='uploading') | Q(status='writing', updated_at__lt=abandoned), id=upload.id, received=offset,
+    ).update(status='writing', updated_at=claimed_at):
+        raise UploadConflict()
+    claim = ChatUpload.objects.filter(id=upload.id, status='writing', received=offset, updated_at=claimed_at)
+
+    written = 0
+    try:
+        with open(partial_path(upload), 'r+b') as part:
+            part.seek(offset)
+            part.truncate()
+            while stream is not None and offset + written < upload.size:
+                data = stream.read(min(READ_SIZE, upload.size - offset - written))
+                if not data:
+                    break
+                part.write(data)
+                written += len(data)
+    except BaseException:
+        # what made it to the file is truncated away by the next chunk
+        claim.update(status='uploading')
+        raise
+
+    received = offset + written
+    status = 'processing' if received == upload.size else 'uploading'
+    if not claim.update(status=status, received=received, updated_at=timezone.now()):
+        raise UploadConflict()
+    upload.received, upload.status = received, status
+    if status == 'processing':
+        finish_upload(upload)
+    return received
+
+def finish_upload(upload):
+    '''Moving the complete file into place and making an image's preview
+
+    Previews that take longer than UPLOAD_PROCESSING_WAIT are finished in
+    the background, the upload stays 'processing' until then.
+    '''
+    folder = f'{UPLOAD_DIR}/{upload.id}'
+    name = f'{folder}/{get_valid_filename(upload.filename) or "file"}'
+    os.makedirs(default_storage.path(folder), exist_ok=True)
+    shutil.move(partial_path(upload), default_storage.path(name))
+
+    upload.file.name = name
+    upload.meta = {
+        'name': upload.filename,
+        'size': upload.size,
+        'content_type': upload.content_type,
+        'url': default_storage.url(name),
+    }
+    if not upload.content_type.startswith('image/'):
+        upload.status = 'complete'
+        upload.save(update_fields=['file', 'meta', 'status', 'updated_at'])
+        return
+
+    upload.status = 'processing'
+    upload.save(update_fields=['file', 'meta', 'status', 'updated_at'])
+    preview = f'{folder}/preview.webp'
+    future = get_media_pool().submit(
+        make_preview, default_storage.path(name), default_storage.path(preview), chat_config('THUMBNAIL_SIZE'),
+    )
+    try:
+        result = future.result(timeout=chat_config('UPLOAD_PROCESSING_WAIT'))
+    except TimeoutError:
+        future.add_done_callback(on_own_thread(record_preview_in_background, upload, preview))
+        return
+    except Exception:
+        logger.exception('Preview of upload %s failed', upload.id)
+        result = None
+    record_preview(upload, preview, result)
+
+def record_preview(upload, preview, result):
+    # images Pillow can't read are still sent, as plain files
+    if result is not None:
+        upload.meta.update(
+            width=result['width'],
+            height=result['height'],
+            preview={
+                'url': default_storage.url(preview),
+                'width': result['preview_width'],
+                'height': result['preview_height'],
+            },
+            blurhash=result['blurhash'],
+        )
+    upload.status = 'complete'
+    upload.save(update_fields=['meta', 'status', 'updated_at'])
+
+def record_preview_in_background(upload, preview, future):
+    # runs on a thread of its own, see on_own_thread, so the connection it opens is its to close
+    close_old_connections()
+    try:
+        result = future.result()
+    except Exception:
+        logger.exception('Preview of upload %s failed', upload.id)
+        result = None
+    try:
+        record_preview(upload, preview, result)
+    except Exception:
+        logger.exception('Could not record the preview of upload %s', upload.id)
+    finally:
+        connection.close()
+
+def upload_state(upload):
+    '''What clients see of an upload, enough to resume it'''
+    return {
+        'id': upload.id,
+        'room_id': upload.room_id,
+        'filename': upload.filename,
+        'size': upload.size,
+        'offset': upload.received,
+        'chunk_size': chat_config('UPLOAD_CHUNK_SIZE'),
+        'status': upload.status,
+        'attachment': upload.meta if upload.status in ('complete', 'sent') else None,
+    }
+
+def attach_upload(message, upload):
+    '''Making message carry a completed upload, image uploads with a preview become image messages'''
+    message.file = upload.file.name
+    message.attachment_meta = upload.meta
+    message.message_type = 'image' if 'preview' in upload.meta else 'file'
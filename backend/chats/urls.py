@@ -4,7 +4,13 @@ from . import views
 urlpatterns = [
     path('rooms/', views.ChatRoomListCreateView.as_view(), name='room-list') ,
     path('rooms/<uuid:pk>/', views.ChatRoomDetailView.as_view(), name='room-detail') ,
+    path('rooms/<uuid:room_id>/participants/', views.RoomParticipantListView.as_view(), name='room-participants'),
+    path('rooms/<uuid:room_id>/search/', views.MessageSearchView.as_view(), name='room-message-search'),
     path('rooms/<uuid:room_id>/messages/', views.MessageListCreateView.as_view(), name='message-list'),
+    path('messages/search/', views.MessageSearchView.as_view(), name='message-search'),
     path('messages/<uuid:message_id>/read/',views.mark_message_read, name='mark-read'),
     path('messages/<uuid:message_id>/like/', views.like_message, name='like-message'),
+    path('messages/<uuid:message_id>/react/', views.react_message, name='react-message'),
+    path('uploads/', views.start_upload, name='upload-start'),
+    path('uploads/<uuid:upload_id>/', views.upload_detail, name='upload-detail'),
 ]
\ No newline at end of file
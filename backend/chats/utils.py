@@ -0,0 +1,74 @@
+from django.conf import settings
+from django.db.models import F, Func, Subquery
+
+
+CHAT_DEFAULTS = {
+    # write-behind message persistence, off as it delays broadcasts until the batch commits
+    'WRITE_BEHIND': False,
+    'WRITE_BEHIND_MAX_BATCH': 100,
+    'WRITE_BEHIND_MAX_DELAY': 0.05,
+
+    # connection refcounted presence
+    'PRESENCE_BACKEND': 'local',
+    'PRESENCE_REDIS_URL': 'redis://127.0.0.1:6379/0',
+    'PRESENCE_TTL': 60.0,
+    'PRESENCE_FLUSH_INTERVAL': 2.0,
+
+    # coalesced typing indicators
+    'TYPING_INTERVAL': 0.5,
+    'TYPING_TTL': 5.0,
+
+    # multiplexed connections
+    'MAX_ROOMS_PER_CONNECTION': 200,
+
+    # per-connection outbound buffering
+    'OUTBOUND_QUEUE_SIZE': 500,
+    'OUTBOUND_WINDOW': 100,
+    'OUTBOUND_MAX_BYTES': 4 * 1024 * 1024,
+
+    # msgpack subprotocol, needs the msgpack package
+    'BINARY_FRAMES': True,
+
+    # reconnect catch-up by sequence number
+    'REPLAY_LIMIT': 500,
+
+    # batched reaction count broadcasts
+    'REACTION_INTERVAL': 1.0,
+
+    # cold storage of old messages, see the archive_messages command
+    'ARCHIVE_AFTER_DAYS': 365,
+    'ARCHIVE_SEGMENT_SIZE': 500,
+
+    # participants embedded per room in the room list
+    'PARTICIPANT_SAMPLE_SIZE': 5,
+
+    # resumable attachment uploads and their previews
+    'UPLOAD_MAX_SIZE': 50 * 1024 * 1024,
+    'UPLOAD_CHUNK_SIZE': 1024 * 1024,
+    'UPLOAD_PROCESSING_WAIT': 2.0,
+    'UPLOAD_CLAIM_TIMEOUT': 300.0,
+    'MEDIA_WORKERS': 2,
+    'THUMBNAIL_SIZE': 320,
+
+    # room_updated frames on the per-room update topics
+    'ROOM_UPDATE_MAX_PARTICIPANTS': 1000,
+    'ROOM_UPDATE_PREVIEW_LENGTH': 100,
+
+    # per-process fan-out of public channel rooms
+    'FANOUT_CHANNELS': True,
+    'FANOUT_REFRESH_INTERVAL': 3600.0,
+
+    # thread pools of the sockets' database work
+    'DB_WORKERS': 8,
+    'DB_HISTORY_WORKERS': 4,
+    'DB_SATURATION_WARNING': 0.25,
+}
+
+def chat_config(key):
+    '''Reading a chat setting from CHAT_CONFIG falling back to CHAT_DEFAULTS'''
+    return getattr(settings, 'CHAT_CONFIG', {}).get(key, CHAT_DEFAULTS[key])
+
+def count_subquery(queryset):
+    '''COUNT(*) of queryset as a subquery expression, 0 when nothing matches'''
+    # a bare COUNT without GROUP BY, so it yields 0 rather than no row
+    return Subquery(queryset.order_by().values(count=Func(F('pk'), function='COUNT')))
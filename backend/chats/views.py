@@ -1,23 +1,65 @@
+import uuid
+
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.shortcuts import render
-from django.db.models import Q
+from django.db.models import OuterRef, Prefetch, Q, Subquery
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 
 from rest_framework import generics, status, permissions
 from rest_framework.decorators import permission_classes, api_view
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 
-from .models import ChatRoom, Message 
-from .serializers import ChatRoomSerializer, MessageSerializer, RoomParticipantsSerializer
+from .archive import RoomArchive, search_archive
+from .models import ChatRoom, ChatUpload, Message, RoomParticipant
+from .notifications import send_room_update
+from .pagination import MessageCursorPagination, SearchCursorPagination
+from .persistence import serialize_message
+from .reactions import like, react, reaction_counts, valid_emoji
+from .receipts import advance_read_watermark
+from .search import search_messages
+from .serializers import (
+    ChatRoomListSerializer, ChatRoomSerializer, MessageSearchSerializer, MessageSerializer,
+    RoomParticipantsSerializer, annotate_messages,
+)
+from .uploads import UploadConflict, create_upload, upload_state, write_chunk
+from .utils import chat_config, count_subquery
+
+from users.models import User
 
 class ChatRoomListCreateView(generics.ListCreateAPIView):
     serializer_class= ChatRoomSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    def get_serializer_class(self):
+        if self.request.method == 'GET':
+            return ChatRoomListSerializer
+        return ChatRoomSerializer
+
     def get_queryset(self):
         # return ChatRoom.objects.all()
+        # the caller's participant row, for the counters and role read along with the rooms
+        mine = RoomParticipant.objects.filter(room=OuterRef('pk'), user=self.request.user)
         return ChatRoom.objects.filter(
             Q(participants=self.request.user) |
             Q(room_type='channel',is_private=False)
-        ).distinct()
+        ).distinct().select_related('created_by', 'last_message__sender').annotate(
+            my_unread_count=Subquery(mine.values('unread_count')[:1]),
+            my_role=Subquery(mine.values('role')[:1]),
+            participant_count=count_subquery(
+                ChatRoom.participants.through.objects.filter(chatroom_id=OuterRef('pk'))
+            ),
+        ).prefetch_related(
+            # online members first, one windowed query for the whole page
+            Prefetch(
+                'participants',
+                queryset=User.objects.only('id', 'username', 'avatar', 'avatar_renditions', 'is_online')
+                .order_by('-is_online', 'username')[:chat_config('PARTICIPANT_SAMPLE_SIZE')],
+                to_attr='participant_sample',
+            )
+        )
     
     def perform_create(self, serializer):
         room = serializer.save(created_by=self.request.user) 
@@ -28,16 +70,47 @@ class ChatRoomDetailView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return ChatRoom.objects.filter(participants=self.request.user)
+        return ChatRoom.objects.filter(participants=self.request.user).select_related('last_message__sender')
+
+class RoomParticipantListView(generics.ListAPIView):
+    serializer_class = RoomParticipantsSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        # participants of rooms the caller is in, or of public channels
+        room = generics.get_object_or_404(
+            ChatRoom.objects.filter(
+                Q(participants=self.request.user) |
+                Q(room_type='channel', is_private=False)
+            ).distinct(),
+            id=self.kwargs['room_id'],
+        )
+        return (
+            RoomParticipant.objects
+            .filter(room=room)
+            .select_related('user')
+            .order_by('joined_at', 'id')
+        )
 
 class MessageListCreateView(generics.ListCreateAPIView):
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessageCursorPagination
 
     def get_queryset(self):
         room_id = self.kwargs['room_id']
         print(room_id)
-        return Message.objects.filter(room_id=room_id, room__participants = self.request.user) 
+        return annotate_messages(
+            Message.objects.filter(room_id=room_id, room__participants = self.request.user),
+            self.request.user,
+        )
+
+    def get_archive(self):
+        # older history lives in archive segments, merged in by the paginator
+        room_id = self.kwargs['room_id']
+        if ChatRoom.objects.filter(id=room_id, participants=self.request.user).exists():
+            return RoomArchive(room_id)
+        return None
     
     def perform_create(self, serializer):
         print("creating message")
@@ -46,14 +119,47 @@ class MessageListCreateView(generics.ListCreateAPIView):
         message = serializer.save(sender=self.request.user, room=room)
         print(message)
         # mark message as read by sender
-        message.read_by.add(self.request.user)
+        advance_read_watermark(self.request.user.id, message)
+        # members elsewhere get the room's preview
+        async_to_sync(send_room_update)(get_channel_layer(), room.id, serialize_message(message))
+
+class MessageSearchView(generics.ListAPIView):
+    serializer_class = MessageSearchSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = SearchCursorPagination
+
+    def get_queryset(self):
+        text = self.request.query_params.get('q', '').strip()
+        if not text:
+            raise ValidationError({'q': 'A search term is required'})
+
+        return search_messages(
+            Message.objects.filter(room_id__in=self.get_room_ids()).select_related('sender'), text
+        )
+
+    def get_room_ids(self):
+        # only rooms the caller takes part in, one of them when scoped
+        rooms = ChatRoom.objects.filter(participants=self.request.user)
+        room_id = self.kwargs.get('room_id') or self.request.query_params.get('room')
+        if room_id:
+            try:
+                rooms = rooms.filter(id=uuid.UUID(str(room_id)))
+            except ValueError:
+                raise ValidationError({'room': 'Invalid room id'})
+        return list(rooms.values_list('id', flat=True))
+
+    def search_archive(self, before, limit):
+        # archived matches, merged with the live ones by the paginator
+        return search_archive(
+            self.get_room_ids(), self.request.query_params['q'].strip(), before=before, limit=limit
+        )
 
 @api_view(["POST"])
 @permission_classes([permissions.IsAuthenticated])
 def mark_message_read(request, message_id):
     try:
         message = Message.objects.get(id=message_id, room__participants = request.user)
-        message.read_by.add(request.user)
+        advance_read_watermark(request.user.id, message)
         return Response({'status': 'success'})
     except Message.DoesNotExist:
         return Response({'error': 'Message not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -62,16 +168,72 @@ def mark_message_read(request, message_id):
 @permission_classes([permissions.IsAuthenticated])
 def like_message(request, message_id):
     try:
-        message = Message.objects.get(id=message_id, room__participants=request.user)
-        if message.likes.filter(id=request.user.id).exists():
-            message.likes.remove(request.user)
-            liked = False
-        else:
-            message.likes.add(request.user)
-            liked = True
-
-        return Response({'liked': liked, 'likes_count': message.likes.count()})    
+        message = Message.objects.only('id', 'room_id').get(id=message_id, room__participants=request.user)
+        liked, likes_count = like(message.room_id, message.id, request.user.id)
+
+        return Response({'liked': liked, 'likes_count': likes_count})    
     except Message.DoesNotExist:
         return Response({'error': 'Message not found'}, status=status.HTTP_404_NOT_FOUND)
-    
-    
\ No newline at end of file
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def react_message(request, message_id):
+    emoji = request.data.get('emoji')
+    if not valid_emoji(emoji):
+        return Response({'error': 'Invalid emoji'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        message = Message.objects.only('id', 'room_id').get(id=message_id, room__participants=request.user)
+        reacted, _ = react(message.room_id, message.id, request.user.id, emoji)
+        counts = reaction_counts([message.id])[message.id]
+
+        return Response({'emoji': emoji, 'reacted': reacted, 'reactions': counts})
+    except Message.DoesNotExist:
+        return Response({'error': 'Message not found'}, status=status.HTTP_404_NOT_FOUND)
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def start_upload(request):
+    # {room_id, filename, size, content_type}, the bytes follow with PATCH requests
+    try:
+        size = int(request.data.get('size'))
+        room = ChatRoom.objects.only('id').get(id=request.data.get('room_id'), participants=request.user)
+    except (TypeError, ValueError, DjangoValidationError):
+        return Response({'error': 'room_id and size are required'}, status=status.HTTP_400_BAD_REQUEST)
+    except ChatRoom.DoesNotExist:
+        return Response({'error': 'Room not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    filename = str(request.data.get('filename') or '').strip()
+    if not filename:
+        return Response({'error': 'filename is required'}, status=status.HTTP_400_BAD_REQUEST)
+    if not 0 < size <= chat_config('UPLOAD_MAX_SIZE'):
+        return Response({'error': 'File is empty or too large'}, status=status.HTTP_400_BAD_REQUEST)
+
+    upload = create_upload(request.user, room.id, filename, size, str(request.data.get('content_type') or ''))
+    return Response(upload_state(upload), status=status.HTTP_201_CREATED)
+
+@api_view(['GET', 'PATCH'])
+@permission_classes([permissions.IsAuthenticated])
+def upload_detail(request, upload_id):
+    '''GET reports how far an upload got, PATCH appends the request body at Upload-Offset
+
+    The body is read from the request stream in small pieces rather than
+    parsed, a 409 carries the offset to resume from.
+    '''
+    try:
+        upload = ChatUpload.objects.get(id=upload_id, user=request.user)
+    except ChatUpload.DoesNotExist:
+        return Response({'error': 'Upload not found'}, status=status.HTTP_404_NOT_FOUND)
+    if request.method == 'GET':
+        return Response(upload_state(upload))
+
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        return Response({'error': 'Upload-Offset header is required'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        write_chunk(upload, offset, request.stream)
+    except UploadConflict:
+        upload.refresh_from_db()
+        return Response(upload_state(upload), status=status.HTTP_409_CONFLICT)
+    return Response(upload_state(upload))
+
@@ -0,0 +1,104 @@
+import copy
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.conf import settings
+
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+
+class TokenUserCache:
+    '''LRU + TTL cache mapping a verified JWT to a snapshot of its user
+
+    Entries live until the earlier of the token's exp claim and ttl seconds
+    after caching, and are dropped when the user row changes (see
+    users.signals). Invalidation is per process, other workers keep their
+    snapshot at most ttl seconds.
+    '''
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.tokens_by_user = {}
+        self.lock = threading.Lock()
+
+    def get(self, token):
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None:
+                return None
+            expires_at, user = entry
+            if expires_at <= time.time():
+                self.remove(token)
+                return None
+            self.entries.move_to_end(token)
+        # handing out copies so callers can't mutate the cached snapshot
+        return copy.copy(user)
+
+    def set(self, token, user, exp=None):
+        expires_at = time.time() + self.ttl
+        if exp is not None:
+            expires_at = min(expires_at, exp)
+
+        with self.lock:
+            self.remove(token)
+            self.entries[token] = (expires_at, copy.copy(user))
+            self.tokens_by_user.setdefault(user.pk, set()).add(token)
+            while len(self.entries) > self.max_size:
+                self.remove(next(iter(self.entries)))
+
+    def invalidate_user(self, user_id):
+        with self.lock:
+            for token in self.tokens_by_user.pop(user_id, ()):
+                self.entries.pop(token, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tokens_by_user.clear()
+
+    def remove(self, token):
+        # caller holds the lock
+        entry = self.entries.pop(token, None)
+        if entry is None:
+            return
+        user_id = entry[1].pk
+        tokens = self.tokens_by_user.get(user_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self.tokens_by_user[user_id]
+
+
+_config = getattr(settings, 'AUTH_TOKEN_CACHE', {})
+token_user_cache = TokenUserCache(
+    max_size=_config.get('MAX_SIZE', 10000),
+    ttl=_config.get('TTL', 300),
+)
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    '''JWTAuthentication serving the user lookup from token_user_cache'''
+
+    def authenticate(self, request):
+        header = self.get_header(request)
+        if header is None:
+            return None
+
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        # the signature and expiry are still checked on every request,
+        # only the users table lookup is cached
+        validated_token = self.get_validated_token(raw_token)
+        token = raw_token.decode() if isinstance(raw_token, bytes) else raw_token
+
+        user = token_user_cache.get(token)
+        if user is None:
+            user = self.get_user(validated_token)
+            token_user_cache.set(token, user, validated_token.get('exp'))
+        return user, validated_token
@@ -0,0 +1,85 @@
+'''Precomputed avatar sizes
+
+A new avatar is resized once, in the media process pool, into square WebP
+and JPEG renditions named by a hash of their bytes. Their URLs are kept on
+User.avatar_renditions along with the avatar they were made from, so
+serializers pick the small one without asking storage for anything.
+'''
+import logging
+import os
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, connection
+
+from chats.imaging import make_renditions
+from chats.uploads import get_media_pool, on_own_thread
+
+from .authentication import token_user_cache
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+_config = getattr(settings, 'AVATAR_RENDITIONS', {})
+SIZES = tuple(_config.get('SIZES', (32, 64, 128, 256)))
+SMALL_SIZE = _config.get('SMALL_SIZE', 64)
+QUALITY = _config.get('QUALITY', 80)
+
+
+def avatar_url(user, size=SMALL_SIZE, format='webp'):
+    '''URL of the user's avatar at size, the original until its renditions are made'''
+    if not user.avatar:
+        return None
+    renditions = user.avatar_renditions or {}
+    if renditions.get('source') == user.avatar.name:
+        url = renditions['sizes'].get(str(size), {}).get(format)
+        if url:
+            return url
+    return user.avatar.url
+
+def rendition_folder(user_id):
+    return f'avatars/renditions/{user_id}'
+
+def render_avatar(user, wait=False):
+    '''Making renditions of the user's current avatar in the media pool
+
+    Recorded on a thread of its own, or before returning with wait.
+    '''
+    source, folder = user.avatar.name, rendition_folder(user.pk)
+    future = get_media_pool().submit(
+        make_renditions, default_storage.path(source), default_storage.path(folder), SIZES, QUALITY,
+    )
+    if wait:
+        record_renditions(user.pk, source, folder, future.result())
+        return
+    future.add_done_callback(on_own_thread(record_renditions_in_background, user.pk, source, folder))
+
+def record_renditions(user_id, source, folder, renditions):
+    '''Storing rendition URLs unless the avatar changed meanwhile, then dropping older files'''
+    urls = {
+        'source': source,
+        'sizes': {
+            str(size): {key: default_storage.url(f'{folder}/{name}') for key, name in files.items()}
+            for size, files in renditions.items()
+        },
+    }
+    # update() skips post_save, so this doesn't schedule another render
+    if not User.objects.filter(pk=user_id, avatar=source).update(avatar_renditions=urls):
+        return
+    token_user_cache.invalidate_user(user_id)
+
+    keep = {name for files in renditions.values() for name in files.values()}
+    path = default_storage.path(folder)
+    for name in os.listdir(path):
+        if name not in keep:
+            os.remove(os.path.join(path, name))
+
+def record_renditions_in_background(user_id, source, folder, future):
+    # runs on a thread of its own, see on_own_thread, so the connection it opens is its to close
+    close_old_connections()
+    try:
+        record_renditions(user_id, source, folder, future.result())
+    except Exception:
+        logger.exception('Could not make avatar renditions of user %s', user_id)
+    finally:
+        connection.close()
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from users.avatars import render_avatar
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = 'Makes the resized avatar copies of users whose avatar has none yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Render every avatar again, not only missing ones')
+
+    def handle(self, *args, **options):
+        users = User.objects.exclude(avatar='').only('id', 'avatar', 'avatar_renditions')
+        rendered = failed = 0
+        for user in users.iterator(chunk_size=200):
+            if not options['all'] and user.avatar_renditions.get('source') == user.avatar.name:
+                continue
+            try:
+                render_avatar(user, wait=True)
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f'{user.pk}: {e}')
+                continue
+            rendered += 1
+
+        self.stdout.write(f'{rendered} avatars rendered, {failed} failed')
@@ -8,6 +8,8 @@ class User(AbstractUser):
     email = models.EmailField(unique=True)
     phone = models.CharField(max_length=20, blank=True, null=True)
     avatar = models.ImageField(upload_to='avatars/', blank=True, null=False)
+    # URLs of the avatar's resized copies, see users.avatars
+    avatar_renditions = models.JSONField(default=dict, blank=True)
     bio = models.TextField(max_length=500, blank=True)
     is_verified = models.BooleanField(default=False)
     is_online = models.BooleanField(default=False)
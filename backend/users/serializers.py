@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
+from .avatars import avatar_url
 from .models import User, UserProfile
 
 class UserProfileSerializer(serializers.ModelSerializer): 
@@ -10,13 +11,30 @@ class UserProfileSerializer(serializers.ModelSerializer):
 
 class UserSerializer(serializers.ModelSerializer):
     profile = UserProfileSerializer(read_only=True)
+    avatar_small = serializers.SerializerMethodField()
 
     class Meta:
         model = User
         fields = ('id', 'username', 'email', 'first_name', 'last_name',
-                  'avatar', 'bio', 'is_online', 'last_seen', 'profile'
+                  'avatar', 'avatar_small', 'avatar_renditions', 'bio', 'is_online', 'last_seen', 'profile'
                   )
-        read_only_fields = ('id', 'is_online', 'last_seen')
+        read_only_fields = ('id', 'is_online', 'last_seen', 'avatar_renditions')
+
+    def get_avatar_small(self, obj):
+        return avatar_url(obj)
+
+class UserSummarySerializer(serializers.ModelSerializer):
+    # just enough to render an avatar, for lists embedding many users
+    avatar = serializers.SerializerMethodField()
+
+    class Meta:
+        model = User
+        fields = ('id', 'username', 'avatar', 'is_online')
+        read_only_fields = fields
+
+    def get_avatar(self, obj):
+        # the small rendition, list entries never show more
+        return avatar_url(obj)
 
 class UserRegistrationSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, validators=[validate_password])
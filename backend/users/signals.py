@@ -0,0 +1,29 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .authentication import token_user_cache
+from .avatars import render_avatar
+from .models import User
+
+# presence bookkeeping, not worth dropping cached auth snapshots for
+VOLATILE_FIELDS = {'is_online', 'last_seen'}
+
+
+@receiver(post_save, sender=User)
+def invalidate_cached_tokens(sender, instance, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= VOLATILE_FIELDS:
+        return
+    token_user_cache.invalidate_user(instance.pk)
+
+@receiver(post_delete, sender=User)
+def drop_cached_tokens(sender, instance, **kwargs):
+    token_user_cache.invalidate_user(instance.pk)
+
+@receiver(post_save, sender=User)
+def render_new_avatar(sender, instance, update_fields=None, **kwargs):
+    if update_fields and 'avatar' not in update_fields:
+        return
+    if instance.avatar and (instance.avatar_renditions or {}).get('source') != instance.avatar.name:
+        # the file is only certain to be there once the row is committed
+        transaction.on_commit(lambda: render_avatar(instance))
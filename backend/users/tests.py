@@ -1,3 +1,143 @@
+import io
+import os
+import tempfile
+import time
+
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from PIL import Image
+
+from .authentication import TokenUserCache, token_user_cache
+from .avatars import SIZES, SMALL_SIZE, avatar_url, record_renditions, render_avatar, rendition_folder
+from .models import User
+
+
+class TokenUserCacheTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', email='alice@example.com', password='pass')
+        self.bob = User.objects.create_user(username='bob', email='bob@example.com', password='pass')
+
+    def test_entries_expire_with_the_token_or_the_ttl(self):
+        cache = TokenUserCache(ttl=300)
+        cache.set('fresh', self.alice)
+        cache.set('expiring', self.alice, exp=time.time() - 1)
+        self.assertEqual(cache.get('fresh').pk, self.alice.pk)
+        self.assertIsNone(cache.get('expiring'))
+
+        cache = TokenUserCache(ttl=0)
+        cache.set('fresh', self.alice)
+        self.assertIsNone(cache.get('fresh'))
+        self.assertEqual(cache.tokens_by_user, {})
+
+    def test_least_recently_used_entries_go_first(self):
+        cache = TokenUserCache(max_size=2)
+        cache.set('a', self.alice)
+        cache.set('b', self.bob)
+        cache.get('a')
+        cache.set('c', self.bob)
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.tokens_by_user, {self.alice.pk: {'a'}, self.bob.pk: {'c'}})
+
+    def test_callers_get_copies(self):
+        cache = TokenUserCache()
+        cache.set('a', self.alice)
+        cache.get('a').username = 'mallory'
+        self.assertEqual(cache.get('a').username, 'alice')
+
+    def test_api_requests_skip_the_user_lookup_until_the_user_changes(self):
+        token_user_cache.clear()
+        self.addCleanup(token_user_cache.clear)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.alice)}')
+
+        with CaptureQueriesContext(connection) as first:
+            self.assertEqual(client.get(reverse('profile')).status_code, 200)
+        with CaptureQueriesContext(connection) as second:
+            self.assertEqual(client.get(reverse('profile')).status_code, 200)
+        self.assertEqual(len(second), len(first) - 1)
+
+        # presence updates keep the snapshot, anything else drops it
+        self.alice.is_online = True
+        self.alice.save(update_fields=['is_online'])
+        self.assertIn(self.alice.pk, token_user_cache.tokens_by_user)
+        self.alice.first_name = 'Alice'
+        self.alice.save()
+        self.assertNotIn(self.alice.pk, token_user_cache.tokens_by_user)
+        self.assertEqual(client.get(reverse('profile')).data['first_name'], 'Alice')
+
+
+def image_upload(name, color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (300, 200), color).save(buffer, 'PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+class AvatarRenditionTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(self.settings(MEDIA_ROOT=media.name))
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='pass')
+
+    def set_avatar(self, name, color):
+        # the signal renders on commit, which a TestCase never reaches
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.user.avatar = image_upload(name, color)
+            self.user.save()
+        self.assertEqual(len(callbacks), 1)
+
+    def render(self):
+        render_avatar(self.user, wait=True)
+        self.user.refresh_from_db()
+
+    def rendition_files(self):
+        return set(os.listdir(default_storage.path(rendition_folder(self.user.pk))))
+
+    def test_serializers_get_the_small_rendition_once_made(self):
+        self.set_avatar('alice.png', 'red')
+        self.assertEqual(avatar_url(self.user), self.user.avatar.url)
+
+        self.render()
+        self.assertEqual(set(self.user.avatar_renditions['sizes']), {str(size) for size in SIZES})
+        url = avatar_url(self.user)
+        self.assertIn('/avatars/renditions/', url)
+        self.assertTrue(url.endswith('.webp'))
+        self.assertTrue(avatar_url(self.user, 32, 'jpeg').endswith('.jpg'))
+        name = url.rsplit('/', 1)[1]
+        with Image.open(default_storage.path(f'{rendition_folder(self.user.pk)}/{name}')) as image:
+            self.assertEqual(image.size, (SMALL_SIZE, SMALL_SIZE))
+
+    def test_saves_without_a_new_avatar_dont_render(self):
+        self.set_avatar('alice.png', 'red')
+        self.render()
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.user.bio = 'hello'
+            self.user.save()
+        self.assertEqual(callbacks, [])
+
+    def test_a_new_avatar_replaces_the_old_files(self):
+        self.set_avatar('alice.png', 'red')
+        self.render()
+        old = self.rendition_files()
+        self.set_avatar('alice2.png', 'blue')
+        # until the new renditions are made the new original is served
+        self.assertEqual(avatar_url(self.user), self.user.avatar.url)
+        self.render()
+        new = self.rendition_files()
+        self.assertEqual(len(new), len(SIZES) * 2)
+        self.assertFalse(old & new)
 
-# Create your tests here.
+    def test_renditions_of_a_replaced_avatar_are_not_recorded(self):
+        self.set_avatar('alice.png', 'red')
+        self.render()
+        renditions = self.user.avatar_renditions
+        record_renditions(self.user.pk, 'avatars/older.png', rendition_folder(self.user.pk), {})
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.avatar_renditions, renditions)
@@ -1,5 +1,6 @@
 from django.shortcuts import render
 from django.contrib.auth import authenticate
+from django.utils import timezone
 
 from .models import User , UserProfile
 from .serializers import UserSerializer, UserRegistrationSerializer
@@ -39,8 +40,8 @@ def login_view(request):
 
     if user:
         refresh =  RefreshToken.for_user(user)
-        user.is_online=True
-        user.save()
+        # is_online follows open chat sockets (chats.presence), only stamp last_seen
+        User.objects.filter(pk=user.pk).update(last_seen=timezone.now())
 
         return Response({
             'user': UserSerializer(user).data,
@@ -60,6 +61,5 @@ class UserProfileView(generics.RetrieveUpdateAPIView):
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
 def logout_view(request):
-    request.user.is_online = False
-    request.user.save()
+    User.objects.filter(pk=request.user.pk).update(last_seen=timezone.now())
     return Response({"message": "Successfully logged out"})
@@ -99,7 +99,7 @@ const ChatRoom = () => {
               <p className="text-gray-400 text-sm">
                 {typingUsers.length > 0
                   ? `${typingUsers[0].username} is typing...`
-                  : `${activeRoom.participants.length} participants`
+                  : `${activeRoom.participant_count ?? activeRoom.participants.length} participants`
                 }
               </p>
             </div>
@@ -143,7 +143,7 @@ const ChatSidebar = ({ roomCreated}) => {
                       <div className="flex items-center justify-between mt-1">
                         <div className="flex items-center space-x-1 text-xs text-gray-500">
                           <Users className='w-3 h-3'></Users>
-                          <span>{ room.participants.length}</span>
+                          <span>{ room.participant_count}</span>
                         </div>
                         {room.unread_count > 0 && (
                           <span className="bg-purple-500 text-white text-xs px-2 py-1 rounded-full">
@@ -165,7 +165,7 @@ const ChatSidebar = ({ roomCreated}) => {
         <div className="flex items-center space-x-3">
           <div className="relative">
             <img 
-              src={user.avatar || '/default-avatar.png'} 
+              src={user.avatar_small || user.avatar || '/default-avatar.png'} 
               alt={user.name} 
               className='w-10 h-10 rounded-full border-2 border-green-500'
             />
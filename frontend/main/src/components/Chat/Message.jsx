@@ -37,9 +37,9 @@ const Message = ({message, index}) => {
 
   const getStatusIcon = () => {
     if (!isSent) return null;
-    if (message.read_by && message.read_by.length > 1) {
+    if (message.read_count > 0) {
       return <CheckCheck className='w-3 h-3 text-blue-500'></CheckCheck>;
-    }else if (message.read_by && message.read_by.length === 1) {
+    }else if (message.read_count === 0) {
       return <Check className='w-3 h-3 text-gray-500'></Check>;
     }
     return <Check className='w-3 h-3 text-gray-400'></Check>;
@@ -118,7 +118,7 @@ const Navbar = ({ activeTab, setActiveTab}) => {
               <div className="flex items-center space-x-3">
                 <div className="hidden sm:flex items-center space-x-2">
                   <img 
-                    src={user.avatar || '/default-avatar.png' || 'T'} 
+                    src={user.avatar_small || user.avatar || '/default-avatar.png'} 
                     alt={user.username} 
                     className='w-8 h-8 rounded-full border-2 border-purple-500'  
                   />
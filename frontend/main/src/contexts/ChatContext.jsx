@@ -99,6 +99,24 @@ const chatReducer = (state, action) => {
         ),
       };
 
+    case 'ROOM_UPDATED': {
+      // new messages and preview pushed for a room this socket isn't in, moved to the top
+      const updated = state.rooms.find(room => room.id === action.payload.room_id);
+      if (!updated) return state;
+      return {
+        ...state,
+        rooms: [
+          {
+            ...updated,
+            unread_count: (updated.unread_count || 0) + action.payload.new_messages,
+            last_message: action.payload.last_message,
+            last_activity_at: action.payload.last_message.created_at,
+          },
+          ...state.rooms.filter(room => room.id !== action.payload.room_id),
+        ],
+      };
+    }
+
     case 'USER_ONLINE':
       return {
         ...state,
@@ -177,6 +195,10 @@ export const ChatProvider = ({ children }) => {
       dispatch({ type: 'USER_OFFLINE', payload: data});
     });
 
+    webSocketManager.on(WEBSOCKET_EVENTS.ROOM_UPDATED, (data) => {
+      dispatch({ type: 'ROOM_UPDATED', payload: data});
+    });
+
     return () => {
       console.log("Cleaning up websocket event listeners");
       webSocketManager.off(WEBSOCKET_EVENTS.CHAT_MESSAGE);
@@ -185,6 +207,7 @@ export const ChatProvider = ({ children }) => {
       webSocketManager.off(WEBSOCKET_EVENTS.MESSAGE_READ);
       webSocketManager.off(WEBSOCKET_EVENTS.USER_ONLINE);
       webSocketManager.off(WEBSOCKET_EVENTS.USER_OFFLINE);
+      webSocketManager.off(WEBSOCKET_EVENTS.ROOM_UPDATED);
     };
   }, [user]);
 
@@ -37,7 +37,10 @@ export const WEBSOCKET_EVENTS = {
     MESSAGE_READ: 'message_read',
     USER_ONLINE: 'user_online',
     USER_OFFLINE: 'user_offline',
+    // new messages and preview of a room the socket isn't subscribed to
     ROOM_UPDATED: 'room_updated',
+    // sent back every few frames, the server holds frames while too many are unacknowledged
+    FRAMES_RECEIVED: 'frames_received',
 };
 
 export const    SUBSCRIPTION_PLANS = {
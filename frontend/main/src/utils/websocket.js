@@ -8,6 +8,9 @@ class WebSocketManager {
         this.reconnectInterval = 3000;
         this.eventListeners = new Map();
         this.isConnected = false;
+        // frames received on the current socket, reported so the server knows what's still in flight
+        this.framesReceived = 0;
+        this.ackEvery = 20;
     }
 
     connect(roomId) {
@@ -25,6 +28,7 @@ class WebSocketManager {
         try {
             const wsUrl = `ws://localhost:8000/ws/chat/${roomId}/?token=${token}`;
             this.ws = new WebSocket(wsUrl);
+            this.framesReceived = 0;
 
             this.ws.onopen = () => {
                 console.log("Websocket connected successfully");
@@ -34,6 +38,10 @@ class WebSocketManager {
             };
 
             this.ws.onmessage = (event) => {
+                this.framesReceived++;
+                if (this.framesReceived % this.ackEvery === 0) {
+                    this.sendMessage(WEBSOCKET_EVENTS.FRAMES_RECEIVED, { count: this.framesReceived });
+                }
                 try {
                     const data = JSON.parse(event.data);
                     this.handleMessage(data);